@@ -1,56 +1,276 @@
 #!/usr/bin/env python
 
-# Purpose: Plot histograms of all umbrella sampling windows altogether; 
-#    they should overlap.
+# Purpose: Check the overlap of umbrella sampling windows.
+#    Histograms all windows on one shared bin grid, computes the pairwise
+#    overlap matrix of the window histograms, and flags neighboring windows
+#    whose overlap is below a threshold. With a centers file (as for mbar.py)
+#    and pymbar installed, also computes the MBAR overlap matrix and its
+#    overlap scalar (1 minus the second largest eigenvalue).
+#    Exits with status 1 if any neighbor pair is flagged, so it can be
+#    used to check batches of US runs without plotting (--noplot).
+#    Windows are histogrammed chunk by chunk (see US/histogram.py), one
+#    window per process with --nproc, so they need not fit in memory
+#    (except for the MBAR overlap, which needs all samples).
 # Usage: python file.py
+#        python file.py -d trajfiles -n 53 --eqt 8000 --threshold 0.03 --noplot
+#        python file.py --centers data/centers.dat --temp 308 -o overlap.dat
+#
+# Histogram overlap of windows k and l is sum_i min(p_ki, p_li), where p_ki
+#    is the fraction of window k's samples in bin i. It is 1 for identical
+#    distributions and 0 for distributions that share no bins.
 
 import os
+import sys
 import numpy as np
-import matplotlib.pyplot as p
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+import colvars_traj # shared colvars .traj reader in US/
+import histogram # streaming histograms in US/
+
+try:
+    import pymbar
+except ImportError:
+    pymbar = None
 
 # -------------------- Variables ------------------ #
 
-os.chdir("/pub/limvt/pmf/07_us/02_analysis/trajfiles")
+trajdir = "/pub/limvt/pmf/07_us/02_analysis/trajfiles"
+figname = "/pub/limvt/pmf/07_us/02_analysis/02_overlap/overlap.png"
 
 numWins = 53 # total number of US windows
 eqt = 8000  # equil time to discard. 1000 = 1 ns
+nbins = 100 # number of bins of shared histogram grid
+threshold = 0.03 # minimum histogram overlap of neighboring windows
+
+kB = 1.381e-23 * 6.022e23 / 1000.0 # Boltzmann constant in kJ/mol/K
 
 # ------------------------------------------------- #
 
-data = []
-for i in range(numWins):
-    if i < 10:
-        index = "0"+str(i)
+
+def findWindows(trajdir, numWins):
+    """
+    Find the winNN.traj file of each window.
+
+    Returns
+    -------
+    wins: list of int window numbers of the files found
+    tfiles: list of string names of the files found
+
+    """
+    wins = []
+    tfiles = []
+    for i in range(numWins):
+        tfile = os.path.join(trajdir, "win%02d.traj" % i)
+        if not os.path.isfile(tfile):
+            print("No file for window %d: %s" % (i, tfile))
+            continue
+        wins.append(i)
+        tfiles.append(tfile)
+    return wins, tfiles
+
+
+def histogramFiles(tfiles, nbins=100, zrange=None, eqt=0, nproc=1):
+    """
+    Histogram all windows on a shared grid of bins, streaming each file.
+
+    Parameters
+    ----------
+    tfiles: list of string names of .traj files, one per window
+    nbins: int number of bins
+    zrange: (zmin, zmax) range of the bins. Default is the range of all data,
+       which takes an extra pass over the files.
+    eqt: int number of frames to discard from start of each window
+    nproc: int number of processes, one window each. None uses all cores.
+
+    Returns
+    -------
+    edges, counts: see histogramWindows
+
+    """
+    if zrange is None:
+        zrange = histogram.traj_range(tfiles, 1, eqt)
+    edges = np.linspace(zrange[0], zrange[1], nbins+1)
+    hist = histogram.histogram_trajs(tfiles, edges, 1, eqt, nproc=nproc)
+    return edges, hist.counts
+
+
+def histogramWindows(data, nbins=100, zrange=None):
+    """
+    Histogram all windows on a shared grid of bins, at once.
+
+    Parameters
+    ----------
+    data: list of numpy arrays of positions, one per window
+    nbins: int number of bins
+    zrange: (zmin, zmax) range of the bins. Default is the range of all data.
+
+    Returns
+    -------
+    edges: numpy array of shape [nbins+1] of bin edges
+    counts: numpy int array of shape [K, nbins] of histogram of each window.
+       Positions outside of zrange are not counted.
+
+    """
+    if zrange is None:
+        zrange = (min(d.min() for d in data), max(d.max() for d in data))
+    hist = histogram.HistogramAccumulator.uniform(zrange[0], zrange[1], nbins, len(data))
+    for k, d in enumerate(data):
+        hist.update(d, k)
+    return hist.edges, hist.counts
+
+
+def overlapMatrix(counts):
+    """
+    Compute the pairwise overlap of window histograms.
+
+    Parameters
+    ----------
+    counts: numpy array of shape [K, nbins] of histograms on a shared grid
+
+    Returns
+    -------
+    O_kl: numpy array of shape [K, K], O_kl[k,l] = sum_i min(p_ki, p_li)
+
+    """
+    N_k = counts.sum(axis=1).astype(np.float64)
+    p_ki = counts / np.maximum(N_k, 1)[:,np.newaxis]
+    K = len(p_ki)
+    O_kl = np.zeros([K, K])
+    for k in range(K):
+        O_kl[k] = np.minimum(p_ki[k], p_ki).sum(axis=1)
+    return O_kl
+
+
+def mbarOverlap(data, centers, springs, temp):
+    """
+    Compute the MBAR overlap matrix of the windows with pymbar.
+
+    Parameters
+    ----------
+    data: list of numpy arrays of positions, one per window
+    centers: numpy array of spring centers (Angs)
+    springs: numpy array of spring constants (kJ/mol/Angs**2)
+    temp: float temperature (K)
+
+    Returns
+    -------
+    O_kl: numpy array of shape [K, K] of MBAR overlap matrix
+    scalar: float overlap scalar, 1 minus the second largest eigenvalue of O_kl
+
+    """
+    beta = 1.0/(kB*temp)
+    N_k = np.array([len(d) for d in data])
+    z_n = np.concatenate(data)
+    u_kn = beta * 0.5*springs[:,np.newaxis] * (z_n[np.newaxis,:] - centers[:,np.newaxis])**2
+
+    mbar = pymbar.MBAR(u_kn, N_k)
+    if hasattr(mbar, 'compute_overlap'): # pymbar 4
+        overlap = mbar.compute_overlap()
     else:
-        index = str(i)
-    tfile = "win"+index+".traj"
-    print tfile
-
-    if not os.path.isfile(tfile):
-        continue
-
-    with open(tfile) as f:
-        lines = f.readlines()[eqt:]
-
-        zlist = []
-        for line in lines:
-            parts = line.split() # split line into parts
-            if len(parts) > 1:   # if at least 2 parts/columns
-                zlist.append(float(parts[1]))   # print column 2
-    data.append(zlist)
-    
-print len(data)
-print len(zlist)
-
-
-p.figure(figsize=(20,8))
-for i, zlist in enumerate(data):
-    y,binEdges = np.histogram(zlist,bins=100)
-    bincenters = 0.5*(binEdges[1:]+binEdges[:-1])
-    p.plot(bincenters,y,'-')
-p.tick_params(axis='both', which='major', labelsize=14)
-p.xlabel("z coordinate ($\AA$)",fontsize=16)
-p.ylabel("count",fontsize=16)
-
-p.savefig(os.path.join("/pub/limvt/pmf/07_us/02_analysis/02_overlap","overlap.png"))
-p.show()
+        overlap = mbar.computeOverlap()
+    if isinstance(overlap, dict): # pymbar 3 and 4
+        O_kl = overlap['matrix']
+    else: # pymbar 2 returns the scalar by default
+        O_kl = mbar.computeOverlap(output='matrix')
+    eig = np.sort(np.linalg.eigvals(O_kl).real)[::-1]
+    return O_kl, 1.0 - eig[1]
+
+
+def flagNeighbors(O_kl, threshold):
+    """
+    Get the neighboring windows whose overlap is below a threshold.
+
+    Returns
+    -------
+    flagged: list of (k, k+1, overlap) tuples of matrix indices
+
+    """
+    neighbors = np.diagonal(O_kl, offset=1)
+    return [(k, k+1, o) for k, o in enumerate(neighbors) if o < threshold]
+
+
+def plotOverlap(edges, counts, figname=None):
+    import matplotlib.pyplot as p
+
+    bincenters = 0.5*(edges[1:]+edges[:-1])
+    p.figure(figsize=(20,8))
+    for y in counts:
+        p.plot(bincenters,y,'-')
+    p.tick_params(axis='both', which='major', labelsize=14)
+    p.xlabel("z coordinate ($\AA$)",fontsize=16)
+    p.ylabel("count",fontsize=16)
+
+    if figname is not None:
+        p.savefig(figname)
+    p.show()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-d", "--trajdir", default=trajdir,
+                        help="Directory of winNN.traj files.")
+    parser.add_argument("-n", "--numwins", type=int, default=numWins,
+                        help="Total number of US windows.")
+    parser.add_argument("--eqt", type=int, default=eqt,
+                        help="Number of frames to discard from start of each window.")
+    parser.add_argument("-b", "--nbins", type=int, default=nbins,
+                        help="Number of bins of the shared histogram grid.")
+    parser.add_argument("-r", "--range", type=float, nargs=2, default=None,
+                        help="Min and max of the histogram grid. Default is range of data.")
+    parser.add_argument("-t", "--threshold", type=float, default=threshold,
+                        help="Flag neighboring windows with overlap below this value.")
+    parser.add_argument("-c", "--centers", default=None,
+                        help="File of US centers (col 1, Angs) and spring constants "
+                             "(col 2, kJ/mol/Angs**2), one line per window as for "
+                             "mbar.py. Enables the MBAR overlap with pymbar.")
+    parser.add_argument("--temp", type=float, default=308.,
+                        help="Temperature (K) for the MBAR overlap.")
+    parser.add_argument("-o", "--outfile", default=None,
+                        help="Write the histogram overlap matrix to this file.")
+    parser.add_argument("--figname", default=figname,
+                        help="Name of the figure of histograms to save.")
+    parser.add_argument("--noplot", action="store_true", default=False,
+                        help="Do not plot the histograms.")
+    parser.add_argument("-p", "--nproc", type=int, default=1,
+                        help="Number of processes to histogram windows.")
+
+    args = parser.parse_args()
+    wins, tfiles = findWindows(args.trajdir, args.numwins)
+    edges, counts = histogramFiles(tfiles, args.nbins, args.range, args.eqt, args.nproc)
+    print("Histogrammed %d windows" % len(tfiles))
+    O_kl = overlapMatrix(counts)
+    if args.outfile is not None:
+        np.savetxt(args.outfile, O_kl, fmt='%.4f',
+                   header="histogram overlap matrix of windows %s" % ' '.join(map(str, wins)))
+
+    ### Overlap of neighboring windows.
+    flagged = flagNeighbors(O_kl, args.threshold)
+    print("\n%8s %8s %10s" % ('win', 'win', 'overlap'))
+    for k, o in enumerate(np.diagonal(O_kl, offset=1)):
+        flag = ' *' if o < args.threshold else ''
+        print("%8d %8d %10.4f%s" % (wins[k], wins[k+1], o, flag))
+
+    ### MBAR overlap.
+    if args.centers is not None:
+        if pymbar is None:
+            print("\npymbar not found; skipping MBAR overlap")
+        else:
+            centers = np.loadtxt(args.centers, ndmin=2)[wins]
+            data = [colvars_traj.read_traj(f, columns=1, start=args.eqt) for f in tfiles]
+            M_kl, scalar = mbarOverlap(data, centers[:,0], centers[:,1], args.temp)
+            print("\nMBAR overlap scalar (1 - second largest eigenvalue): %.6f" % scalar)
+            print("%8s %8s %10s" % ('win', 'win', 'MBAR'))
+            for k, o in enumerate(np.diagonal(M_kl, offset=1)):
+                print("%8d %8d %10.4f" % (wins[k], wins[k+1], o))
+
+    if flagged:
+        print("\n%d neighboring pairs with overlap below %g:" % (len(flagged), args.threshold))
+        for k, l, o in flagged:
+            print("   windows %d and %d: %.4f" % (wins[k], wins[l], o))
+
+    if not args.noplot:
+        plotOverlap(edges, counts, args.figname)
+
+    sys.exit(1 if flagged else 0)
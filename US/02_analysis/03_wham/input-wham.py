@@ -6,10 +6,21 @@
 #   inputs to specify whether to use subset of data and start / end time (ns). 
 # Usage, for subset:    python file.py --portion True --begin 0 --end 13
 # Usage, for all data:  python file.py --portion False --begin 0 --end <largesttime>
+# Usage, for time blocks: python file.py --blocks 0,13,26,39,52,104 [--cumulative]
+#   Writes subsets and WHAM input files of all blocks, reading each .traj file once.
+#   If a window's subset is empty, the latest earlier block's subset is used
+#   instead (unless --prefix is given).
+# Usage, without copies:  add --descriptors to write small .slice files that
+#   point into each win*.traj (by byte offset) instead of copies of the subset.
+#   These WHAM inputs are read by wham.py, not by Grossfield WHAM.
 
 import os
+import sys
 import glob
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+import colvars_traj # shared colvars .traj reader in US/
+
 
 # ==================================================
 
@@ -32,32 +43,67 @@ os.chdir('/pub/limvt/pmf/07_us/02_analysis/trajfiles')
 
 # ==================================================
 
-def GenInput(usePortion, startns, stopns, shortprefix):
+def frameRange(startns, stopns):
+    """Get the [start, stop) frames of a time slice (step*2/1e6 = time ns)."""
     if startns != 0:
-        time1 = (1000*startns/2)+1
+        time1 = (1000*startns//2)+1
     else:
         time1 = startns
-    time2 = (1000*stopns/2)
+    time2 = (1000*stopns//2)
+    return time1, time2
+
+
+def SliceTrajs(blocks, ext='.traj'):
+    """
+    Write subset of each traj file for every (startns, stopns) time block,
+    streaming each file once and only the lines in the slices.
+    With ext='.slice', write slice descriptors instead of copies, which
+    only scans each traj file once to index it.
+    Existing subset files are not rewritten.
+    """
+    for f in glob.glob('win*traj'):
+        slices = []
+        for startns, stopns in blocks:
+            trajout = "%d-%dns_%s%s" % (startns, stopns, f.split('.')[0], ext)
+            if not os.path.exists(trajout):
+                slices.append((trajout,) + frameRange(startns, stopns))
+        if not slices:
+            continue
+        if ext == colvars_traj.SLICE_EXT:
+            for trajout, time1, time2 in slices:
+                colvars_traj.write_slice(f, trajout, time1, time2)
+        else:
+            colvars_traj.copy_slices(f, slices)
+
+
+def isEmpty(trajout):
+    """Check whether a subset .traj file or slice descriptor has no frames."""
+    if trajout.endswith(colvars_traj.SLICE_EXT):
+        return colvars_traj.count_frames(trajout) == 0
+    return os.stat(trajout).st_size == 0
+
+
+def GenInput(usePortion, startns, stopns, shortprefix, writeSubsets=True, ext='.traj'):
+    """
+    Write WHAM input file for one time slice.
+    shortprefix may be a string or a list of prefixes tried in order.
+    Set writeSubsets=False if the subsets were already written by SliceTrajs.
+    ext is '.traj' for copies of subsets or '.slice' for slice descriptors.
+    """
+    if shortprefix is None:
+        prefixes = []
+    elif isinstance(shortprefix, str):
+        prefixes = [shortprefix]
+    else:
+        prefixes = shortprefix
 
     ### Output file names
     wham = "WHAM-INPUT_%d-%dns" % (startns, stopns)
     pmf = "US_%d-%dns.pmf" % (startns, stopns)
     
-    ### open and read traj files 
-    for f in glob.glob('win*traj'):
-        inf = open(f, 'r')
-        lines = inf.readlines()
-        inf.close()
-    
-        ### write out subset of each traj file
-        if usePortion: 
-            trajout = "%d-%dns_%s.traj" % (startns, stopns, f.split('.')[0])
-            if not os.path.exists(trajout):
-                outf = open(trajout, 'w')
-                subset = lines[time1:time2]
-                for i in subset:
-                    outf.write(str(i))
-                outf.close()
+    ### write out subset of each traj file, streaming only the lines in the slice
+    if usePortion and writeSubsets:
+        SliceTrajs([(startns, stopns)], ext)
     
     ### open and write WHAM input file header
     fname = os.path.join('../03_wham',wham)
@@ -65,7 +111,7 @@ def GenInput(usePortion, startns, stopns, shortprefix):
         whamf = open(fname, 'w')
     else:
         print("WHAM input file already exists: %s" % fname)
-        quit()
+        return
     whamf.write("### wham %f %f %d %f %f %f %s %s" % (minZ, maxZ, numbins, tolerance, temp, padding, wham, pmf))
     whamf.write("\n### /path/to/timeseries/file loc_win_min spring [correl time] [temp]")
     whamf.write("\n###")
@@ -84,20 +130,22 @@ def GenInput(usePortion, startns, stopns, shortprefix):
             cent = str(maxZ-i)
     
         if usePortion:
-            trajout = '%d-%dns_win%s.traj' % (startns, stopns, win)
+            trajout = '%d-%dns_win%s%s' % (startns, stopns, win, ext)
     
             ### use prespecified files for some windows that ran for less time
-            if os.stat(trajout).st_size == 0:
-                trajout = '%s_win%s.traj' % (shortprefix, win)
-                if os.stat(trajout).st_size == 0:
-                    print("ALERT: %s in WHAM input is an empty file" % trajout)
+            for prefix in prefixes:
+                if not isEmpty(trajout):
+                    break
+                trajout = '%s_win%s%s' % (prefix, win, ext)
+            if isEmpty(trajout):
+                print("ALERT: %s in WHAM input is an empty file" % trajout)
         else:
             trajout = 'win%s.traj' % win   
-        print trajout
+        print(trajout)
     
         ### don't write to WHAM if the window didn't finish
         if not os.path.exists(trajout):
-            print "No *.traj output for WHAM for %s" % (trajout)
+            print("No *.traj output for WHAM for %s" % (trajout))
             i += 1
             continue
     
@@ -105,6 +153,26 @@ def GenInput(usePortion, startns, stopns, shortprefix):
         i += 1
     whamf.close()
 
+
+def GenInputs(blocks, shortprefix=None, ext='.traj'):
+    """
+    Write subsets and WHAM input files for a list of (startns, stopns) time
+    blocks, e.g. to plot evolution of PMF over successive times.
+    Prints the WHAM command to run for each block.
+    """
+    SliceTrajs(blocks, ext)
+    for i, (startns, stopns) in enumerate(blocks):
+        if shortprefix is not None:
+            prefixes = [shortprefix]
+        else:
+            # fall back to latest earlier block with data for a window
+            prefixes = ["%d-%dns" % b for b in blocks[i-1::-1]] if i > 0 else []
+        GenInput(True, startns, stopns, prefixes, writeSubsets=False, ext=ext)
+
+    for startns, stopns in blocks:
+        print("wham %f %f %d %f %f %f WHAM-INPUT_%d-%dns US_%d-%dns.pmf > wham_%d-%dns.out" % (minZ, maxZ,
+              numbins, tolerance, temp, padding, startns, stopns, startns, stopns, startns, stopns))
+
 # ------------------------- Parse Command Line Inputs ----------------------- #
 if __name__ == '__main__':
     from optparse import OptionParser
@@ -137,6 +205,37 @@ Look for warning msgs if this is empty too.",
             type = "string",
             dest = 'shortprefix')
 
+    parser.add_option('-t', '--blocks',
+            help = "Comma-separated integer times in nanoseconds bounding time blocks, \
+e.g. 0,13,26,39,52,104. Writes inputs of all blocks in one pass; \
+--begin, --end, and --portion are ignored.",
+            default = None,
+            type = "string",
+            dest = 'blocks')
+
+    parser.add_option('-c', '--cumulative',
+            help = "With --blocks, use cumulative blocks (0-13, 0-26, ...) \
+instead of successive ones (0-13, 13-26, ...).",
+            action = "store_true",
+            default = False,
+            dest = 'cumulative')
+
+    parser.add_option('-d', '--descriptors',
+            help = "Write .slice descriptors pointing into the win*.traj files \
+instead of copies of the subsets. For wham.py only.",
+            action = "store_true",
+            default = False,
+            dest = 'descriptors')
+
     (opt, args) = parser.parse_args()
+    ext = colvars_traj.SLICE_EXT if opt.descriptors else '.traj'
     #usePortion = opt.usePortion.lower() in ("true", "True", "TRUE")
-    GenInput(opt.usePortion, opt.startns, opt.stopns, opt.shortprefix)
+    if opt.blocks is not None:
+        edges = [int(t) for t in opt.blocks.split(',')]
+        if opt.cumulative:
+            blocks = [(edges[0], t) for t in edges[1:]]
+        else:
+            blocks = list(zip(edges[:-1], edges[1:]))
+        GenInputs(blocks, opt.shortprefix, ext)
+    else:
+        GenInput(opt.usePortion, opt.startns, opt.stopns, opt.shortprefix, ext=ext)
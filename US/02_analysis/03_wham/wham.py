@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+
+# Purpose: Weighted histogram analysis method (WHAM) to combine US windows
+#   to a PMF, in place of the external Grossfield WHAM program.
+#   Takes the same arguments and metadata file as Grossfield WHAM and
+#   writes the same .pmf output format, which plot-wham.py reads.
+#   The self-consistent equations are solved for all windows and bins
+#   at once, and all Monte Carlo bootstrap trials are solved together.
+# Usage: python file.py [P|Ppi|Pval] hist_min hist_max num_bins tol temperature
+#            numpad metadatafile freefile [num_MC_trials randSeed]
+#   e.g. python file.py -8 44 180 0.0001 308 0 WHAM-INPUT_0-104ns US_0-104ns.pmf 100 1
+# Usage, slicing times (ns) in memory instead of reading sliced copies:
+#   python file.py ... --begin 0 --end 13 metadata_of_whole_windows freefile
+# Usage, many time blocks in parallel (freefile contains two %d for tstart, tstop):
+#   python file.py ... --blocks 0,13,26,39,52,104 --nproc 5 metadata US_%d-%dns.pmf
+#
+# Metadata lines: /path/to/timeseries/file loc_win_min spring [correl time] [temp]
+#   Time series files have time in column 1 and position in column 2 (e.g.
+#   colvars .traj files); lines starting with '#' or '@' are skipped.
+#   Bias is 0.5*spring*(x-loc_win_min)**2 in kcal/mol, with spring in
+#   kcal/mol/Angs**2. The correl time (in number of samples) reduces the
+#   number of independent samples drawn in bootstrap trials to
+#   N/(1+2*correl_time). The temperature column is read but not used; all
+#   windows are taken to be at the temperature given on the command line.
+#
+# Python usage:
+#   import wham
+#   windows = wham.readMetadata('WHAM-INPUT_0-104ns')
+#   data = wham.readWindows(windows)
+#   res = wham.wham(data, [w['center'] for w in windows],
+#                   [w['spring'] for w in windows], -8, 44, 180, 308, num_mc=100)
+#
+# Reference:
+#   Grossfield, A. "WHAM: the weighted histogram analysis method",
+#   version 2.0.9, http://membrane.urmc.rochester.edu/content/wham
+
+import os
+import sys
+import multiprocessing
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+import colvars_traj # shared colvars .traj reader in US/
+import autocorr # FFT statistical inefficiency in US/
+
+kB = 0.001982923700 # Boltzmann constant in kcal/mol/K, as in Grossfield WHAM
+
+
+# ==================================================
+
+def readMetadata(metafile):
+    """
+    Read a Grossfield WHAM metadata file.
+
+    Parameters
+    ----------
+    metafile: string name of the metadata file
+
+    Returns
+    -------
+    windows: list of dicts, one per window, with keys 'file', 'center',
+       'spring', and 'ctime' (None if not given) and 'temp' (None if not given)
+
+    """
+    windows = []
+    with open(metafile, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0][0] == '#':
+                continue
+            windows.append({'file': fields[0],
+                            'center': float(fields[1]),
+                            'spring': float(fields[2]),
+                            'ctime': float(fields[3]) if len(fields) > 3 else None,
+                            'temp': float(fields[4]) if len(fields) > 4 else None})
+    return windows
+
+
+def frameRange(startns, stopns):
+    """
+    Get the [start, stop) frames of a time slice (step*2/1e6 = time ns),
+    the same frames that input-wham.py writes to sliced .traj copies.
+    """
+    start = 0
+    if startns:
+        start = int(1000*startns//2)+1
+    stop = None
+    if stopns is not None:
+        stop = int(1000*stopns//2)
+    return start, stop
+
+
+def _readWindow(job):
+    filename, start, stop = job
+    return colvars_traj.read_traj(filename, columns=1, start=start, stop=stop)
+
+
+def readWindows(windows, startns=0, stopns=None, nproc=1):
+    """
+    Read the positions of each window, optionally only of a time slice.
+
+    Parameters
+    ----------
+    windows: list of dicts from readMetadata
+    startns: start time (ns) of slice
+    stopns: stop time (ns) of slice; None reads to the end
+    nproc: int number of processes to read windows. None uses all cores.
+
+    Returns
+    -------
+    data: list of numpy arrays of positions, one per window
+
+    """
+    start, stop = frameRange(startns, stopns)
+    jobs = [(w['file'], start, stop) for w in windows]
+    if nproc == 1:
+        return [_readWindow(job) for job in jobs]
+    pool = multiprocessing.Pool(nproc)
+    try:
+        return pool.map(_readWindow, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _logsumexp(a, axis):
+    """Compute log(sum(exp(a))) along an axis, allowing -inf entries."""
+    m = np.max(a, axis=axis, keepdims=True)
+    m[~np.isfinite(m)] = 0.
+    with np.errstate(divide='ignore'):
+        s = np.log(np.sum(np.exp(a - m), axis=axis, keepdims=True))
+    return np.squeeze(s + m, axis=axis)
+
+
+def solve(n_ki, logc_ki, kT, tol=1e-4, maxiter=100000, f_k=None):
+    """
+    Iterate the WHAM equations to self-consistency in log space.
+
+        P_i = sum_k n_ki / sum_k N_k exp(f_k) c_ki
+        exp(-f_k) = sum_i c_ki P_i
+
+    where c_ki = exp(-w_k(x_i)/kT) and f_k = F_k/kT.
+
+    Parameters
+    ----------
+    n_ki: numpy array of shape [..., K, nbins] of histogram counts.
+       Leading dimensions (e.g. bootstrap trials) are solved together.
+    logc_ki: numpy array of shape [K, nbins] of -w_k(x_i)/kT
+    kT: float thermal energy (kcal/mol)
+    tol: float convergence tolerance of window free energies (kcal/mol)
+    maxiter: int maximum number of iterations
+    f_k: numpy array of shape [..., K] of initial dimensionless window
+       free energies; default zeros
+
+    Returns
+    -------
+    logP_i: numpy array of shape [..., nbins] of unnormalized log probabilities
+    f_k: numpy array of shape [..., K] of dimensionless window free
+       energies, with f_k[..., 0] = 0
+
+    """
+    n_ki = np.asarray(n_ki, np.float64)
+    with np.errstate(divide='ignore'):
+        logN_k = np.log(n_ki.sum(axis=-1))
+        lognum_i = np.log(n_ki.sum(axis=-2))
+    if f_k is None:
+        f_k = np.zeros(n_ki.shape[:-1])
+
+    for it in range(maxiter):
+        logP_i = lognum_i - _logsumexp((logN_k + f_k)[..., np.newaxis] + logc_ki, axis=-2)
+        f_new = -_logsumexp(logc_ki + logP_i[..., np.newaxis, :], axis=-1)
+        f_new -= f_new[..., :1]
+        delta = np.max(np.abs(f_new - f_k))*kT
+        f_k = f_new
+        if delta < tol:
+            break
+    else:
+        print("WARNING: WHAM not converged after %d iterations (change %g)" % (maxiter, delta))
+
+    logP_i = lognum_i - _logsumexp((logN_k + f_k)[..., np.newaxis] + logc_ki, axis=-2)
+    return logP_i, f_k
+
+
+def _profile(logP_i, kT):
+    """Get free energies (min of zero) and normalized probabilities of bins."""
+    free = -kT*logP_i
+    free -= np.min(free, axis=-1, keepdims=True)
+    prob = np.exp(logP_i - _logsumexp(logP_i, axis=-1)[..., np.newaxis])
+    return free, prob
+
+
+def wham(data, centers, springs, hist_min, hist_max, num_bins, temp,
+         tol=1e-4, period=None, num_mc=0, seed=None, ctimes=None):
+    """
+    Compute the PMF of umbrella sampling windows by WHAM.
+
+    Parameters
+    ----------
+    data: list of numpy arrays of positions, one per window
+    centers: list of floats of spring centers
+    springs: list of floats of spring constants (kcal/mol/unit**2)
+    hist_min, hist_max: float range of the histogram; positions outside
+       are ignored
+    num_bins: int number of histogram bins
+    temp: float temperature (K)
+    tol: float convergence tolerance (kcal/mol)
+    period: float period of the coordinate, e.g. 360, or None if not periodic
+    num_mc: int number of Monte Carlo bootstrap trials for errors; 0 for none
+    seed: int seed for random number generator of bootstrap trials
+    ctimes: list of correlation times (number of samples) of windows for
+       bootstrap trials, with None entries for uncorrelated data.
+       'auto' computes them from the data with autocorr.py.
+
+    Returns
+    -------
+    result: dict of numpy arrays
+       coor: bin centers
+       free, dfree: free energy (kcal/mol) and its bootstrap error of bins
+       prob, dprob: normalized probability and its bootstrap error of bins
+       F_k, dF_k: free energy (kcal/mol) and its bootstrap error of windows
+    Errors are zeros if num_mc is 0.
+
+    """
+    K = len(data)
+    kT = kB*temp
+    centers = np.asarray(centers, np.float64)
+    springs = np.asarray(springs, np.float64)
+    edges = np.linspace(hist_min, hist_max, num_bins+1)
+    coor = 0.5*(edges[1:] + edges[:-1])
+
+    # histograms of all windows; np.histogram includes hist_max in last bin
+    n_ki = np.array([np.histogram(z, bins=edges)[0] for z in data], np.float64)
+
+    # biasing potential of each window at each bin center
+    dx = coor[np.newaxis,:] - centers[:,np.newaxis]
+    if period is not None:
+        dx -= period*np.round(dx/period)
+    logc_ki = -0.5*springs[:,np.newaxis]*dx**2/kT
+
+    logP_i, f_k = solve(n_ki, logc_ki, kT, tol)
+    free, prob = _profile(logP_i, kT)
+    result = {'coor': coor, 'free': free, 'prob': prob, 'F_k': f_k*kT,
+              'dfree': np.zeros(num_bins), 'dprob': np.zeros(num_bins),
+              'dF_k': np.zeros(K)}
+    if not num_mc:
+        return result
+
+    ### Monte Carlo bootstrap: resample each window's histogram with its
+    ### number of independent samples, then solve all trials together.
+    if ctimes == 'auto':
+        g_k = autocorr.statistical_inefficiency(list(data))
+    elif ctimes is None:
+        g_k = np.ones(K)
+    else:
+        g_k = np.array([1. if c is None else 1+2*c for c in ctimes])
+    N_k = n_ki.sum(axis=1)
+    neff_k = np.maximum(np.round(N_k/g_k), 1).astype(int)
+    neff_k[N_k == 0] = 0
+    p_ki = n_ki / np.maximum(N_k, 1)[:,np.newaxis]
+
+    rng = np.random.RandomState(seed)
+    fake = np.zeros([num_mc, K, num_bins])
+    for k in range(K):
+        if neff_k[k]:
+            fake[:,k,:] = rng.multinomial(neff_k[k], p_ki[k], size=num_mc)
+
+    logP_ti, f_tk = solve(fake, logc_ki, kT, tol, f_k=np.tile(f_k, (num_mc, 1)))
+    free_t, prob_t = _profile(logP_ti, kT)
+    with np.errstate(invalid='ignore'):
+        result['dfree'] = np.std(free_t, axis=0)
+    result['dprob'] = np.std(prob_t, axis=0)
+    result['dF_k'] = np.std(f_tk*kT, axis=0)
+    return result
+
+
+def writeFree(result, freefile):
+    """
+    Write WHAM results in the format of Grossfield WHAM free energy files.
+    """
+    with open(freefile, 'w') as f:
+        f.write("#Coor\t\tFree\t\t+/-\t\tProb\t\t+/-\n")
+        for row in zip(result['coor'], result['free'], result['dfree'],
+                       result['prob'], result['dprob']):
+            f.write("%f\t%f\t%f\t%f\t%f\n" % row)
+        f.write("#Window\t\tFree\t+/-\t\n")
+        for k, (F, dF) in enumerate(zip(result['F_k'], result['dF_k'])):
+            f.write("#%d\t%f\t%f\t\n" % (k, F, dF))
+
+
+def _runBlock(job):
+    """Run WHAM and write the free file for one (data, options, freefile) job."""
+    data, kwargs, freefile = job
+    writeFree(wham(data, **kwargs), freefile)
+    return freefile
+
+
+# ------------------------- Parse Command Line Inputs ----------------------- #
+if __name__ == '__main__':
+    import argparse
+
+    ### optional leading periodicity argument as in Grossfield WHAM
+    argv = sys.argv[1:]
+    period = None
+    if argv and argv[0][0] == 'P':
+        p = argv.pop(0)
+        if p == 'P':
+            period = 360.
+        elif p == 'Ppi':
+            period = 2*np.pi
+        else:
+            period = float(p[1:])
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("hist_min", type=float)
+    parser.add_argument("hist_max", type=float)
+    parser.add_argument("num_bins", type=int)
+    parser.add_argument("tol", type=float)
+    parser.add_argument("temperature", type=float)
+    parser.add_argument("numpad", type=int,
+                        help="Accepted for compatibility; not used.")
+    parser.add_argument("metadatafile")
+    parser.add_argument("freefile")
+    parser.add_argument("num_MC_trials", type=int, nargs='?', default=0)
+    parser.add_argument("randSeed", type=int, nargs='?', default=None)
+
+    parser.add_argument("-b", "--begin", type=float, default=0,
+                        help="Start time (ns) of data to use from each window.")
+    parser.add_argument("-e", "--end", type=float, default=None,
+                        help="Stop time (ns) of data to use from each window.")
+    parser.add_argument("-t", "--blocks", default=None,
+                        help="Comma-separated times (ns) bounding time blocks, "
+                             "e.g. 0,13,26,39,52,104. Runs WHAM for each block; "
+                             "freefile must contain two %%d for start and stop.")
+    parser.add_argument("-c", "--cumulative", action="store_true", default=False,
+                        help="With --blocks, use cumulative blocks (0-13, 0-26, ...).")
+    parser.add_argument("-a", "--autocorr", action="store_true", default=False,
+                        help="Compute correlation times of windows for bootstrap "
+                             "trials from the data instead of the metadata file.")
+    parser.add_argument("-n", "--nproc", type=int, default=1,
+                        help="Number of processes for reading windows and blocks.")
+
+    args = parser.parse_args(argv)
+    windows = readMetadata(args.metadatafile)
+    kwargs = {'centers': [w['center'] for w in windows],
+              'springs': [w['spring'] for w in windows],
+              'hist_min': args.hist_min, 'hist_max': args.hist_max,
+              'num_bins': args.num_bins, 'temp': args.temperature,
+              'tol': args.tol, 'period': period,
+              'num_mc': args.num_MC_trials, 'seed': args.randSeed,
+              'ctimes': 'auto' if args.autocorr else [w['ctime'] for w in windows]}
+
+    if args.blocks is None:
+        data = readWindows(windows, args.begin, args.end, args.nproc)
+        _runBlock((data, kwargs, args.freefile))
+        sys.exit()
+
+    edges = [float(t) for t in args.blocks.split(',')]
+    if args.cumulative:
+        blocks = [(edges[0], t) for t in edges[1:]]
+    else:
+        blocks = list(zip(edges[:-1], edges[1:]))
+
+    ### read each window once, then slice every block in memory
+    data = readWindows(windows, edges[0], edges[-1], args.nproc)
+    offset = frameRange(edges[0], None)[0]
+    jobs = []
+    for startns, stopns in blocks:
+        start, stop = frameRange(startns, stopns)
+        jobs.append(([z[start-offset:stop-offset] for z in data], kwargs,
+                     args.freefile % (startns, stopns)))
+    if args.nproc == 1:
+        for job in jobs:
+            print(_runBlock(job))
+    else:
+        pool = multiprocessing.Pool(args.nproc)
+        for freefile in pool.imap(_runBlock, jobs):
+            print(freefile)
+        pool.close()
+        pool.join()
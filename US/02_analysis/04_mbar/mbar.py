@@ -1,52 +1,92 @@
 #!/usr/bin/env python
 
 # Purpose: Use MBAR to compute PMF from NAMD US simulations.
-# Usage: python file.py > output.dat
+# Usage: python file.py -c mbar_config.json > output.dat
+#    or: python file.py -c mbar_config.json --blocks 0 13 26 39 52 104 -o blocks.dat
+#    or: import mbar; results = mbar.runPipeline(mbar.loadConfig('mbar_config.json'))
 
 # Adapted from:
 # https://github.com/davecap/pymbar/blob/master/examples/umbrella-sampling.py
 
+# Requires pymbar 3.x. The method argument of MBAR, MBAR.computePMF, and
+# the camelCase timeseries functions used here are not in pymbar 4.
+
+# Configuration (JSON) keys; see mbar_config.json for an example:
+#   workdir        directory for relative paths (default: dir of config file)
+#   temperature    temperature (K)
+#   z_min, z_max   range of independent variable (Angs)
+#   nbins          number of bins for PMF (like nbins of histogram, more = finer data)
+#   windows        list of {"file", "center", "spring", ["tstart"], ["tstop"]};
+#                  or instead of windows, give all three of:
+#   centers_file   file with US centers (col 1, Angs) and spring constants (col 2, kJ/mol/Angs**2)
+#   traj_pattern   filename pattern of window k, e.g. "data/win%02d.traj"
+#   num_windows    number of windows (default: number of lines in centers_file)
+#   tstart, tstop  default int start/stop time (ns) for each window (assuming step*2/1e6 = time)
+#   overrides      list of {"windows": [k, ...], "tstart", "tstop"} for particular windows
+#   flatten        use flattened u_kn [K, sum(N_k)] instead of padded u_kln [K, K, N_max]
+#   chunk          snapshots per block when evaluating reduced potentials; null = all at once
+#   nproc          number of processes to read and decorrelate windows; null = all cores
+#   ineff          statistical inefficiency from "fft" (autocorr.py) or "pymbar" (timeseries)
+#   cache_dir      directory for intermediate results; null disables caching
+#   block_edges    times (ns) bounding time blocks for a convergence series, e.g.
+#                  [0, 13, 26, 39, 52, 104]; null computes a single PMF
+#   block_mode     "sliding" for blocks between successive edges (0-13, 13-26, ...)
+#                  or "cumulative" for blocks from the first edge (0-13, 0-26, ...)
+#
+# Intermediate results (subsampled windows, bin assignments, reduced potentials,
+# MBAR free energies) are cached in cache_dir, keyed on the inputs they depend on.
+# E.g. changing only nbins re-bins the cached samples and warm-starts MBAR from
+# the cached free energies instead of re-reading and re-decorrelating all windows.
+#
+# With block_edges (or --blocks), each window is read once and the PMF of every
+# time block is computed in one pass, each MBAR solve warm-started from the
+# previous block's free energies. All profiles are written to one file
+# (--outfile) in blocks separated by blank lines, for plot-mbar.py.
+
 
 import os
-import re
+import sys
+import json
+import time
+import hashlib
+import multiprocessing
 import numpy # numerical array library
 import pymbar # multistate Bennett acceptance ratio
 from pymbar import timeseries # timeseries analysis
 import matplotlib.pyplot as plt
 
-# =========== VARIABLES ============================
-
-### Parameters from US simulations
-
-K = 53          # number of windows
-z_min = -8.0  # min independent variable
-z_max = +44.0 # max independent variable
-temp = 308.     # temperature 
-
-nbins = 180     # number of bins for PMF (like nbins of histogram, more = finer data)
-N_max = 52001   # maximum number of snapshots/simulation
-#tstart = 0      # int start time (ns) for each window (assuming step*2/1e6 = time)
-#tstop = 26     # int stop time (ns) for each window
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+import colvars_traj # shared colvars .traj reader in US/
+import autocorr # FFT statistical inefficiency in US/
+import histogram # streaming histograms in US/
 
-os.chdir('/tw/limvt/04_mbar/')
-
-### specify tstart and tstop to read 
-portion = True
-if portion:
-    tstarts = numpy.ones(K,float)*39
-    tstops = numpy.ones(K,float)*52
+# =========== VARIABLES ============================
 
-    for i in range(30,45,1):
-        tstarts[i] = 13
-        tstops[i] = 26
-    tstarts[5] = 52
-    tstarts[48] = 52
-    tstops[5] = 104
-    tstops[48] = 104
+### Default configuration.
+DEFAULTS = {
+    'workdir': None,
+    'temperature': 308.,
+    'z_min': -8.0,
+    'z_max': +44.0,
+    'nbins': 180,
+    'windows': None,
+    'centers_file': None,
+    'traj_pattern': None,
+    'num_windows': None,
+    'tstart': 0,
+    'tstop': None,
+    'overrides': [],
+    'flatten': True,
+    'chunk': None,
+    'nproc': 1,
+    'ineff': 'fft',
+    'cache_dir': 'mbar_cache',
+    'block_edges': None,
+    'block_mode': 'sliding',
+}
 
 ### Constants.
 kB = 1.381e-23 * 6.022e23 / 1000.0 # Boltzmann constant in kJ/mol/K
-beta = 1.0 / (kB * temp) # inverse temperature of simulations (in 1/(kJ/mol))
 
 
 # =========== FUNCTIONS ============================
@@ -60,7 +100,7 @@ def parseWindow(filename, tstart=0, tstop=None):
     Parameters
     ----------
     filename: string name of the file to process.
-       For *.traj file, assumes all lines are data (e.g. no comment lines).
+       Comment lines starting with '#' or '@' are skipped.
     tstart: integer nanosecond start time
     tstop: integer nanosecond stop time 
 
@@ -71,66 +111,276 @@ def parseWindow(filename, tstart=0, tstop=None):
 
     """
 
-    # Read file.
-    infile = open(filename, 'r')
-    lines = infile.readlines()
-    infile.close()
-
-    # Convert from time (ns) to step number.
-    tstart = tstart/2*1000.
+    # Convert from time (ns) to frame number.
+    start = colvars_traj.time_to_frame(tstart)
+    stop = None
     if tstop != None:
-        tstop = tstop/2*1000.+1
-    else:
-        tstop = len(lines)
-
-    n = 0
-    winZ = numpy.zeros([len(lines)])
-    for line in lines:
-        if n<tstart: 
-            n += 1
-            continue
-        if n>=tstop: 
-            n += 1
-            break
-        if line[0] != '#' and line[0] != '@':
-            tokens = line.split()
-            winZ[n] = float(tokens[1]) # transmemb position
-            n += 1
-    counts = min(tstop-tstart, len(lines))
-    winZ = winZ[tstart:tstop]
+        stop = colvars_traj.time_to_frame(tstop)+1
+
+    # Read only the frames in the time slice; column 1 is transmemb position.
+    winZ = colvars_traj.read_traj(filename, columns=1, start=start, stop=stop)
+    counts = len(winZ)
     return counts, winZ
 
 
 
-def prepWindow(filename, tstart=0, tstop=None):
+def decorrelate(z, method='fft'):
+    """
+    Compute the statistical inefficiency of a timeseries and subsample it.
+
+    Parameters
+    ----------
+    z: numpy array of the timeseries
+    method: string 'fft' to compute correlation times with autocorr.py,
+       or 'pymbar' to use pymbar.timeseries
+
+    Returns
+    -------
+    z_sub: numpy array of effectively uncorrelated samples of z
+    g: float statistical inefficiency of the timeseries
+
+    """
+    if method == 'fft':
+        g = autocorr.statistical_inefficiency(z)
+        indices = autocorr.subsample_indices(len(z), g)
+    else:
+        g = timeseries.statisticalInefficiency(z)
+        indices = timeseries.subsampleCorrelatedData(z, g) 
+    return z[indices], g
+
+
+def prepWindow(filename, tstart=0, tstop=None, method='fft'):
     """
     Read window .traj file, compute correlation times, subsample data.
 
     Parameters
     ----------
     filename: string name of the file to process.
-       For *.traj file, assumes all lines are data (e.g. no comment lines).
+       Comment lines starting with '#' or '@' are skipped.
     tstart: integer nanosecond start time
     tstop: integer nanosecond stop time
+    method: string method for correlation times, see decorrelate
 
     Returns
     -------
     counts: int, number of entries for this particular window
     winZ: numpy list containing SUBSAMPLED data for this window from tstart to tstop
+    g: float statistical inefficiency of the window's timeseries
 
     """
     # Parse data.
     n, z_sub = parseWindow(filename, tstart, tstop)
 
-    # Compute correlation times for z (actual spring center position) timeseries.
-    g = timeseries.statisticalInefficiency(z_sub)
-    print "Correlation time for %s is %10.3f" % (re.split('\W+',filename)[1],g)
-    indices = timeseries.subsampleCorrelatedData(z_sub, g) 
+    # Compute correlation times for z (actual spring center position) timeseries,
+    # and subsample data.
+    z_sub, g = decorrelate(z_sub, method)
+    return len(z_sub), z_sub, g
+
+
+def prepWindowBlocks(filename, blocks, method='fft'):
+    """
+    Read window .traj file once, then decorrelate each time block of it.
+
+    Parameters
+    ----------
+    filename: string name of the file to process
+    blocks: list of (tstart, tstop) nanosecond time blocks
+    method: string method for correlation times, see decorrelate
+
+    Returns
+    -------
+    subs: list of (counts, winZ, g) tuples as from prepWindow, one per block
+
+    """
+    tmin = min(a for a, b in blocks)
+    tmax = max(b for a, b in blocks)
+    offset = colvars_traj.time_to_frame(tmin)
+    n, winZ = parseWindow(filename, tmin, tmax)
+
+    subs = []
+    for tstart, tstop in blocks:
+        start = colvars_traj.time_to_frame(tstart) - offset
+        stop = colvars_traj.time_to_frame(tstop) + 1 - offset
+        z_sub, g = decorrelate(winZ[start:stop], method)
+        subs.append((len(z_sub), z_sub, g))
+    return subs
+
+
+def _timed(job):
+    """Run a (function, args) job and append its wall time to the result."""
+    t0 = time.time()
+    func, args = job
+    return func(*args), time.time()-t0
+
+
+def _mapWindows(func, jobs, nproc=1):
+    """
+    Run func on each tuple of arguments in jobs, optionally in a pool of
+    processes. Returns a list of (result, wall time) in the order of jobs.
+    """
+    jobs = [(func, args) for args in jobs]
+    if nproc == 1:
+        return [_timed(job) for job in jobs]
+    pool = multiprocessing.Pool(nproc)
+    try:
+        # map returns results in input order regardless of finish order
+        return pool.map(_timed, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def prepWindows(filenames, tstarts, tstops, nproc=1, method='fft'):
+    """
+    Read and decorrelate all windows, optionally in a pool of processes.
+    Prints the correlation time and wall time of each window in order.
+
+    Parameters
+    ----------
+    filenames: list of string names of the .traj files, one per window
+    tstarts: list of integer nanosecond start times, one per window
+    tstops: list of integer nanosecond stop times, one per window
+    nproc: int number of worker processes. 1 runs serially in this
+       process; None uses all available cores.
+    method: string method for correlation times, see decorrelate
+
+    Returns
+    -------
+    results: list of (counts, winZ) tuples from prepWindow, in the same
+       order as filenames
+
+    """
+    jobs = [(f, a, b, method) for f, a, b in zip(filenames, tstarts, tstops)]
+    t0 = time.time()
+    timed = _mapWindows(prepWindow, jobs, nproc)
+
+    results = []
+    for filename, ((n, z_sub, g), dt) in zip(filenames, timed):
+        print("Correlation time for %s is %10.3f (%d samples, %.2f s)" % (os.path.basename(filename), g, n, dt))
+        results.append((n, z_sub))
+    print("Read and decorrelated %d windows in %.2f s" % (len(jobs), time.time()-t0))
+    return results
+
+
+def binData(z_kn, N_k, z_min, delta):
+    """
+    Assign every snapshot of every window to a histogram bin at once.
+
+    Parameters
+    ----------
+    z_kn: numpy array of shape [K,N_max], z_kn[k,n] is the position of
+       snapshot n from umbrella simulation k. May also be a flattened
+       array of shape [sum(N_k)] if N_k is None.
+    N_k: numpy array of shape [K], number of snapshots in each window,
+       or None if z_kn is flattened (no padding)
+    z_min: float lower edge of the first bin
+    delta: float width of each bin
+
+    Returns
+    -------
+    bin_kn: numpy int array of same shape as z_kn, bin index of each snapshot.
+       Entries past N_k[k] (padding) are left as zero.
+
+    """
+    # int() truncates toward zero, as does astype
+    bin_kn = ((z_kn - z_min) / delta).astype(numpy.int32)
+    if N_k is not None:
+        bin_kn[numpy.arange(z_kn.shape[1]) >= N_k[:,numpy.newaxis]] = 0
+    return bin_kn
+
+
+def reducedPotentials(z_kn, u_kn, N_k, z0_k, K_k, beta_k, chunk=None):
+    """
+    Evaluate the reduced potential of every snapshot in every umbrella
+    using whole-array operations.
+
+    Parameters
+    ----------
+    z_kn: numpy array of shape [K,N_max] of snapshot positions (Angs)
+    u_kn: numpy array of shape [K,N_max] of unbiased reduced potentials
+    N_k: numpy array of shape [K], number of snapshots in each window
+    z0_k: numpy array of shape [K], spring centers (Angs)
+    K_k: numpy array of shape [K], spring constants (kJ/mol/Angs**2)
+    beta_k: numpy array of shape [K], inverse temperatures (1/(kJ/mol))
+    chunk: int number of snapshots to evaluate per block. Peak temporary
+       memory is K*K*chunk floats. Default of None evaluates all at once.
+
+    Returns
+    -------
+    u_kln: numpy array of shape [K,K,N_max], u_kln[k,l,n] is the reduced
+       potential of snapshot n from umbrella k evaluated at umbrella l.
+       Entries past N_k[k] (padding) are left as zero.
 
-    # Subsample data.
-    zsublen = len(indices)
-    z_sub = z_sub[indices]
-    return zsublen, z_sub
+    """
+    K, N_max = z_kn.shape
+    if chunk is None:
+        chunk = N_max
+    u_kln = numpy.zeros([K,K,N_max], numpy.float64)
+
+    # beta_k[k] * (K_k[l]/2.0) for each pair of sampled/evaluated umbrella
+    force_kl = beta_k[:,numpy.newaxis] * (K_k/2.0)[numpy.newaxis,:]
+    valid_kn = numpy.arange(N_max) < N_k[:,numpy.newaxis]
+
+    for start in range(0, N_max, chunk):
+        stop = min(start+chunk, N_max)
+
+        # deviation from each umbrella center, shape [K,K,stop-start]
+        dz = z_kn[:,numpy.newaxis,start:stop] - z0_k[numpy.newaxis,:,numpy.newaxis]
+        dz **= 2
+        dz *= force_kl[:,:,numpy.newaxis]
+        dz += u_kn[:,numpy.newaxis,start:stop]
+        dz *= valid_kn[:,numpy.newaxis,start:stop]
+        u_kln[:,:,start:stop] = dz
+
+    return u_kln
+
+
+def reducedPotentialsFlat(z_n, u_n, N_k, z0_k, K_k, beta_k, chunk=None):
+    """
+    Evaluate the reduced potential of every retained sample in every
+    umbrella, with samples from all windows concatenated (no padding).
+    This is the u_kn layout accepted by pymbar 3, and its memory scales
+    with sum(N_k) instead of K*N_max.
+
+    Parameters
+    ----------
+    z_n: numpy array of shape [sum(N_k)] of positions (Angs), ordered by
+       window so that the first N_k[0] came from umbrella 0, etc.
+    u_n: numpy array of shape [sum(N_k)] of unbiased reduced potentials
+    N_k: numpy array of shape [K], number of samples from each window
+    z0_k: numpy array of shape [K], spring centers (Angs)
+    K_k: numpy array of shape [K], spring constants (kJ/mol/Angs**2)
+    beta_k: numpy array of shape [K], inverse temperatures (1/(kJ/mol))
+    chunk: int number of samples to evaluate per block. Peak temporary
+       memory is K*chunk floats. Default of None evaluates all at once.
+
+    Returns
+    -------
+    u_ln: numpy array of shape [K,sum(N_k)], u_ln[l,n] is the reduced
+       potential of sample n evaluated at umbrella l
+
+    """
+    K = len(z0_k)
+    N = len(z_n)
+    if chunk is None:
+        chunk = N
+    u_ln = numpy.zeros([K,N], numpy.float64)
+
+    # inverse temperature of the window each sample was drawn from
+    beta_n = numpy.repeat(beta_k, N_k)
+
+    for start in range(0, N, chunk):
+        stop = min(start+chunk, N)
+
+        # deviation from each umbrella center, shape [K,stop-start]
+        dz = z_n[numpy.newaxis,start:stop] - z0_k[:,numpy.newaxis]
+        dz **= 2
+        dz *= (K_k/2.0)[:,numpy.newaxis]
+        dz *= beta_n[numpy.newaxis,start:stop]
+        dz += u_n[numpy.newaxis,start:stop]
+        u_ln[:,start:stop] = dz
+
+    return u_ln
 
 
 def plotPMF(xdata, ydata, devs, xlabel, ylabel, title, save=False, figname='plot.png'):
@@ -152,117 +402,442 @@ def plotPMF(xdata, ydata, devs, xlabel, ylabel, title, save=False, figname='plot
     #ax1.plot(xdata, ydata)
     if save: plt.savefig(figname)
     plt.show()
-    
-# ==================================================
-# ==================================================
 
 
-### Allocate storage for simulation data
-T_k = numpy.ones(K,float)*temp # inital temperatures are all equal 
-N_k = numpy.zeros([K], numpy.int32) # N_k[k] is the number of snapshots from umbrella simulation k
-K_k = numpy.zeros([K], numpy.float64) # K_k[k] is the spring constant (in kJ/mol/Angs**2) for umbrella simulation k
-z0_k = numpy.zeros([K], numpy.float64) # z0_k[k] is the spring center location (in Angs) for umbrella simulation k
-z_kn = numpy.zeros([K,N_max], numpy.float64) # z_kn[k,n] is the transmembrane position (in Angs) for snapshot n from umbrella simulation k
-u_kn = numpy.zeros([K,N_max], numpy.float64) # u_kn[k,n] is the reduced potential energy without umbrella restraints of snapshot n of umbrella simulation k
+def loadConfig(filename):
+    """
+    Read a JSON configuration file and fill in defaults.
+
+    Parameters
+    ----------
+    filename: string name of the JSON configuration file
+
+    Returns
+    -------
+    config: dict of settings, where config['windows'] is a list with one
+       dict per window of 'file' (absolute path), 'center', 'spring',
+       'tstart', and 'tstop'
+
+    """
+    with open(filename, 'r') as f:
+        user = json.load(f)
+    unknown = set(user) - set(DEFAULTS)
+    if unknown:
+        raise ValueError("Unknown keys in %s: %s" % (filename, ", ".join(sorted(unknown))))
+
+    config = dict(DEFAULTS)
+    config.update(user)
+    if config['workdir'] is None:
+        config['workdir'] = os.path.dirname(os.path.abspath(filename))
+    config['windows'] = windowList(config)
+    return config
+
+
+def windowList(config):
+    """
+    Build the list of per-window settings from a configuration.
+    Precedence is: per-window entries > overrides > default tstart/tstop.
+    """
+    workdir = config['workdir'] or '.'
+    windows = config['windows']
+
+    # read US centers (column 1) and spring constants (col 2)
+    if windows is None:
+        centers = numpy.loadtxt(os.path.join(workdir, config['centers_file']), ndmin=2)
+        K = config['num_windows'] or len(centers)
+        windows = []
+        for k in range(K):
+            windows.append({'file': config['traj_pattern'] % k,
+                            'center': float(centers[k,0]), # spring center (Angs)
+                            'spring': float(centers[k,1])}) # spring constant (kJ/mol/Angs**2)
+
+    full = []
+    for k, win in enumerate(windows):
+        w = {'tstart': config['tstart'], 'tstop': config['tstop']}
+        for o in config['overrides']:
+            if k in o['windows']:
+                w.update((key, o[key]) for key in ('tstart', 'tstop') if key in o)
+        w.update(win)
+        w['file'] = os.path.join(workdir, w['file'])
+        full.append(w)
+    return full
+
+
+def _stageKey(*parts):
+    """Hash the inputs that a cached stage depends on."""
+    text = json.dumps(parts, sort_keys=True)
+    return hashlib.md5(text.encode('utf-8')).hexdigest()[:16]
+
+
+def _fileStamp(filename):
+    """Identify the current version of an input file."""
+    st = os.stat(filename)
+    return [os.path.abspath(filename), st.st_size, st.st_mtime]
+
+
+def _loadStage(cache_dir, stage, key):
+    """Load cached arrays of a stage as a dict, or None if not cached."""
+    if cache_dir is None:
+        return None
+    path = os.path.join(cache_dir, '%s-%s.npz' % (stage, key))
+    if not os.path.isfile(path):
+        return None
+    with numpy.load(path) as data:
+        return dict(data)
+
+
+def _saveStage(cache_dir, stage, key, arrays):
+    """Write arrays of a stage to the cache."""
+    if cache_dir is None:
+        return
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    path = os.path.join(cache_dir, '%s-%s.npz' % (stage, key))
+    tmp = '%s.%d.tmp.npz' % (path[:-4], os.getpid())
+    numpy.savez(tmp, **arrays)
+    os.rename(tmp, path)
+
+
+def _cachedStage(cache_dir, stage, key, compute):
+    """Return cached arrays of a stage, else compute and cache them."""
+    arrays = _loadStage(cache_dir, stage, key)
+    if arrays is None:
+        arrays = compute()
+        _saveStage(cache_dir, stage, key, arrays)
+    else:
+        print("Using cached %s (%s)" % (stage, key))
+    return arrays
 
-### beta factor for all temps. (See referenced code for diff. temp windows.)
-beta_k = 1.0/(kB*T_k)
 
-### Read in file containing US centers (column 1) and spring constants and (col 2). 
-### Units of centers being Angstrom, spring constant as kJ/mol/Angs**2 (convert from kcal/mol).
-infile = open('data/centers.dat', 'r')
-lines = infile.readlines()
-infile.close()
-for k in range(K):
-    # Parse line k.
-    line = lines[k]
-    tokens = line.split()
-    z0_k[k] = float(tokens[0]) # spring center (Angs)
-    K_k[k] = float(tokens[1]) # spring constant (kJ/mol/Angs**2)    
+def _umbrellas(windows, temperature):
+    """
+    Get the spring centers, spring constants, and inverse temperatures
+    of the umbrella windows as arrays.
+    """
+    K = len(windows)
+    T_k = numpy.ones(K,float)*temperature # inital temperatures are all equal 
+    K_k = numpy.array([w['spring'] for w in windows], numpy.float64) # K_k[k] is the spring constant (in kJ/mol/Angs**2) for umbrella simulation k
+    z0_k = numpy.array([w['center'] for w in windows], numpy.float64) # z0_k[k] is the spring center location (in Angs) for umbrella simulation k
 
+    ### beta factor for all temps. (See referenced code for diff. temp windows.)
+    beta_k = 1.0/(kB*T_k)
+    return z0_k, K_k, beta_k
 
-### Read/process simulation data for each window.
-for k in range(K):
 
-    # Get window number (e.g. 09)
-    if k < 10: kk = '0'+str(k)
-    else: kk = str(k)
+def _bins(z_min, z_max, nbins):
+    """Get the bin width and bin centers of the PMF."""
+    # Construct torsion bins
+    delta = (z_max - z_min) / float(nbins)
 
-    filename = 'data/win%s.traj' % kk
-#    filename = 'data/26ns/win%d.traj' % k
+    # compute bin centers
+    bin_center_i = z_min + delta/2 + delta * numpy.arange(nbins)
+    return delta, bin_center_i
 
-    n, winZ = prepWindow(filename, tstarts[k], tstops[k])
 
-    z_kn[k][0:len(winZ)] = winZ
-    N_k[k] = n
+def binCounts(z_n, N_k, z_min, z_max, nbins):
+    """
+    Count the samples of each window in each PMF bin, one window at a time,
+    and warn about bins without samples.
 
+    Parameters
+    ----------
+    z_n: numpy array of shape [sum(N_k)] of positions (Angs), ordered by window
+    N_k: numpy array of shape [K], number of samples from each window
+    z_min, z_max, nbins: range and number of PMF bins
 
-### Shorten list of counts per window (N) and the US center (z). Create list for PEs.
-N_max = numpy.max(N_k) # shorten the array size
-u_kln = numpy.zeros([K,K,N_max], numpy.float64) # u_kln[k,l,n] is the reduced potential energy of snapshot n from umbrella simulation k evaluated at umbrella l
+    Returns
+    -------
+    counts_ki: numpy int array of shape [K, nbins] of counts of each window
 
-### Set zero of u_kn -- this is arbitrary.
-### At this point, is still zero since orig script only defined for DiffTemp = True ?
-u_kn -= u_kn.min()
+    """
+    hist = histogram.HistogramAccumulator.uniform(z_min, z_max, nbins, len(N_k))
+    start = 0
+    for k, n in enumerate(N_k):
+        hist.update(z_n[start:start+n], k)
+        start += n
+    empty = numpy.flatnonzero(hist.counts.sum(axis=0) == 0)
+    if len(empty):
+        print("WARNING: no samples in %d of %d bins, e.g. at z = %.3f Angs" % (len(empty),
+              nbins, hist.centers[empty[0]]))
+    return hist.counts
+
+
+def runPipeline(config):
+    """
+    Compute the PMF from US windows with MBAR.
 
+    Parameters
+    ----------
+    config: dict of settings as returned by loadConfig
 
-### Bin the data.
-print "Binning data..."
+    Returns
+    -------
+    results: dict with the following numpy arrays
+       bin_center_i: bin centers (Angs)
+       f_i: PMF in each bin (kT)
+       df_i: uncertainty of PMF in each bin (kT)
+       f_k: dimensionless free energies of the umbrella states
+       N_k: number of uncorrelated samples from each window
+       counts_ki: number of uncorrelated samples from each window in each bin
+
+    """
+    windows = config['windows']
+    K = len(windows)
+    cache_dir = config['cache_dir']
+    if cache_dir is not None:
+        cache_dir = os.path.join(config['workdir'] or '.', cache_dir)
+    z_min = config['z_min']
+    z_max = config['z_max']
+    nbins = config['nbins']
+
+    z0_k, K_k, beta_k = _umbrellas(windows, config['temperature'])
+
+    ### Read/process simulation data for each window.
+    key_sub = _stageKey([(_fileStamp(w['file']), w['tstart'], w['tstop']) for w in windows],
+                        config['ineff'])
+    def subsample():
+        results = prepWindows([w['file'] for w in windows],
+                              [w['tstart'] for w in windows],
+                              [w['tstop'] for w in windows],
+                              config['nproc'], config['ineff'])
+        return {'N_k': numpy.array([n for n, winZ in results], numpy.int32),
+                'z_n': numpy.concatenate([winZ for n, winZ in results])}
+    sub = _cachedStage(cache_dir, 'subsample', key_sub, subsample)
+    N_k = sub['N_k'] # N_k[k] is the number of snapshots from umbrella simulation k
+    z_n = sub['z_n'] # z_n[n] is the transmembrane position (in Angs) of sample n, all windows concatenated
+
+    ### Bin the data.
+    print("Binning data...")
+
+    delta, bin_center_i = _bins(z_min, z_max, nbins)
+
+    # Compute bin assignment.
+    key_bin = _stageKey(key_sub, z_min, z_max, nbins)
+    bin_n = _cachedStage(cache_dir, 'bins', key_bin,
+        lambda: {'bin_n': binData(z_n, None, z_min, delta)})['bin_n']
+    counts_ki = binCounts(z_n, N_k, z_min, z_max, nbins)
+
+    u_n = numpy.zeros(len(z_n), numpy.float64) # u_n[n] is the reduced potential energy without umbrella restraints of sample n
+
+    ### Set zero of u_n -- this is arbitrary.
+    ### At this point, is still zero since orig script only defined for DiffTemp = True ?
+    u_n -= u_n.min()
+
+    key_u = _stageKey(key_sub, z0_k.tolist(), K_k.tolist(), beta_k.tolist(), config['flatten'])
+    if config['flatten']:
+        ### Evaluate reduced energies in all umbrellas, no padding to N_max.
+        print("Evaluating reduced potential energies...")
+        u_ln = _cachedStage(cache_dir, 'ukn', key_u,
+            lambda: {'u_ln': reducedPotentialsFlat(z_n, u_n, N_k, z0_k, K_k, beta_k, config['chunk'])})['u_ln']
+        mbar_u, pmf_u, pmf_bin = u_ln, u_n, bin_n
+
+    else:
+        ### Pad windows to the longest subsampled window.
+        N_max = numpy.max(N_k)
+        z_kn = numpy.zeros([K,N_max], numpy.float64) # z_kn[k,n] is the transmembrane position (in Angs) for snapshot n from umbrella simulation k
+        u_kn = numpy.zeros([K,N_max], numpy.float64) # u_kn[k,n] is the reduced potential energy without umbrella restraints of snapshot n of umbrella simulation k
+        bin_kn = numpy.zeros([K,N_max], numpy.int32)
+        start = 0
+        for k in range(K):
+            z_kn[k,0:N_k[k]] = z_n[start:start+N_k[k]]
+            bin_kn[k,0:N_k[k]] = bin_n[start:start+N_k[k]]
+            start += N_k[k]
+
+        ### Evaluate reduced energies in all umbrellas
+        print("Evaluating reduced potential energies...")
+        u_kln = reducedPotentials(z_kn, u_kn, N_k, z0_k, K_k, beta_k, config['chunk'])
+        mbar_u, pmf_u, pmf_bin = u_kln, u_kn, bin_kn
+
+    ### Initialize MBAR (pymbar 3.x API, see top of file),
+    ### warm-started from cached free energies of the same states if any.
+    print("Running MBAR...")
+    cached = _loadStage(cache_dir, 'mbar', key_u)
+    f_k = None if cached is None else cached['f_k']
+    mbar = pymbar.MBAR(mbar_u, N_k, verbose = True, method = 'adaptive', initial_f_k = f_k)
+    _saveStage(cache_dir, 'mbar', key_u, {'f_k': mbar.f_k})
+
+    ### Compute PMF in unbiased potential (in units of kT).
+    (f_i, df_i) = mbar.computePMF(pmf_u, pmf_bin, nbins)
+
+    return {'bin_center_i': bin_center_i, 'f_i': f_i, 'df_i': df_i,
+            'f_k': mbar.f_k, 'N_k': N_k, 'counts_ki': counts_ki}
+
+
+def writePMF(bin_center_i, f_i, df_i):
+    """
+    Print the PMF in units of (Angs, kT), then in units of (nm, kcal/mol).
+    """
+    nbins = len(bin_center_i)
+
+    ### Write out PMF.
+    print("\n\nPMF (in units of Angs, kT)")
+    print("%8s %8s %8s" % ('bin', 'f', 'df'))
+    for i in range(nbins):
+        print("%8.6f %8.6f %8.6f" % (bin_center_i[i], f_i[i], df_i[i]))
+
+    ### Convert units: x (A --> nm), y (kT --> kcal/mol).
+    xs = [item/10 for item in bin_center_i]
+    ys = [item*0.6120 for item in f_i]
+    ss = [item*0.6120 for item in df_i]
+
+
+    ### Write out PMF with converted units.
+    print("\n\nPMF (in units of nm, kcal/mol)")
+    print("%8s %8s" % ('bin', 'f'))
+    for i in range(nbins):
+        print("%8.6f %8.6f %8.6f" % (xs[i], ys[i], ss[i]))
+    return xs, ys, ss
+
+
+def timeBlocks(edges, mode='sliding'):
+    """
+    List the time blocks of a convergence series.
+
+    Parameters
+    ----------
+    edges: list of increasing times (ns), e.g. [0, 13, 26, 39, 52, 104]
+    mode: string 'sliding' for blocks between successive edges
+       (0-13, 13-26, ...) or 'cumulative' for blocks that all start at
+       the first edge (0-13, 0-26, ...)
+
+    Returns
+    -------
+    blocks: list of (tstart, tstop) tuples
+
+    """
+    if mode == 'sliding':
+        return list(zip(edges[:-1], edges[1:]))
+    elif mode == 'cumulative':
+        return [(edges[0], t) for t in edges[1:]]
+    raise ValueError("Unknown block mode '%s'" % mode)
+
+
+def runBlocks(config, blocks):
+    """
+    Compute the PMF of each time block with MBAR, reading each window once.
+    Each MBAR solve is warm-started from the previous block's free energies.
+    Per-window tstart/tstop settings are not used.
+
+    Parameters
+    ----------
+    config: dict of settings as returned by loadConfig
+    blocks: list of (tstart, tstop) nanosecond time blocks, e.g. from timeBlocks
+
+    Returns
+    -------
+    results: list of dicts as returned by runPipeline, one per block,
+       each with additional keys tstart and tstop
+
+    """
+    windows = config['windows']
+    nbins = config['nbins']
+    z0_k, K_k, beta_k = _umbrellas(windows, config['temperature'])
+    delta, bin_center_i = _bins(config['z_min'], config['z_max'], nbins)
+
+    ### Read/process simulation data for each window, all blocks at once.
+    t0 = time.time()
+    jobs = [(w['file'], blocks, config['ineff']) for w in windows]
+    timed = _mapWindows(prepWindowBlocks, jobs, config['nproc'])
+    for w, (subs, dt) in zip(windows, timed):
+        print("Correlation times for %s are %s (%.2f s)" % (os.path.basename(w['file']),
+              ' '.join(["%.3f" % g for n, z_sub, g in subs]), dt))
+    print("Read and decorrelated %d windows in %.2f s" % (len(windows), time.time()-t0))
+
+    results = []
+    f_k = None
+    for b, (tstart, tstop) in enumerate(blocks):
+        N_k = numpy.array([subs[b][0] for subs, dt in timed], numpy.int32)
+        z_n = numpy.concatenate([subs[b][1] for subs, dt in timed])
+        u_n = numpy.zeros(len(z_n), numpy.float64)
+
+        bin_n = binData(z_n, None, config['z_min'], delta)
+        counts_ki = binCounts(z_n, N_k, config['z_min'], config['z_max'], nbins)
+        u_ln = reducedPotentialsFlat(z_n, u_n, N_k, z0_k, K_k, beta_k, config['chunk'])
+
+        print("Running MBAR for %g-%g ns..." % (tstart, tstop))
+        mbar = pymbar.MBAR(u_ln, N_k, verbose = True, method = 'adaptive', initial_f_k = f_k)
+        f_k = mbar.f_k
+        (f_i, df_i) = mbar.computePMF(u_n, bin_n, nbins)
+
+        results.append({'bin_center_i': bin_center_i, 'f_i': f_i, 'df_i': df_i,
+                        'f_k': mbar.f_k, 'N_k': N_k, 'counts_ki': counts_ki,
+                        'tstart': tstart, 'tstop': tstop})
+    return results
+
+
+def writeBlocks(results, outfile):
+    """
+    Write the PMFs of all time blocks to one file in units of (nm, kcal/mol).
+    Each block starts with a '# tstart-tstop ns' line and blocks are separated
+    by a blank line.
+    """
+    with open(outfile, 'w') as f:
+        f.write("# MBAR PMF of time blocks; columns: bin (nm), f (kcal/mol), df (kcal/mol)\n")
+        for r in results:
+            f.write("\n# %g-%g ns\n" % (r['tstart'], r['tstop']))
+            for x, y, dy in zip(r['bin_center_i'], r['f_i'], r['df_i']):
+                f.write("%8.6f %8.6f %8.6f\n" % (x/10, y*0.6120, dy*0.6120))
+
+
+# ==================================================
+# ==================================================
 
-# Construct torsion bins
-delta = (z_max - z_min) / float(nbins)
 
-# compute bin centers
-bin_center_i = numpy.zeros([nbins], numpy.float64)
-for i in range(nbins):
-    bin_center_i[i] = z_min + delta/2 + delta * i
+if __name__ == "__main__":
 
-# Compute bin assignment.
-bin_kn = numpy.zeros([K,N_max], numpy.int32)
-for k in range(K):
-    for n in range(N_k[k]):
-        bin_kn[k,n] = int((z_kn[k,n] - z_min) / delta)
+    import argparse
+    parser = argparse.ArgumentParser()
 
-### Evaluate reduced energies in all umbrellas
-print "Evaluating reduced potential energies..."
-for k in range(K):
-    for n in range(N_k[k]):
-        # Compute deviation from umbrella center
-        dz = z_kn[k,n] - z0_k
+    parser.add_argument("-c", "--config", required=True,
+                        help="JSON configuration file listing windows, centers, "
+                             "spring constants, time slices, and binning.")
 
-        # Compute energy of snapshot n from simulation k in umbrella potential
-        u_kln[k,:,n] = u_kn[k,n] + beta_k[k] * (K_k/2.0) * dz**2
+    parser.add_argument("-b", "--nbins", type=int,
+                        help="Number of PMF bins. Overrides value in config file.")
 
-### Initialize MBAR.
-print "Running MBAR..."
-mbar = pymbar.MBAR(u_kln, N_k, verbose = True, method = 'adaptive')
+    parser.add_argument("-n", "--nproc", type=int,
+                        help="Number of processes for reading windows. "
+                             "Overrides value in config file.")
 
-### Compute PMF in unbiased potential (in units of kT).
-(f_i, df_i) = mbar.computePMF(u_kn, bin_kn, nbins)
+    parser.add_argument("-t", "--blocks", type=float, nargs='+',
+                        help="Times (ns) bounding time blocks, e.g. 0 13 26 39 52 104. "
+                             "Computes the PMF of every block in one pass. "
+                             "Overrides block_edges in config file.")
 
+    parser.add_argument("--cumulative", action="store_true", default=False,
+                        help="Use cumulative blocks (0-13, 0-26, ...) instead of "
+                             "successive ones (0-13, 13-26, ...).")
 
-### Write out PMF.
-print "\n\nPMF (in units of Angs, kT)"
-print "%8s %8s %8s" % ('bin', 'f', 'df')
-for i in range(nbins):
-    print "%8.6f %8.6f %8.6f" % (bin_center_i[i], f_i[i], df_i[i])
+    parser.add_argument("-o", "--outfile", default="mbar_blocks.dat",
+                        help="Output file for PMFs of all time blocks.")
 
-### Convert units: x (A --> nm), y (kT --> kcal/mol).
-xs = [item/10 for item in bin_center_i]
-ys = [item*0.6120 for item in f_i]
-ss = [item*0.6120 for item in df_i]
+    parser.add_argument("--nocache", action="store_true", default=False,
+                        help="Do not read or write cached intermediate results.")
 
+    args = parser.parse_args()
+    config = loadConfig(args.config)
+    if args.nbins is not None:
+        config['nbins'] = args.nbins
+    if args.nproc is not None:
+        config['nproc'] = args.nproc
+    if args.nocache:
+        config['cache_dir'] = None
+    if args.blocks is not None:
+        config['block_edges'] = args.blocks
+    if args.cumulative:
+        config['block_mode'] = 'cumulative'
 
-### Write out PMF with converted units.
-print "\n\nPMF (in units of nm, kcal/mol)"
-print "%8s %8s" % ('bin', 'f')
-for i in range(nbins):
-    print "%8.6f %8.6f %8.6f" % (xs[i], ys[i], ss[i])
+    if config['block_edges'] is not None:
+        blocks = timeBlocks(config['block_edges'], config['block_mode'])
+        writeBlocks(runBlocks(config, blocks), args.outfile)
+        sys.exit()
 
+    results = runPipeline(config)
+    xs, ys, ss = writePMF(results['bin_center_i'], results['f_i'], results['df_i'])
 
-### Plot the PMF.
-xlabel = 'z coordinate (nm)'
-ylabel = 'free energy (kcal/mol)'
-title = 'Potential of Mean Force of Water\nthrough POPC bilayer (0-52* ns)'
-#plotPMF(xs, ys, ss, xlabel, ylabel, title, save=True, figname='0-52ns.eps')
 
+    ### Plot the PMF.
+    xlabel = 'z coordinate (nm)'
+    ylabel = 'free energy (kcal/mol)'
+    title = 'Potential of Mean Force of Water\nthrough POPC bilayer (0-52* ns)'
+    #plotPMF(xs, ys, ss, xlabel, ylabel, title, save=True, figname='0-52ns.eps')
@@ -13,6 +13,7 @@ from matplotlib.ticker import AutoMinorLocator
 nbins=180  # should match the nbins value from the MBAR script
 dataf=['pmf-2c_0-13.out','pmf-2d_13-26.out','pmf-2e_26-39.out','pmf-2f_39-52.out','pmf-2g_52-104.out']
 dataf=['pmf-2b-104ns.out']
+blockf = None # e.g. 'mbar_blocks.dat' from mbar.py --blocks; if set, used instead of dataf
 figname = 'plot-2b-withErr.png'
 plotErr = True
 os.chdir('/tw/limvt/04_mbar')
@@ -22,6 +23,26 @@ origys = []
 stdevs = []
 writeX = True # only write Xs for one file (all should be same)
 
+if blockf is not None:
+    ### read all time blocks from one file; each starts with a '# tstart-tstop ns' line
+    lbls = []
+    for line in open(blockf, 'r'):
+        fields = line.split()
+        if not fields:
+            continue
+        if line[0] == '#':
+            if fields[-1] == 'ns':
+                lbls.append(fields[1]+' ns')
+                origys.append([])
+                stdevs.append([])
+                writeX = (len(origys) == 1)
+            continue
+        if writeX:
+            origxs.append(float(fields[0]))
+        origys[-1].append(float(fields[1]))
+        stdevs[-1].append(float(fields[2]))
+    dataf = []
+
 for i, f in enumerate(dataf):
     origys.append([])
     stdevs.append([])
@@ -72,7 +93,8 @@ else:
         ax1.plot(origxs, y, color=color)
 
 ### get legend labels
-lbls = []
+if blockf is None:
+    lbls = []
 for f in dataf:
 #    lbls.append(f.split('.')[0])
     lbls.append(re.split('_|\.', f)[1]+' ns')
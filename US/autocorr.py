@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+"""
+Purpose:    Autocorrelation functions and statistical inefficiencies of
+            timeseries computed by FFT in O(N log N), for one series or
+            for many equal-length series (e.g. all US windows) at once.
+
+            statistical_inefficiency follows the estimator of
+            pymbar.timeseries.statisticalInefficiency (fast=False):
+                g = 1 + 2 sum_{t=1} (1 - t/N) C(t)
+            where C(t) is the normalized autocorrelation function, and the
+            sum stops at the first C(t) <= 0 after mintime lags.
+
+References:
+ 1. Chodera et al., J. Chem. Theory Comput. 3, 26 (2007).  10.1021/ct0502864
+ 2. https://github.com/choderalab/pymbar/blob/master/pymbar/timeseries.py
+
+Example:    import autocorr
+            g = autocorr.statistical_inefficiency(z)        # z.shape = (N,)
+            g_k = autocorr.statistical_inefficiency(z_kn)   # z_kn.shape = (K, N)
+            z_sub = z[autocorr.subsample_indices(len(z), g)]
+
+"""
+
+import numpy as np
+
+
+def _by_length(series, func):
+    """
+    Apply a batched function to a list of series that may differ in length,
+    calling it once per group of equal-length series. Returns a list.
+    """
+    lengths = [len(s) for s in series]
+    results = [None]*len(series)
+    for n in set(lengths):
+        idx = [i for i, m in enumerate(lengths) if m == n]
+        batch = func(np.array([series[i] for i in idx], dtype=np.float64))
+        for i, r in zip(idx, batch):
+            results[i] = r
+    return results
+
+
+def acf(x, nlags=None, subtract_mean=True, unbiased=False, normalize=True):
+    """
+    Compute autocorrelation functions along the last axis by FFT.
+
+        C(t) = 1/M sum_{i=0}^{N-t-1} dx(i) * dx(i+t)
+
+    where M = N for the biased estimate or M = N-t for the unbiased one.
+
+    Parameters
+    ----------
+    x: numpy array of shape [..., N] of one or more timeseries
+    nlags: int number of lag times (0 to nlags-1) to return; default N
+    subtract_mean: bool, whether dx is the deviation from each series' mean
+    unbiased: bool, whether to divide each lag by its number of terms N-t
+       instead of by N
+    normalize: bool, whether to divide by C(0) so that C(0) = 1
+
+    Returns
+    -------
+    c: numpy array of shape [..., nlags] of autocorrelation functions
+
+    """
+    x = np.asarray(x, dtype=np.float64)
+    N = x.shape[-1]
+    if nlags is None:
+        nlags = N
+    nlags = min(nlags, N)
+    if subtract_mean:
+        x = x - x.mean(axis=-1, keepdims=True)
+
+    # zero-pad to at least 2N-1 to avoid circular wrap-around
+    nfft = 1
+    while nfft < 2*N - 1:
+        nfft *= 2
+    f = np.fft.rfft(x, n=nfft, axis=-1)
+    c = np.fft.irfft(f * np.conj(f), n=nfft, axis=-1)[..., :nlags]
+
+    if unbiased:
+        c /= (N - np.arange(nlags))
+    else:
+        c /= N
+    if normalize:
+        c /= c[..., :1]
+    return c
+
+
+def statistical_inefficiency(x, mintime=3):
+    """
+    Compute the statistical inefficiency g = 1 + 2*tau of timeseries.
+
+    Parameters
+    ----------
+    x: numpy array of shape [N] for one series or [K, N] for K series,
+       or a list of 1-D series of different lengths
+    mintime: int minimum number of lags to sum before stopping at the
+       first non-positive autocorrelation
+
+    Returns
+    -------
+    g: float for a single series, else numpy array of shape [K]
+
+    """
+    if isinstance(x, (list, tuple)):
+        return np.array(_by_length(x, statistical_inefficiency))
+
+    x = np.asarray(x, dtype=np.float64)
+    single = (x.ndim == 1)
+    x = np.atleast_2d(x)
+    K, N = x.shape
+    if N < 3:
+        g = np.ones(K)
+        return g[0] if single else g
+
+    dx = x - x.mean(axis=-1, keepdims=True)
+    sigma2 = (dx*dx).mean(axis=-1)
+    if np.any(sigma2 == 0):
+        raise ValueError("Sample variance is zero -- cannot compute statistical inefficiency")
+
+    # normalized unbiased autocorrelation for lags t = 0 .. N-2
+    C = acf(dx, nlags=N-1, subtract_mean=False, unbiased=True, normalize=False)
+    C /= sigma2[:, np.newaxis]
+    t = np.arange(N-1)
+
+    # stop at first lag t > mintime with C(t) <= 0, else run to t = N-2
+    stop = (C <= 0) & (t > mintime)
+    stop[:, 0] = False
+    last = np.where(stop.any(axis=-1), stop.argmax(axis=-1), N-1)
+
+    terms = 2.0 * C * (1.0 - t/float(N))
+    terms[:, 0] = 0.0
+    g = 1.0 + np.cumsum(terms, axis=-1)[np.arange(K), last-1]
+    g = np.maximum(g, 1.0)
+    return g[0] if single else g
+
+
+def correlation_time(x, dt=1.0, mintime=3):
+    """
+    Compute the integrated correlation time tau = (g-1)/2 * dt.
+
+    Parameters
+    ----------
+    x: timeseries as for statistical_inefficiency
+    dt: float time interval between samples
+    mintime: see statistical_inefficiency
+
+    Returns
+    -------
+    tau: float or numpy array of correlation times in units of dt
+
+    """
+    g = statistical_inefficiency(x, mintime)
+    return 0.5*(g - 1.0)*dt
+
+
+def subsample_indices(N, g):
+    """
+    Get indices of effectively uncorrelated samples, spaced by g,
+    as in pymbar.timeseries.subsampleCorrelatedData.
+
+    Parameters
+    ----------
+    N: int length of the timeseries
+    g: float statistical inefficiency of the timeseries
+
+    Returns
+    -------
+    indices: numpy int array of indices to keep
+
+    """
+    n = np.arange(int(np.ceil(N/float(g))) + 1)
+    t = np.rint(n*g).astype(int)
+    return np.unique(t[t < N])
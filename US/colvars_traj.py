@@ -0,0 +1,590 @@
+#!/usr/bin/env python
+
+"""
+Purpose:    Read colvars trajectory (*.traj) files from NAMD US simulations.
+            Shared by the MBAR, WHAM, overlap, and diffusivity scripts.
+
+            Files are read in large binary blocks. Comment lines (starting
+            with '#' or '@', e.g. the header repeated after each restart)
+            are located and dropped with array operations, and only the
+            frames within the requested [start, stop) slice are parsed.
+            Reading stops as soon as the slice has been read.
+
+Cache:      By default, the first read of a file parses all of its frames
+            once and stores them in a binary cache (see traj_cache.py).
+            Later reads memory-map the cache and copy only the requested
+            slice. The cache is rebuilt whenever the .traj file changes.
+
+Index:      build_index records the byte offset of every INDEX_STRIDE-th frame
+            (also kept next to the binary cache). Uncached reads and copies
+            of a slice then seek close to its first frame instead of
+            scanning the file from the beginning.
+
+Slices:     write_slice writes a small JSON descriptor (*.slice) of a frame
+            slice of a .traj file, with the byte offset and number of its
+            frames, instead of a copy of its text. read_traj and iter_chunks
+            accept a .slice file in place of a .traj file.
+
+Frames:     Frame n is the n-th data (non-comment) line of the file.
+            By default, frame = time (ns) * 500, i.e. colvarsTrajFrequency of
+            1000 steps with a 2 fs time step (step*2/1e6 = time ns).
+
+Example:    import colvars_traj
+            z = colvars_traj.read_traj('win05.traj', columns=1,
+                    start=colvars_traj.time_to_frame(13),
+                    stop=colvars_traj.time_to_frame(26)+1)
+
+"""
+
+import os
+import json
+import numpy as np
+import traj_cache
+
+CHUNK_BYTES = 16*1024*1024  # bytes read from disk per block
+FRAMES_PER_NS = 500         # frames written per nanosecond of simulation
+INDEX_STRIDE = 1000         # frames between byte offsets stored in an index
+SLICE_EXT = '.slice'        # extension of slice descriptor files
+
+_NEWLINE = ord('\n')
+_COMMENTS = (ord('#'), ord('@'))
+
+
+def time_to_frame(t, frames_per_ns=FRAMES_PER_NS):
+    """
+    Convert a time in nanoseconds to a frame index.
+
+    Parameters
+    ----------
+    t: float time in ns
+    frames_per_ns: number of frames written per ns of simulation
+
+    Returns
+    -------
+    frame: int index of the data line corresponding to time t
+
+    """
+    return int(round(t*frames_per_ns))
+
+
+def read_header(filename):
+    """
+    Get the column names from the first header line of a .traj file.
+
+    Parameters
+    ----------
+    filename: string name of the .traj file
+
+    Returns
+    -------
+    names: list of strings of column names (e.g. ['step', 'ProjectionZ']),
+       or None if the file has no header before its first data line
+
+    """
+    with open(filename, 'r') as f:
+        for line in f:
+            if line[0] == '#':
+                return line[1:].split()
+            if line.strip():
+                return None
+    return None
+
+
+def _resolve_columns(filename, columns):
+    """Convert column names to integer indices using the file header."""
+    names = None
+    resolved = []
+    for c in columns:
+        if isinstance(c, str):
+            if names is None:
+                names = read_header(filename)
+            if names is None or c not in names:
+                raise ValueError("column '%s' not found in header of %s" % (c, filename))
+            c = names.index(c)
+        resolved.append(c)
+    return resolved
+
+
+def _data_lines(buf):
+    """
+    Locate the lines of a uint8 array of complete lines.
+
+    Returns
+    -------
+    begins: numpy int array of byte positions of the start of each line
+    ends: numpy int array of byte positions of the newline of each line
+    data: numpy bool array, whether each line is a data line, i.e. is
+       non-empty and does not begin with a comment character
+
+    """
+    ends = np.flatnonzero(buf == _NEWLINE)
+    begins = np.concatenate(([0], ends[:-1] + 1))
+    first = buf[begins]
+    data = (ends > begins) & (first != _COMMENTS[0]) & (first != _COMMENTS[1])
+    return begins, ends, data
+
+
+def _select_lines(block, lo, hi):
+    """
+    Find data lines of a block of complete lines and keep those whose
+    data-line ordinal within the block is in [lo, hi).
+
+    Returns
+    -------
+    selected: numpy uint8 array of the bytes of the kept lines (may be empty)
+    nlines: int number of selected lines
+    ndata: int total number of data lines in the block
+
+    """
+    buf = np.frombuffer(block, np.uint8)
+    begins, ends, data = _data_lines(buf)
+    ordinal = np.cumsum(data) - 1
+    ndata = int(ordinal[-1] + 1) if len(ordinal) else 0
+
+    keep = data & (ordinal >= lo) & (ordinal < hi)
+    nlines = int(np.count_nonzero(keep))
+    if nlines == 0:
+        return buf[:0], 0, ndata
+    if nlines == ndata and ndata == len(ends):
+        return buf, nlines, ndata
+
+    # expand line mask to byte mask, including each trailing newline
+    selected = buf[np.repeat(keep, ends - begins + 1)]
+    return selected, nlines, ndata
+
+
+def _iter_lines(filename, offset=0, chunk_bytes=CHUNK_BYTES):
+    """
+    Read a file from a byte offset in blocks of complete lines.
+
+    Yields
+    ------
+    block: bytes of consecutive complete lines, each ending in a newline
+    pos: int byte position of the block in the file
+
+    """
+    pos = offset
+    leftover = b''
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        while True:
+            buf = f.read(chunk_bytes)
+            if buf:
+                buf = leftover + buf
+                cut = buf.rfind(b'\n') + 1
+                if cut == 0:
+                    leftover = buf
+                    continue
+                block, leftover = buf[:cut], buf[cut:]
+            elif leftover:
+                # last line of file without trailing newline
+                block, leftover = leftover + b'\n', b''
+            else:
+                break
+            yield block, pos
+            pos += len(block)
+
+
+def _iter_frame_offsets(filename, offset=0, chunk_bytes=CHUNK_BYTES):
+    """Yield numpy int arrays of byte positions of data lines, by block."""
+    for block, pos in _iter_lines(filename, offset, chunk_bytes):
+        begins, ends, data = _data_lines(np.frombuffer(block, np.uint8))
+        yield pos + begins[data]
+
+
+def build_index(filename, stride=INDEX_STRIDE, chunk_bytes=CHUNK_BYTES):
+    """
+    Scan a .traj file once, recording the byte offset of every stride-th
+    frame, and store the index next to the binary cache (see traj_cache.py).
+
+    Parameters
+    ----------
+    filename: string name of the .traj file
+    stride: int number of frames between recorded offsets
+    chunk_bytes: int number of bytes to read from disk at a time
+
+    Returns
+    -------
+    offsets: numpy int64 array, offsets[i] is the byte position of frame i*stride
+    stride: int number of frames between recorded offsets
+    nframes: int total number of frames in the file
+
+    """
+    writer = traj_cache.open_index_writer(filename)
+    offsets = []
+    nframes = 0
+    for starts in _iter_frame_offsets(filename, 0, chunk_bytes):
+        offsets.append(starts[(-nframes) % stride::stride])
+        nframes += len(starts)
+    offsets = np.concatenate(offsets).astype(np.int64) if offsets else np.zeros(0, np.int64)
+    if writer is not None:
+        writer.commit(offsets, stride, nframes)
+    return offsets, stride, nframes
+
+
+def load_index(filename, build=True):
+    """
+    Get the index of a .traj file from the cache, building it if needed.
+
+    Parameters
+    ----------
+    filename: string name of the .traj file
+    build: bool, whether to build a missing or outdated index
+
+    Returns
+    -------
+    index: (offsets, stride, nframes) tuple as from build_index,
+       or None if there is no valid index and build is False
+
+    """
+    index = traj_cache.load_index(filename)
+    if index is None and build:
+        index = build_index(filename)
+    return index
+
+
+def seek_frame(filename, frame, build=False):
+    """
+    Find an indexed frame at or before a frame, to start reading from.
+
+    Parameters
+    ----------
+    filename: string name of the .traj file
+    frame: int index of the frame to be read
+    build: bool, whether to build the index if there is none
+
+    Returns
+    -------
+    offset: int byte position of the indexed frame, 0 without an index
+    base: int index of the frame at that byte position, 0 without an index
+
+    """
+    index = load_index(filename, build)
+    if index is None or frame is None or frame <= 0:
+        return 0, 0
+    offsets, stride, nframes = index
+    i = min(int(frame)//stride, len(offsets)-1)
+    if i < 0:
+        return 0, 0
+    return int(offsets[i]), i*stride
+
+
+def frame_offset(filename, frame, build=True):
+    """
+    Get the exact byte position of a frame, or the file size if the frame
+    is past the end of the file.
+    """
+    offset, base = seek_frame(filename, frame, build)
+    for starts in _iter_frame_offsets(filename, offset):
+        if frame - base < len(starts):
+            return int(starts[frame - base])
+        base += len(starts)
+    return os.path.getsize(filename)
+
+
+def count_frames(filename):
+    """
+    Get the number of frames of a .traj file (from its index) or of a
+    slice descriptor.
+    """
+    if filename.endswith(SLICE_EXT):
+        return read_slice(filename)['nframes']
+    return load_index(filename)[2]
+
+
+def write_slice(filename, outname, start=0, stop=None):
+    """
+    Write a slice descriptor of the frames in [start, stop) of a .traj
+    file instead of a copy of their text.
+
+    The descriptor is a JSON file of the source file (relative to the
+    descriptor), the frame slice, the byte offset of its first frame, its
+    number of frames, and the size and modification time of the source.
+
+    Parameters
+    ----------
+    filename: string name of the source .traj file
+    outname: string name of the descriptor to write, ending in SLICE_EXT
+    start, stop: see read_traj
+
+    Returns
+    -------
+    nframes: int number of frames in the slice
+
+    """
+    start = int(start)
+    total = load_index(filename)[2]
+    end = total if stop is None else min(int(stop), total)
+    nframes = max(end - start, 0)
+    st = os.stat(filename)
+
+    desc = {'source': os.path.relpath(os.path.abspath(filename),
+                                      os.path.dirname(os.path.abspath(outname))),
+            'start': start,
+            'stop': start + nframes,
+            'offset': frame_offset(filename, start),
+            'nframes': nframes,
+            'size': st.st_size,
+            'mtime': st.st_mtime}
+    with open(outname, 'w') as f:
+        json.dump(desc, f, indent=1)
+    return nframes
+
+
+def read_slice(filename):
+    """
+    Read a slice descriptor.
+
+    Returns
+    -------
+    desc: dict of the descriptor, with 'source' as an absolute path
+
+    """
+    with open(filename, 'r') as f:
+        desc = json.load(f)
+    desc['source'] = os.path.join(os.path.dirname(os.path.abspath(filename)), desc['source'])
+    st = os.stat(desc['source'])
+    if st.st_size != desc['size'] or st.st_mtime != desc['mtime']:
+        raise ValueError("%s changed since slice %s was written" % (desc['source'], filename))
+    return desc
+
+
+def _resolve(filename, start, stop):
+    """
+    Convert a frame slice of a .traj file or descriptor to a frame slice
+    of a .traj file.
+    """
+    if not filename.endswith(SLICE_EXT):
+        return filename, start, stop
+    desc = read_slice(filename)
+    n = desc['nframes'] if stop is None else min(stop, desc['nframes'])
+    return desc['source'], desc['start'] + start, desc['start'] + max(n, start)
+
+
+def iter_blocks(filename, start=0, stop=None, chunk_bytes=CHUNK_BYTES, offset=0):
+    """
+    Stream the raw text of data lines in the frame slice [start, stop).
+
+    Parameters
+    ----------
+    filename: string name of the .traj file
+    start: int index of first frame to keep
+    stop: int index one past the last frame to keep; None reads to the end
+    chunk_bytes: int number of bytes to read from disk at a time
+    offset: int byte position of frame 0 in the file; frames are
+       counted from this position
+
+    Yields
+    ------
+    selected: numpy uint8 array of the bytes of consecutive kept lines
+    nlines: int number of lines in selected
+
+    """
+    seen = 0  # number of data frames passed so far
+    if stop is not None and stop <= 0:
+        return
+    for block, pos in _iter_lines(filename, offset, chunk_bytes):
+        hi = None if stop is None else stop - seen
+        selected, nlines, ndata = _select_lines(
+            block, start - seen, np.inf if hi is None else hi)
+        seen += ndata
+        if nlines:
+            yield selected, nlines
+        if stop is not None and seen >= stop:
+            break
+
+
+def _parse_chunks(filename, start, stop, chunk_bytes, offset):
+    """Parse text blocks of all columns of frames in [start, stop)."""
+    for selected, nlines in iter_blocks(filename, start, stop, chunk_bytes, offset):
+        values = np.fromstring(selected.tobytes().decode('ascii'), sep=' ')
+        if values.size % nlines != 0:
+            raise ValueError("inconsistent number of columns in %s" % filename)
+        yield values.reshape(nlines, -1)
+
+
+def _parse_and_cache(filename, start, stop, chunk_bytes):
+    """
+    Parse every frame of the file, writing all of them to the cache,
+    and yield the blocks of frames in [start, stop).
+    """
+    writer = traj_cache.open_writer(filename)
+    if writer is None:
+        for values in _parse_chunks(filename, start, stop, chunk_bytes, 0):
+            yield values
+        return
+
+    seen = 0
+    try:
+        for values in _parse_chunks(filename, 0, None, chunk_bytes, 0):
+            writer.write(values)
+            lo = max(start - seen, 0)
+            hi = len(values) if stop is None else min(stop - seen, len(values))
+            seen += len(values)
+            if hi > lo:
+                yield values[lo:hi]
+        writer.commit()
+    finally:
+        writer.abort()
+
+
+def iter_chunks(filename, columns=None, start=0, stop=None,
+                chunk_bytes=CHUNK_BYTES, offset=0, cache=True):
+    """
+    Stream parsed frames in the slice [start, stop) one block at a time.
+
+    Parameters
+    ----------
+    filename: string name of the .traj file or slice descriptor
+    columns: list of int indices or string names of columns to keep;
+       None keeps all columns
+    start, stop, chunk_bytes, offset: see iter_blocks
+    cache: bool, whether to read from (or build) the binary cache.
+       The cache is not used when offset is nonzero. Without the cache,
+       reading starts from the nearest indexed frame, if indexed.
+
+    Yields
+    ------
+    data: numpy array of shape [nframes, ncolumns] for one block
+
+    """
+    if offset == 0:
+        filename, start, stop = _resolve(filename, start, stop)
+    if columns is not None:
+        columns = _resolve_columns(filename, columns)
+
+    if not cache or offset != 0:
+        if offset == 0:
+            offset, base = seek_frame(filename, start)
+            start -= base
+            stop = None if stop is None else stop - base
+        blocks = _parse_chunks(filename, start, stop, chunk_bytes, offset)
+    else:
+        cached = traj_cache.load(filename)
+        if cached is None:
+            blocks = _parse_and_cache(filename, start, stop, chunk_bytes)
+        else:
+            # copy about chunk_bytes of the memory-mapped cache at a time
+            nrows = max(chunk_bytes // (8*max(cached.shape[1], 1)), 1)
+            end = len(cached) if stop is None else min(stop, len(cached))
+            blocks = (cached[i:min(i+nrows, end)] for i in range(start, end, nrows))
+
+    for values in blocks:
+        if columns is not None:
+            values = values[:, columns]
+        yield np.array(values)
+
+
+def read_traj(filename, columns=None, start=0, stop=None,
+              chunk_bytes=CHUNK_BYTES, cache=True):
+    """
+    Read the frames in [start, stop) of a colvars trajectory.
+
+    Parameters
+    ----------
+    filename: string name of the .traj file or slice descriptor
+    columns: int/string for a single column, list of ints/strings for
+       several columns, or None for all columns
+    start: int index of first frame to keep
+    stop: int index one past the last frame to keep; None reads to the end
+    chunk_bytes: int number of bytes to read from disk at a time
+    cache: bool, whether to read from (or build) the binary cache
+
+    Returns
+    -------
+    data: numpy array of shape [nframes] if a single column was requested,
+       else of shape [nframes, ncolumns]
+
+    """
+    single = isinstance(columns, (int, str))
+    cols = [columns] if single else columns
+    filename, start, stop = _resolve(filename, start, stop)
+
+    cached = traj_cache.load(filename) if cache else None
+    if cached is not None:
+        data = cached[start:stop]
+        if cols is not None:
+            data = data[:, _resolve_columns(filename, cols)]
+        data = np.array(data)
+    else:
+        chunks = list(iter_chunks(filename, cols, start, stop, chunk_bytes, cache=cache))
+        if chunks:
+            data = np.concatenate(chunks)
+        else:
+            data = np.zeros([0, 0 if cols is None else len(cols)])
+
+    if single:
+        return data[:, 0]
+    return data
+
+
+def copy_slice(filename, outname, start=0, stop=None, chunk_bytes=CHUNK_BYTES):
+    """
+    Write the text of the frames in [start, stop) to a new file,
+    without parsing them.
+
+    Parameters
+    ----------
+    filename: string name of the source .traj file
+    outname: string name of the file to write
+    start, stop, chunk_bytes: see read_traj
+
+    Returns
+    -------
+    nframes: int number of frames written
+
+    """
+    offset, base = seek_frame(filename, start)
+    start -= base
+    stop = None if stop is None else stop - base
+
+    nframes = 0
+    with open(outname, 'wb') as outf:
+        for selected, nlines in iter_blocks(filename, start, stop, chunk_bytes, offset):
+            outf.write(selected.tobytes())
+            nframes += nlines
+    return nframes
+
+
+def copy_slices(filename, slices, chunk_bytes=CHUNK_BYTES):
+    """
+    Write the text of several frame slices of one file to new files,
+    reading the source file once and without parsing it.
+
+    Parameters
+    ----------
+    filename: string name of the source .traj file
+    slices: list of (outname, start, stop) tuples, with start and stop
+       as in read_traj. Slices may overlap.
+    chunk_bytes: see read_traj
+
+    Returns
+    -------
+    nframes: list of int number of frames written to each file
+
+    """
+    lo = min(int(start) for outname, start, stop in slices)
+    stops = [None if stop is None else int(stop) for outname, start, stop in slices]
+    hi = None if None in stops else max(stops)
+
+    offset, base = seek_frame(filename, lo)
+
+    nframes = [0]*len(slices)
+    outfs = [open(outname, 'wb') for outname, start, stop in slices]
+    try:
+        frame = lo  # frame index of first line in current block
+        for selected, nlines in iter_blocks(filename, lo-base,
+                None if hi is None else hi-base, chunk_bytes, offset):
+            ends = np.flatnonzero(selected == _NEWLINE) + 1
+            begins = np.concatenate(([0], ends[:-1]))
+            for i, (outname, start, stop) in enumerate(slices):
+                a = max(int(start) - frame, 0)
+                b = nlines if stop is None else min(int(stop) - frame, nlines)
+                if b > a:
+                    outfs[i].write(selected[begins[a]:ends[b-1]].tobytes())
+                    nframes[i] += b - a
+            frame += nlines
+    finally:
+        for f in outfs:
+            f.close()
+    return nframes
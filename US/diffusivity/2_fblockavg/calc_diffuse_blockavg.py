@@ -2,6 +2,7 @@
 
 """
 Example:    python calc_diffuse_blockavg.py -w 5 -i win05.traj -t 0.002
+            python calc_diffuse_blockavg.py -w 5 -i win05.traj -t 0.002 -m fft
 
 Purpose:    Calculate the correlation time of some time series from the variance
             of the mean as well as the interval of the time series. This applies
@@ -17,38 +18,70 @@ References:
 Version:    Sep 20 2018
 By:         Victoria T. Lim
 
-Example of full membrane calculation:
+Example of full membrane calculation (see calc_diffuse_profile.py to do this in one run):
  * for k in {-08..-01}; do i=`expr $k - 44`; j=$((-1 * $i)); echo $j; python calc_diffuse_blockavg.py -w $k -i /pub/limvt/pmf/07_us/02_analysis/trajfiles-26ns/win$j.traj -t 0.002 >> diffuse_26ns.dat; done
  * for k in {00..44}; do echo $k; python calc_diffuse_blockavg.py -w $k -i /pub/limvt/pmf/07_us/02_analysis/trajfiles-26ns/win$k.traj -t 0.002 >> diffuse_26ns.dat; done
 
 
 """
 
+import os
+import sys
 import numpy as np
 from flyvbjerg_petersen_std_err import fp_stderr
 
-data = np.random.randn(1000)
-err = fp_stderr(data)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+import colvars_traj # shared colvars .traj reader in US/
+import autocorr # FFT statistical inefficiency in US/
 
-def main(**kwargs):
-    data = np.loadtxt(args.infile)
-    colvars = data[:,0]
-    positions = data[:,1]
+def hummer_diffusivity(positions, dt, method='block'):
+    """
+    Compute the diffusivity of harmonically restrained positions.
 
+    Parameters
+    ----------
+    positions: numpy array of positions (Angs), of shape [n] for one
+       timeseries or [k, n] for k timeseries of the same length at once
+    dt: float interval of the timeseries (ns)
+    method: string 'block' for Flyvbjerg-Petersen block averaging or 'fft'
+       for the statistical inefficiency of the autocorrelation function
+
+    Returns
+    -------
+    dif: float or numpy array of diffusivities (Angs**2/ns)
+    tau: float or numpy array of correlation times (ns)
+
+    """
     # calculate variance of data
-    var = np.var(positions)
+    var = np.var(positions, axis=-1)
 
     # calculate variance of the mean
-    varbar = fp_stderr(positions)
+    n = np.shape(positions)[-1]
+    if method == 'fft':
+        # from statistical inefficiency g of the autocorrelation function
+        g = autocorr.statistical_inefficiency(positions)
+        varbar = var*g/n
+    else:
+        # fp_stderr returns the standard error, i.e. sqrt of variance of mean
+        varbar = fp_stderr(positions)**2
 
     # calculate tau (eq. 20 of ref 1)
-    n = len(positions)
     term1 = (n*varbar/var)-1
-    term2 = args.dt/2
+    term2 = dt/2
     tau = term1 * term2
 
-    # calculate diffusivity (eq. 17 of ref 1)
-    dif = var**2./tau
+    # calculate diffusivity (eq. 17 of ref 1); tau is a time, so the
+    # integral of the autocovariance in eq. 17 is var*tau
+    dif = var/tau
+    return dif, tau
+
+
+def main(**kwargs):
+    data = colvars_traj.read_traj(args.infile, columns=(0, 1))
+    colvars = data[:,0]
+    positions = data[:,1]
+
+    dif, tau = hummer_diffusivity(positions, args.dt, args.method)
 
     # output results
 #    print("# Diffusivities, using estimate of correlation time from block averaging")
@@ -70,6 +103,10 @@ if __name__ == "__main__":
     parser.add_argument("-t", "--dt", type=float,required=True,
                         help="Interval of time series data points in units of "
                              "nanoseconds.")
+    parser.add_argument("-m", "--method", choices=['block', 'fft'], default='block',
+                        help="Estimate the variance of the mean by Flyvbjerg-"
+                             "Petersen block averaging (default) or from the "
+                             "FFT autocorrelation function.")
 
     args = parser.parse_args()
     opt = vars(args)
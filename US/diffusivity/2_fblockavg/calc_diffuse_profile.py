@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+"""
+Example:    python calc_diffuse_profile.py -i trajfiles/win*.traj -c centers.dat -t 0.002 -o diffuse.dat
+            python calc_diffuse_profile.py -i win00.traj win01.traj -z 0 1 -t 0.002 --mirror -n 8
+
+Purpose:    Calculate the diffusivity profile D(z) across the membrane from
+            the harmonically restrained positions of all umbrella sampling
+            windows in one run, as calc_diffuse_blockavg.py does for one
+            window. Windows are computed in parallel, one per process.
+
+            The error of each window's diffusivity is from block averaging:
+            the timeseries is split into equal blocks in time, the
+            diffusivity of every block is computed at once, and the error
+            is the standard deviation of the blocks over sqrt(nblocks).
+
+            With --mirror, a window at z also gives the diffusivity at -z
+            if there is no window at -z, for windows that were only run
+            on one side of a symmetric membrane.
+
+            The output has columns of z, diffusivity (Angs**2/ns), and
+            error, sorted by z.
+
+"""
+
+import os
+import sys
+import multiprocessing
+import numpy as np
+from calc_diffuse_blockavg import hummer_diffusivity
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+import colvars_traj # shared colvars .traj reader in US/
+
+
+def window_diffusivity(infile, dt, method='block', nblocks=5, start=0):
+    """
+    Compute the diffusivity and its block error for one window.
+
+    Parameters
+    ----------
+    infile: string name of the .traj file of the window
+    dt: float interval of the timeseries (ns)
+    method: string 'block' or 'fft', see hummer_diffusivity
+    nblocks: int number of blocks in time for the error
+    start: int index of the first frame to use
+
+    Returns
+    -------
+    dif: float diffusivity of the whole timeseries (Angs**2/ns)
+    err: float standard error of the diffusivity from the blocks
+
+    """
+    positions = colvars_traj.read_traj(infile, columns=1, start=start)
+    dif, tau = hummer_diffusivity(positions, dt, method)
+
+    # diffusivity of all blocks at once
+    nper = len(positions) // nblocks
+    blocks = positions[:nblocks*nper].reshape(nblocks, nper)
+    difs, taus = hummer_diffusivity(blocks, dt, method)
+    err = np.std(difs, ddof=1) / np.sqrt(nblocks)
+    return dif, err
+
+
+def _window_job(job):
+    return window_diffusivity(*job)
+
+
+def diffuse_profile(infiles, centers, dt, method='block', nblocks=5,
+                    start=0, mirror=False, nproc=1):
+    """
+    Compute the diffusivity profile from all windows.
+
+    Parameters
+    ----------
+    infiles: list of string names of .traj files, one per window
+    centers: list of float z of each window (Angs)
+    dt, method, nblocks, start: see window_diffusivity
+    mirror: bool, whether a window at z also gives the diffusivity at -z
+       if there is no window at -z
+    nproc: int number of processes, one window each. None uses all cores.
+
+    Returns
+    -------
+    profile: numpy array of shape [nz, 3] of z, diffusivity, and error,
+       sorted by z
+
+    """
+    if len(infiles) != len(centers):
+        raise ValueError("got %d files but %d centers" % (len(infiles), len(centers)))
+    jobs = [(f, dt, method, nblocks, start) for f in infiles]
+    if nproc == 1:
+        results = [_window_job(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(nproc)
+        try:
+            results = pool.map(_window_job, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    centers = np.asarray(centers, dtype=np.float64)
+    profile = np.column_stack([centers, np.array(results)])
+    if mirror:
+        missing = [i for i, z in enumerate(centers)
+                   if z != 0 and not np.any(np.isclose(centers, -z))]
+        mirrored = profile[missing].copy()
+        mirrored[:, 0] *= -1
+        profile = np.vstack([profile, mirrored])
+
+    return profile[np.argsort(profile[:, 0], kind='stable')]
+
+
+def main(**kwargs):
+    if args.centers is not None:
+        centers = np.loadtxt(args.centers, ndmin=2)[:, 0]
+    else:
+        centers = args.zvals
+    profile = diffuse_profile(args.infiles, centers, args.dt, args.method,
+                              args.nblocks, args.start, args.mirror, args.nproc)
+    np.savetxt(args.outfile, profile, fmt=['%.4f', '%.6E', '%.6E'],
+               header="z (Angs)\tdiffusivity (Angs**2/ns)\terror")
+
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-i", "--infiles", nargs='+', required=True,
+                        help="Filenames with the timeseries of harmonically "
+                             "restrained positions in units of Angstroms, "
+                             "one per window.")
+    parser.add_argument("-c", "--centers", default=None,
+                        help="File with the z center (Angs) of each window in "
+                             "the first column, in the same order as the files.")
+    parser.add_argument("-z", "--zvals", type=float, nargs='+', default=None,
+                        help="Z center (Angs) of each window, in the same order "
+                             "as the files, instead of a centers file.")
+    parser.add_argument("-t", "--dt", type=float, required=True,
+                        help="Interval of time series data points in units of "
+                             "nanoseconds.")
+    parser.add_argument("-m", "--method", choices=['block', 'fft'], default='block',
+                        help="Estimate the variance of the mean by Flyvbjerg-"
+                             "Petersen block averaging (default) or from the "
+                             "FFT autocorrelation function.")
+    parser.add_argument("-b", "--nblocks", type=int, default=5,
+                        help="Number of blocks in time for the error of each window.")
+    parser.add_argument("-s", "--start", type=int, default=0,
+                        help="Index of the first frame of each window to use.")
+    parser.add_argument("--mirror", action="store_true", default=False,
+                        help="Use each window at z also for -z if there is no "
+                             "window at -z.")
+    parser.add_argument("-n", "--nproc", type=int, default=1,
+                        help="Number of processes, one window each.")
+    parser.add_argument("-o", "--outfile", default='diffuse.dat',
+                        help="Name of the output file.")
+
+    args = parser.parse_args()
+    if (args.centers is None) == (args.zvals is None):
+        parser.error("give one of --centers or --zvals")
+    opt = vars(args)
+    main(**opt)
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+
+"""
+Example:    python diffuse_estimators.py -i win00.traj win01.traj win02.traj -t 0.002
+            python diffuse_estimators.py -i trajfiles/win*.traj -t 0.002 --fit oscillator -o compare.dat
+
+Purpose:    Compare estimators of the position-dependent diffusivity from the
+            harmonically restrained positions of umbrella sampling windows.
+            Each estimator takes one timeseries of shape [n] or many
+            equal-length timeseries (e.g., all windows) of shape [k, n] and
+            computes all of them at once; lists of different lengths are
+            computed in groups of equal length.
+
+             * pacf: D = var**2 / int_0^tmax C(t) dt, where C(t) is the
+               position autocovariance function from FFT, as computed by
+               ../1_fromSI/diffusivity.cpp (ref 1). Like that program,
+               the integral runs over the first ncorr lag times.
+             * block: Hummer's variance-of-the-mean estimator with
+               Flyvbjerg-Petersen block averaging, as in
+               calc_diffuse_blockavg.py (ref 2).
+             * fit: fit C(t) to the autocovariance of a restrained particle
+               under Langevin dynamics, either overdamped (exponential,
+               D = var/tau) or underdamped (harmonic oscillator with
+               friction gamma and frequency w0, D = var*w0**2/gamma).
+               Needs scipy.
+
+            All diffusivities are in Angs**2 over the units of dt.
+
+References:
+ 1. PACF integral estimator:                   10.1021/acs.jcim.6b00022
+ 2. Variance of the mean estimator:            10.1021/ct2009279
+ 3. Position autocorrelation of the harmonic
+    oscillator under Langevin dynamics:        10.1021/ct400925s
+
+"""
+
+import os
+import sys
+import numpy as np
+from calc_diffuse_blockavg import hummer_diffusivity
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+import colvars_traj # shared colvars .traj reader in US/
+import autocorr # FFT autocorrelation functions in US/
+
+
+def _batched(func):
+    """
+    Let an estimator of [n] or [k, n] arrays also take a list of series
+    of different lengths, returning an array with one value per series.
+    """
+    def wrapper(z, *args, **kwargs):
+        if isinstance(z, (list, tuple)):
+            return np.array(autocorr._by_length(z, lambda b: func(b, *args, **kwargs)))
+        return func(np.asarray(z, dtype=np.float64), *args, **kwargs)
+    wrapper.__doc__ = func.__doc__
+    wrapper.__name__ = func.__name__
+    return wrapper
+
+
+def _trapezoid(y, dx):
+    """Integrate evenly spaced y along the last axis by the trapezoid rule."""
+    return dx * (np.sum(y, axis=-1) - (y[..., 0] + y[..., -1])/2)
+
+
+@_batched
+def pacf_diffusivity(z, dt, ncorr=10000):
+    """
+    Compute the diffusivity from the integral of the position autocovariance.
+
+    Parameters
+    ----------
+    z: numpy array of positions of shape [n] or [k, n]
+    dt: float interval of the timeseries
+    ncorr: int number of lag times of the autocovariance to integrate
+
+    Returns
+    -------
+    dif: float or numpy array of shape [k] of diffusivities
+
+    """
+    # autocovariance normalized by the number of terms at each lag
+    c = autocorr.acf(z, nlags=ncorr, unbiased=True, normalize=False)
+    var = np.var(z, axis=-1)
+    integral = _trapezoid(c, dt)
+    return var**2 / integral
+
+
+@_batched
+def block_diffusivity(z, dt):
+    """
+    Compute the diffusivity from the variance of the mean by block averaging.
+
+    Parameters
+    ----------
+    z: numpy array of positions of shape [n] or [k, n]
+    dt: float interval of the timeseries
+
+    Returns
+    -------
+    dif: float or numpy array of shape [k] of diffusivities
+
+    """
+    return hummer_diffusivity(z, dt, 'block')[0]
+
+
+def _exp_model(t, tau):
+    return np.exp(-t/tau)
+
+
+def _oscillator_model(t, gamma, w0):
+    # normalized position autocorrelation of a damped harmonic oscillator;
+    # complex frequency covers both the under- and overdamped cases
+    w = np.sqrt(complex(w0**2 - gamma**2/4))
+    c = np.exp(-gamma*t/2) * (np.cos(w*t) + gamma/(2*w)*np.sin(w*t))
+    return c.real
+
+
+@_batched
+def fit_diffusivity(z, dt, model='exp', ncorr=10000):
+    """
+    Compute the diffusivity by fitting the normalized position
+    autocorrelation to a model of Langevin dynamics in a harmonic well.
+
+    Parameters
+    ----------
+    z: numpy array of positions of shape [n] or [k, n]
+    dt: float interval of the timeseries
+    model: string 'exp' for overdamped dynamics, C(t) = exp(-t/tau), or
+       'oscillator' for underdamped dynamics with friction gamma and
+       frequency w0
+    ncorr: int number of lag times of the autocorrelation to fit
+
+    Returns
+    -------
+    dif: float or numpy array of shape [k] of diffusivities; nan where
+       the fit does not converge
+
+    """
+    try:
+        from scipy.optimize import curve_fit
+    except ImportError:
+        raise ImportError("fit_diffusivity needs scipy")
+
+    single = (z.ndim == 1)
+    z = np.atleast_2d(z)
+    c = autocorr.acf(z, nlags=ncorr, unbiased=True)
+    var = np.var(z, axis=-1)
+    t = dt*np.arange(c.shape[-1])
+
+    # initial guesses from the integral of c up to its first zero, tau,
+    # and from the first zero as a quarter period of oscillation
+    nonpos = (c <= 0)
+    first_zero = np.where(nonpos.any(axis=-1), nonpos.argmax(axis=-1), c.shape[-1])
+
+    dif = np.full(len(z), np.nan)
+    for k in range(len(z)):
+        tau0 = max(_trapezoid(c[k, :first_zero[k]], dt), dt)
+        if model == 'exp':
+            starts = [[tau0]]
+        else:
+            # underdamped guess, then overdamped guess with w0**2/gamma = 1/tau0
+            starts = [[1./tau0, np.pi/(2*dt*first_zero[k])],
+                      [5./tau0, np.sqrt(5.)/tau0]]
+        func = _exp_model if model == 'exp' else _oscillator_model
+
+        # keep the fit with the smallest residual
+        best = np.inf
+        for p0 in starts:
+            try:
+                popt, _ = curve_fit(func, t, c[k], p0=p0)
+            except RuntimeError:
+                continue
+            resid = np.sum((func(t, *popt) - c[k])**2)
+            if resid < best:
+                best = resid
+                if model == 'exp':
+                    dif[k] = var[k]/popt[0]
+                else:
+                    dif[k] = var[k]*popt[1]**2/popt[0]
+    return dif[0] if single else dif
+
+
+def compare_estimators(z, dt, ncorr=10000, fit=None):
+    """
+    Compute the diffusivity with each estimator.
+
+    Parameters
+    ----------
+    z: numpy array of positions of shape [n] or [k, n], or list of series
+    dt: float interval of the timeseries
+    ncorr: int number of lag times of the autocorrelation
+    fit: string model for fit_diffusivity, or None to skip the fit
+
+    Returns
+    -------
+    difs: dict of diffusivities of each estimator, 'pacf', 'block', and
+       with fit, 'fit'
+
+    """
+    difs = {'pacf': pacf_diffusivity(z, dt, ncorr),
+            'block': block_diffusivity(z, dt)}
+    if fit is not None:
+        difs['fit'] = fit_diffusivity(z, dt, fit, ncorr)
+    return difs
+
+
+def main(**kwargs):
+    series = [colvars_traj.read_traj(f, columns=1, start=args.start) for f in args.infiles]
+    difs = compare_estimators(series, args.dt, args.ncorr, args.fit)
+
+    names = list(difs)
+    table = np.column_stack([difs[n] for n in names])
+    header = "window\t" + "\t".join(names)
+    lines = [header] + ["%s\t%s" % (os.path.basename(f), "\t".join("%.6E" % d for d in row))
+                        for f, row in zip(args.infiles, table)]
+    if args.outfile is None:
+        print("# " + "\n".join(lines))
+    else:
+        with open(args.outfile, 'w') as f:
+            f.write("# " + "\n".join(lines) + "\n")
+
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-i", "--infiles", nargs='+', required=True,
+                        help="Filenames with the timeseries of harmonically "
+                             "restrained positions in units of Angstroms, "
+                             "one per window.")
+    parser.add_argument("-t", "--dt", type=float, required=True,
+                        help="Interval of time series data points in units of "
+                             "nanoseconds.")
+    parser.add_argument("-c", "--ncorr", type=int, default=10000,
+                        help="Number of lag times of the autocorrelation to "
+                             "integrate or fit.")
+    parser.add_argument("-f", "--fit", choices=['exp', 'oscillator'], default=None,
+                        help="Also fit the autocorrelation to this model.")
+    parser.add_argument("-s", "--start", type=int, default=0,
+                        help="Index of the first frame of each window to use.")
+    parser.add_argument("-o", "--outfile", default=None,
+                        help="Name of the output file. Default is to print.")
+
+    args = parser.parse_args()
+    opt = vars(args)
+    main(**opt)
@@ -38,7 +38,8 @@ def block_transformation(series):
     ----------
     series : ndarray
         Things we want to average: e.g. squared displacements to calculate the
-        mean squared displacement of a Brownian particle.
+        mean squared displacement of a Brownian particle. Blocks along the
+        last axis, so a 2-D array holds one series per row.
 
     Returns
     -------
@@ -50,11 +51,21 @@ def block_transformation(series):
     Flyvbjerg & Peterson 1989, equation 20
 
     """
-    n_steps = series.size
-    n_steps_p = np.floor(n_steps/2.)
-    output = 0.5 * (series[::2][:n_steps_p] + series[1::2][:n_steps_p])
+    n_steps = series.shape[-1]
+    n_steps_p = n_steps // 2
+    output = 0.5 * (series[..., 0:2*n_steps_p:2] + series[..., 1:2*n_steps_p:2])
     return output
 
+def blocking_sizes(n_steps, npmin = 15):
+    """
+    Get the number of points at each blocking level, starting from n_steps
+    and halving until at most npmin points are left.
+    """
+    sizes = [n_steps]
+    while sizes[-1] > npmin:
+        sizes.append(sizes[-1] // 2)
+    return np.array(sizes)
+
 def calculate_blocked_variances(series, npmin = 15):
     """
     Compute a series of blocks and variances.
@@ -63,14 +74,17 @@ def calculate_blocked_variances(series, npmin = 15):
     ----------
     series : ndarray
         the thing we want to average: e.g. squared
-        displacements for a Brownian random walk.
+        displacements for a Brownian random walk. A 2-D array of shape
+        (n_series, n_steps) holds many series (e.g., US windows) of the
+        same length, which are blocked together.
     npmin : int
         cutoff number of points to stop blocking
 
     Returns
     -------
     output_var, var_stderr : ndarray
-        The variance and stderr of the variance at each blocking level
+        The variance and stderr of the variance at each blocking level.
+        For 2-D series, output_var has shape (n_series, n_levels).
 
     Notes
     -----
@@ -78,25 +92,17 @@ def calculate_blocked_variances(series, npmin = 15):
     last few blocks are very noisy, so we default to cutting off before that.
 
     """
-    n_steps = series.size
-
-    def var(d, n):
-        # see eq. 27 of FP paper
-        return d.var()/(n-1)
-    def stderr_var(n):
-        # see eq. 27 of FP paper
-        return np.sqrt(2./(n-1))
+    series = np.asarray(series, dtype=np.float64)
+    sizes = blocking_sizes(series.shape[-1], npmin)
 
-    output_var = np.array([var(series, n_steps)]) # initialize
-    var_stderr = np.array([stderr_var(n_steps)])
+    # see eq. 27 of FP paper
+    output_var = np.empty(series.shape[:-1] + (len(sizes),))
+    var_stderr = np.sqrt(2./(sizes-1))
 
-    while n_steps > npmin:
+    output_var[..., 0] = series.var(axis=-1) / (sizes[0]-1)
+    for level in range(1, len(sizes)):
         series = block_transformation(series)
-        n_steps = series.size
-        # TODO: precompute size of output_var and var_stderr from n_steps
-        # rather than appending
-        output_var = np.append(output_var, var(series, n_steps))
-        var_stderr = np.append(var_stderr, stderr_var(n_steps))
+        output_var[..., level] = series.var(axis=-1) / (sizes[level]-1)
 
     return output_var, var_stderr
 
@@ -108,17 +114,18 @@ def detect_fixed_point(fp_var, fp_sev, full_output = False):
     Parameters
     ----------
     fp_var: ndarray
-        FP blocked variance
+        FP blocked variance, or array of shape (n_series, n_levels)
+        for many series
     fp_sev: ndarray
         FP standard error of the variance.
 
     Returns
     -------
-    best_var : float
+    best_var : float or ndarray
         best estimate of the variance
-    converged : bool
+    converged : bool or ndarray
         did the series converge to a fixed point?
-    bounds : (int, int) only if full_output is True
+    bounds : (int, int) or (ndarray, ndarray), only if full_output is True
         range of fp_var averaged to compute best_var
 
     Notes
@@ -128,41 +135,40 @@ def detect_fixed_point(fp_var, fp_sev, full_output = False):
     correspondingly large standard error of the variance.
 
     """
-    n_trans = fp_var.size # number of block transformations and index
-
-    left_index = 0
-    right_index = 0
-
-    # Detect left edge
-    for i in np.arange(n_trans):
-        # ith point inside error bars of next point
-        if np.abs(fp_var[i + 1] - fp_var[i]) < fp_var[i + 1] * fp_sev[i + 1]:
-            left_index = i
-            break
-
-    # Check right edge
-    for i in np.arange(n_trans)[::-1]:
-        if np.abs(fp_var[i] - fp_var[i - 1]) < fp_var[i - 1] * fp_sev[i - 1]:
-            right_index = i
-            break
-
-    # if search succeeds
-    if (left_index >= 0) and (right_index >= 0) and \
-            (right_index >= left_index):
-        best_var = np.average(fp_var[left_index:right_index + 1],
-                              weights = 1./fp_sev[left_index:right_index + 1])
-        converged = True
-    else:
-        best_var = fp_var.max()
-        converged = False
-
+    single = (np.ndim(fp_var) == 1)
+    fp_var = np.atleast_2d(fp_var)
+    n_series, n_trans = fp_var.shape # number of block transformations
+    levels = np.arange(n_trans)
+
+    # Detect left edge: first ith point inside error bars of next point
+    inside = np.abs(np.diff(fp_var, axis=-1)) < fp_var[:, 1:] * fp_sev[1:]
+    left_index = np.where(inside.any(axis=-1), inside.argmax(axis=-1), 0)
+
+    # Check right edge: last ith point with previous point inside its error
+    # bars, using the error bars of the previous point
+    inside = np.abs(np.diff(fp_var, axis=-1)) < fp_var[:, :-1] * fp_sev[:-1]
+    last = n_trans - 2 - inside[:, ::-1].argmax(axis=-1)
+    right_index = np.where(inside.any(axis=-1), last + 1, 0)
+
+    # if search succeeds, average fp_var from left to right edges
+    converged = right_index >= left_index
+    in_range = (levels >= left_index[:, np.newaxis]) & \
+               (levels <= right_index[:, np.newaxis])
+    weights = in_range / fp_sev
+    with np.errstate(invalid='ignore', divide='ignore'):
+        best_var = (weights * fp_var).sum(axis=-1) / weights.sum(axis=-1)
+    best_var = np.where(converged, best_var, fp_var.max(axis=-1))
+
+    if single:
+        best_var, converged = best_var[0], bool(converged[0])
+        left_index, right_index = int(left_index[0]), int(right_index[0])
     if full_output is True:
         return best_var, converged, (left_index, right_index)
     else:
         return best_var, converged
 
 
-def fp_stderr(data):
+def fp_stderr(data, npmin = 15):
     '''
     Compute standard error using Flyvbjerg-Petersen blocking.
 
@@ -173,12 +179,15 @@ def fp_stderr(data):
     ----------
     data: ndarray
         data whose mean is to be calculated, and for which we need
-        a standard error on the mean
+        a standard error on the mean. A 2-D array of shape
+        (n_series, n_steps) computes the standard error of each row at once.
+    npmin : int
+        cutoff number of points to stop blocking
 
     Returns
     -------
-    stderr : float
-        Standard error on the mean of data
+    stderr : float or ndarray
+        Standard error on the mean of data, or of each row of data
 
     Notes
     -----
@@ -188,12 +197,14 @@ def fp_stderr(data):
     section 3.
 
     '''
-    block_trans_var, block_trans_sev = calculate_blocked_variances(data)
+    block_trans_var, block_trans_sev = calculate_blocked_variances(data, npmin)
     var_mean, conv, bounds = detect_fixed_point(block_trans_var,
                                                 block_trans_sev, True)
 
-    if not conv:
-        warnings.warn("Fixed point not found, returned value is a lower bound on the standard error")
+    if not np.all(conv):
+        warnings.warn("Fixed point not found for {} of {} series, returned value "
+                      "is a lower bound on the standard error".format(
+                      np.size(conv) - np.count_nonzero(conv), np.size(conv)))
     return np.sqrt(var_mean)
 
 #  LocalWords:  Flyvbjerg
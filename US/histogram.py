@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+
+"""
+Purpose:    Fixed-grid histograms accumulated one chunk of samples at a
+            time, for trajectories too large to hold in memory.
+
+            A HistogramAccumulator holds the histograms of one or more
+            series (e.g. US windows) on one shared grid of bins. It is
+            updated from arrays of any size, and accumulators on the same
+            grid can be merged, so each window can be histogrammed in a
+            separate process (histogram_trajs) and the parts combined.
+
+Example:    import histogram
+            edges = np.linspace(-8, 44, 181)
+            hist = histogram.histogram_trajs(['win00.traj', 'win01.traj'],
+                                             edges, column=1, nproc=2)
+            hist.counts    # shape [2, 180]
+
+"""
+
+import multiprocessing
+import numpy as np
+import colvars_traj
+
+
+class HistogramAccumulator(object):
+    """
+    Histograms of nseries series on a shared grid of bins, updated chunk
+    by chunk. Samples outside the grid are counted in below and above.
+    The upper edge of the last bin is included in that bin.
+    """
+
+    def __init__(self, edges, nseries=1):
+        self.edges = np.asarray(edges, dtype=np.float64)
+        self.nbins = len(self.edges) - 1
+        self.nseries = nseries
+        self.counts = np.zeros([nseries, self.nbins], np.int64)
+        self.below = np.zeros(nseries, np.int64)
+        self.above = np.zeros(nseries, np.int64)
+
+        # bin index by arithmetic instead of search for uniform grids
+        widths = np.diff(self.edges)
+        self._uniform = np.allclose(widths, widths[0])
+
+    @classmethod
+    def uniform(cls, lo, hi, nbins, nseries=1):
+        """Create an accumulator of nbins equal bins from lo to hi."""
+        return cls(np.linspace(lo, hi, nbins+1), nseries)
+
+    def bin_index(self, values):
+        """
+        Get the bin of each value: -1 below the grid, nbins above it.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        lo, hi = self.edges[0], self.edges[-1]
+        if self._uniform:
+            idx = np.floor((values - lo) / (hi - lo) * self.nbins).astype(np.int64)
+        else:
+            idx = np.searchsorted(self.edges, values, side='right') - 1
+        idx[values == hi] = self.nbins - 1
+        idx[values < lo] = -1
+        idx[values > hi] = self.nbins
+        return idx
+
+    def update(self, values, series=0):
+        """
+        Add a chunk of samples of one series.
+
+        Parameters
+        ----------
+        values: numpy array of samples of any shape
+        series: int index of the series the samples belong to
+
+        """
+        idx = self.bin_index(np.ravel(values))
+        below = idx < 0
+        above = idx >= self.nbins
+        self.below[series] += np.count_nonzero(below)
+        self.above[series] += np.count_nonzero(above)
+        inside = idx[~(below | above)]
+        self.counts[series] += np.bincount(inside, minlength=self.nbins)
+
+    def merge(self, other, series=None):
+        """
+        Add the counts of another accumulator on the same grid.
+
+        Parameters
+        ----------
+        other: HistogramAccumulator with the same bin edges
+        series: int index of the series to add a single-series accumulator
+           into; None adds all series of an accumulator with as many series
+
+        Returns
+        -------
+        self
+
+        """
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError("cannot merge histograms with different bin edges")
+        if series is None:
+            if other.nseries != self.nseries:
+                raise ValueError("cannot merge %d series into %d" % (other.nseries, self.nseries))
+            self.counts += other.counts
+            self.below += other.below
+            self.above += other.above
+        else:
+            if other.nseries != 1:
+                raise ValueError("can only merge a single series into series %d" % series)
+            self.counts[series] += other.counts[0]
+            self.below[series] += other.below[0]
+            self.above[series] += other.above[0]
+        return self
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+    @property
+    def centers(self):
+        """Bin centers."""
+        return 0.5*(self.edges[1:] + self.edges[:-1])
+
+    @property
+    def total(self):
+        """Number of samples of each series, including those off the grid."""
+        return self.counts.sum(axis=1) + self.below + self.above
+
+    def probability(self):
+        """Fraction of each series' samples on the grid that is in each bin."""
+        N_k = self.counts.sum(axis=1).astype(np.float64)
+        return self.counts / np.maximum(N_k, 1)[:, np.newaxis]
+
+    def save(self, filename):
+        """Write the accumulator to a .npz file."""
+        np.savez(filename, edges=self.edges, counts=self.counts,
+                 below=self.below, above=self.above)
+
+    @classmethod
+    def load(cls, filename):
+        """Read an accumulator written by save."""
+        with np.load(filename) as data:
+            hist = cls(data['edges'], len(data['counts']))
+            hist.counts += data['counts']
+            hist.below += data['below']
+            hist.above += data['above']
+        return hist
+
+
+def histogram_traj(filename, edges, column=1, start=0, stop=None,
+                   chunk_bytes=colvars_traj.CHUNK_BYTES):
+    """
+    Histogram one column of a .traj file, streaming it block by block.
+
+    Parameters
+    ----------
+    filename: string name of the .traj file or slice descriptor
+    edges: numpy array of bin edges
+    column: int index or string name of the column
+    start, stop, chunk_bytes: see colvars_traj.read_traj
+
+    Returns
+    -------
+    hist: HistogramAccumulator with a single series
+
+    """
+    hist = HistogramAccumulator(edges)
+    for values in colvars_traj.iter_chunks(filename, [column], start, stop, chunk_bytes):
+        hist.update(values[:, 0])
+    return hist
+
+
+def _histogram_job(job):
+    return histogram_traj(*job)
+
+
+def histogram_trajs(filenames, edges, column=1, start=0, stop=None, nproc=1):
+    """
+    Histogram one column of each of several .traj files on a shared grid,
+    one file per process.
+
+    Parameters
+    ----------
+    filenames: list of string names of .traj files, one per series
+    edges, column, start, stop: see histogram_traj
+    nproc: int number of processes. None uses all cores.
+
+    Returns
+    -------
+    hist: HistogramAccumulator with one series per file
+
+    """
+    jobs = [(f, edges, column, start, stop) for f in filenames]
+    if nproc == 1:
+        parts = [_histogram_job(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(nproc)
+        try:
+            parts = pool.map(_histogram_job, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    hist = HistogramAccumulator(edges, len(filenames))
+    for k, part in enumerate(parts):
+        hist.merge(part, series=k)
+    return hist
+
+
+def traj_range(filenames, column=1, start=0, stop=None):
+    """
+    Get the min and max of one column over several .traj files,
+    streaming them block by block.
+    """
+    lo, hi = np.inf, -np.inf
+    for f in filenames:
+        for values in colvars_traj.iter_chunks(f, [column], start, stop):
+            if len(values):
+                lo = min(lo, values.min())
+                hi = max(hi, values.max())
+    return lo, hi
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+
+"""
+Purpose:    Binary cache of parsed colvars trajectory (*.traj) files, used
+            transparently by colvars_traj so that each .traj text file is
+            only parsed once across all analysis scripts.
+
+            Each parsed file is stored as a raw float64 array (memory-mapped
+            on load) plus a JSON sidecar recording the source path, size,
+            and modification time. A cache entry whose sidecar does not
+            match the current source file is ignored and rebuilt.
+
+Index:      Byte offsets of every n-th frame of a .traj file (see
+            colvars_traj.build_index) are kept the same way, as a raw int64
+            array plus a JSON sidecar.
+
+Location:   By default in a .trajcache directory next to each .traj file.
+            Set the TRAJ_CACHE_DIR environment variable to use one
+            directory for all caches instead.
+
+Usage:      python traj_cache.py win*.traj            # build caches
+            python traj_cache.py --index win*.traj    # build indexes only
+            python traj_cache.py --clear win*.traj    # delete caches and indexes
+
+"""
+
+import os
+import json
+import hashlib
+import warnings
+import numpy as np
+
+CACHE_DIRNAME = '.trajcache'
+DTYPE = 'float64'
+
+
+def cache_paths(filename):
+    """
+    Get the names of the binary data and sidecar metadata cache files.
+
+    Parameters
+    ----------
+    filename: string name of the source .traj file
+
+    Returns
+    -------
+    binfile: string name of the binary data file
+    metafile: string name of the JSON metadata file
+
+    """
+    source = os.path.abspath(filename)
+    cache_dir = os.environ.get('TRAJ_CACHE_DIR')
+    if not cache_dir:
+        cache_dir = os.path.join(os.path.dirname(source), CACHE_DIRNAME)
+
+    # hash of the full path keeps same-named files in a shared dir apart
+    digest = hashlib.md5(source.encode('utf-8')).hexdigest()[:8]
+    key = '%s.%s' % (os.path.basename(source), digest)
+    return os.path.join(cache_dir, key+'.bin'), os.path.join(cache_dir, key+'.json')
+
+
+def _stamp(filename):
+    """Identify the current version of a source file."""
+    st = os.stat(filename)
+    return {'source': os.path.abspath(filename),
+            'size': st.st_size,
+            'mtime': st.st_mtime}
+
+
+def load(filename):
+    """
+    Load the cached array of a .traj file if it is up to date.
+
+    Parameters
+    ----------
+    filename: string name of the source .traj file
+
+    Returns
+    -------
+    data: read-only numpy memmap of shape [nframes, ncolumns] with all
+       frames of the file, or None if there is no valid cache
+
+    """
+    binfile, metafile = cache_paths(filename)
+    try:
+        with open(metafile, 'r') as f:
+            meta = json.load(f)
+        stamp = _stamp(filename)
+    except (IOError, OSError, ValueError):
+        return None
+
+    for key, value in stamp.items():
+        if meta.get(key) != value:
+            return None
+    if not os.path.isfile(binfile):
+        return None
+
+    shape = (meta['nframes'], meta['ncols'])
+    if meta['nframes'] == 0:
+        return np.zeros(shape, meta['dtype'])
+    return np.memmap(binfile, dtype=meta['dtype'], mode='r', shape=shape)
+
+
+class CacheWriter(object):
+    """
+    Write parsed frames of a .traj file to its cache, one block at a time.
+    The cache only becomes visible to load() after commit().
+    """
+
+    def __init__(self, filename):
+        # record source version before parsing begins
+        self.stamp = _stamp(filename)
+        self.binfile, self.metafile = cache_paths(filename)
+        cache_dir = os.path.dirname(self.binfile)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.tmpfile = '%s.%d.tmp' % (self.binfile, os.getpid())
+        self.fh = open(self.tmpfile, 'wb')
+        self.nframes = 0
+        self.ncols = None
+
+    def write(self, values):
+        """Append a [nframes, ncolumns] block of parsed frames."""
+        values = np.ascontiguousarray(values, dtype=DTYPE)
+        if self.ncols is None:
+            self.ncols = values.shape[1]
+        elif values.shape[1] != self.ncols:
+            raise ValueError("inconsistent number of columns in %s" % self.stamp['source'])
+        values.tofile(self.fh)
+        self.nframes += len(values)
+
+    def commit(self):
+        """Move the finished data into place and write the sidecar."""
+        self.fh.close()
+        if os.path.exists(self.metafile):
+            os.remove(self.metafile)
+        os.rename(self.tmpfile, self.binfile)
+
+        meta = dict(self.stamp)
+        meta.update({'nframes': self.nframes,
+                     'ncols': self.ncols or 0,
+                     'dtype': DTYPE})
+        tmpmeta = '%s.%d.tmp' % (self.metafile, os.getpid())
+        with open(tmpmeta, 'w') as f:
+            json.dump(meta, f)
+        os.rename(tmpmeta, self.metafile)
+
+    def abort(self):
+        """Discard an unfinished cache. Does nothing after commit()."""
+        if not self.fh.closed:
+            self.fh.close()
+            os.remove(self.tmpfile)
+
+
+def open_writer(filename):
+    """
+    Start a new cache for a .traj file.
+
+    Returns
+    -------
+    writer: CacheWriter, or None if the cache location is not writable
+
+    """
+    try:
+        return CacheWriter(filename)
+    except (IOError, OSError) as e:
+        warnings.warn("Not caching %s: %s" % (filename, e))
+        return None
+
+
+def index_paths(filename):
+    """Get the names of the binary offsets and sidecar metadata index files."""
+    binfile, metafile = cache_paths(filename)
+    base = binfile[:-len('.bin')]
+    return base+'.idx', base+'.idx.json'
+
+
+def load_index(filename):
+    """
+    Load the frame index of a .traj file if it is up to date.
+
+    Returns
+    -------
+    index: (offsets, stride, nframes) tuple, where offsets is a numpy int64
+       array of byte positions of every stride-th frame and nframes is the
+       number of frames in the file, or None if there is no valid index
+
+    """
+    idxfile, metafile = index_paths(filename)
+    try:
+        with open(metafile, 'r') as f:
+            meta = json.load(f)
+        stamp = _stamp(filename)
+        offsets = np.fromfile(idxfile, dtype=np.int64)
+    except (IOError, OSError, ValueError):
+        return None
+
+    for key, value in stamp.items():
+        if meta.get(key) != value:
+            return None
+    if len(offsets) != meta['noffsets']:
+        return None
+    return offsets, meta['stride'], meta['nframes']
+
+
+class IndexWriter(object):
+    """
+    Write the frame index of a .traj file. Created before scanning the
+    file so that the index records the version of the file that was scanned.
+    """
+
+    def __init__(self, filename):
+        self.stamp = _stamp(filename)
+        self.idxfile, self.metafile = index_paths(filename)
+        cache_dir = os.path.dirname(self.idxfile)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def commit(self, offsets, stride, nframes):
+        """Write the offsets and the sidecar."""
+        if os.path.exists(self.metafile):
+            os.remove(self.metafile)
+        tmpfile = '%s.%d.tmp' % (self.idxfile, os.getpid())
+        np.asarray(offsets, np.int64).tofile(tmpfile)
+        os.rename(tmpfile, self.idxfile)
+
+        meta = dict(self.stamp)
+        meta.update({'stride': int(stride),
+                     'nframes': int(nframes),
+                     'noffsets': len(offsets)})
+        tmpmeta = '%s.%d.tmp' % (self.metafile, os.getpid())
+        with open(tmpmeta, 'w') as f:
+            json.dump(meta, f)
+        os.rename(tmpmeta, self.metafile)
+
+
+def open_index_writer(filename):
+    """
+    Start a new index for a .traj file.
+
+    Returns
+    -------
+    writer: IndexWriter, or None if the cache location is not writable
+
+    """
+    try:
+        return IndexWriter(filename)
+    except (IOError, OSError) as e:
+        warnings.warn("Not indexing %s: %s" % (filename, e))
+        return None
+
+
+def clear(filename):
+    """Delete the cache and index files of a .traj file, if present."""
+    for f in cache_paths(filename) + index_paths(filename):
+        if os.path.exists(f):
+            os.remove(f)
+
+
+if __name__ == "__main__":
+
+    import argparse
+    import colvars_traj
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("infiles", nargs='+',
+                        help="One or more .traj files to cache.")
+
+    parser.add_argument("--clear", action="store_true", default=False,
+                        help="Delete the caches of the files instead.")
+
+    parser.add_argument("--index", action="store_true", default=False,
+                        help="Only build the frame indexes of the files.")
+
+    args = parser.parse_args()
+    for f in args.infiles:
+        if args.clear:
+            clear(f)
+        elif args.index:
+            offsets, stride, nframes = colvars_traj.build_index(f)
+            print("%s\t%d frames" % (f, nframes))
+        else:
+            data = colvars_traj.read_traj(f)
+            print("%s\t%d frames" % (f, len(data)))
@@ -1,4 +1,7 @@
 
+import os
+import sys
+import multiprocessing
 import numpy as np
 import numpy_indexed as npi
 from scipy import integrate
@@ -104,15 +107,134 @@ class Profile:
                 header=header, fmt=['%.2f', '%.6f'])
 
 
+def read_colvars_grid(infile):
+    """Read a colvars grid file (e.g., .grad, .czar.grad, .count) of a
+    one-dimensional colvar, parsing the data block with a single call.
+    Files without a colvars grid header (e.g., post-processed gradients)
+    are read with np.loadtxt.
+
+    Parameters
+    ----------
+    infile : string
+        name of the grid file, with a header of the form
+        '# 1' then '# lower width nbins periodic', or without a header
+
+    Returns
+    -------
+    grid : tuple
+        (lower, width, nbins, periodic) of the colvar grid, or None if
+        the file has no grid header
+    data : numpy array
+        array of shape (npoints, ncols), e.g. columns of x and gradient
+    """
+    with open(infile, 'r') as f:
+        line1 = f.readline().split()
+        line2 = f.readline().split()
+        body = f.read()
+    if not (len(line1) == 2 and line1[0] == '#' and len(line2) == 5 and line2[0] == '#'):
+        return None, np.loadtxt(infile, ndmin=2)
+
+    ndim = int(line1[1])
+    if ndim != 1:
+        raise ValueError(f"{infile} is a {ndim}-D grid; only 1-D grids are supported")
+    grid = (float(line2[1]), float(line2[2]), int(line2[3]), bool(int(line2[4])))
+
+    # number of columns from the first data line
+    first = next(line for line in body.splitlines() if line.strip())
+    ncols = len(first.split())
+
+    values = np.fromstring(body, sep=' ')
+    if values.size % ncols != 0:
+        raise ValueError(f"inconsistent number of columns in {infile}")
+    return grid, values.reshape(-1, ncols)
+
+
+def write_colvars_grid(outfile, xdata, ydata, width, fmt='%.6f'):
+    """Write a one-dimensional colvars grid file (e.g., .grad, .count)
+    of evenly spaced bin centers xdata.
+
+    Parameters
+    ----------
+    outfile : string
+        name of the grid file to write
+    xdata : numpy array
+        bin centers, evenly spaced by width
+    ydata : numpy array
+        value of each bin
+    width : float
+        bin width of the grid
+    fmt : string
+        format of the values, e.g. '%d' for counts
+    """
+    lower = xdata[0] - width/2
+    header = "# 1\n#  {:>10g}{:>10g}{:>10d}  0\n".format(lower, width, len(xdata))
+    np.savetxt(outfile, np.c_[xdata, ydata], fmt=['%.6f', fmt],
+               header=header, comments='')
+
+
+def find_count_file(grad_file):
+    """Find the sample count file that ABF writes next to a gradient file:
+    .zcount for .czar.grad (also as .czar.zcount, as linked by
+    ABF/winmerge/prep.sh) and for .zgrad, else .count for .grad."""
+    if grad_file.endswith('.czar.grad'):
+        base = grad_file[:-len('.czar.grad')]
+        candidates = [base+'.czar.zcount', base+'.zcount']
+    elif grad_file.endswith('.zgrad'):
+        candidates = [grad_file[:-len('.zgrad')]+'.zcount']
+    else:
+        candidates = [os.path.splitext(grad_file)[0]+'.count']
+    for c in candidates:
+        if os.path.exists(c):
+            return c
+    raise FileNotFoundError("no count file for {}; tried {}".format(
+        grad_file, ", ".join(candidates)))
+
+
+def _grid_index(x, x_ref, width):
+    """Get integer index of each x on a grid of spacing width that
+    includes x_ref. Raise an error if any x is not on the grid."""
+    steps = (x - x_ref) / width
+    index = np.rint(steps).astype(np.int64)
+    if not np.allclose(steps, index, rtol=0, atol=1e-6):
+        raise ValueError("x values are not on a common grid of width {}".format(width))
+    return index
+
+
 class Grad(Profile):
 
-    def __init__(self, infile=None, xdata=None, ydata=None):
+    def __init__(self, infile=None, xdata=None, ydata=None, width=None, counts=None):
         super().__init__(infile, xdata, ydata)
+        # grid spacing of xdata, if known from the colvars grid header
+        self.width = width
+        # number of samples in each bin, if known from a count file
+        self.counts = counts
+
+    @classmethod
+    def from_grid_file(cls, infile, count_file=None):
+        """Create a Grad from a colvars gradient file, keeping its grid width
+        (None for files without a grid header). If count_file is given, also
+        read the samples of each bin from it."""
+        grid, data = read_colvars_grid(infile)
+        counts = None
+        if count_file is not None:
+            count_grid, count_data = read_colvars_grid(count_file)
+            if count_grid != grid:
+                raise ValueError("grids of {} and {} differ".format(infile, count_file))
+            counts = count_data[:, 1]
+        width = None if grid is None else grid[1]
+        return cls(infile, data[:, 0], data[:, 1], width=width, counts=counts)
+
+    def write_grid(self, prefix):
+        """Write colvars grid files prefix.grad and, if counts are known,
+        prefix.count, as would be written by NAMD."""
+        write_colvars_grid(prefix+'.grad', self.xdata, self.ydata, self.width)
+        if self.counts is not None:
+            write_colvars_grid(prefix+'.count', self.xdata, self.counts, self.width, fmt='%d')
 
     def integrate(self):
 
         # integrate ydata
-        y_pmf = integrate.cumtrapz(self.ydata, self.xdata)
+        y_pmf = integrate.cumulative_trapezoid(self.ydata, self.xdata)
 
         # take midpoint of all adjacent data points in half_cvs due to integration
         # https://tinyurl.com/ycahltpp
@@ -125,14 +247,24 @@ class Grad(Profile):
         return new_pmf
 
     @staticmethod
-    def join_windows(list_grads):
+    def join_windows(list_grads, weighted=False):
         """Join windows by averaging overlapping regions of .czar.grad files.
         https://stackoverflow.com/questions/41821539/calculate-average-of-y-values-with-different-x-values
 
+        If all Grad objects know their grid width (e.g., from
+        Grad.from_grid_file), points are matched by integer index on the
+        common grid instead of by floating-point equality of x.
+
         Parameters
         ----------
         list_grads : list
             list of Grad objects to be combined
+        weighted : bool
+            weight each window's gradient by its samples in each bin, as
+            merging windows in NAMD does. Requires grid widths and counts,
+            e.g. from Grad.from_grid_file(infile, count_file). The joined
+            Grad spans the full grid, with zero gradient and zero counts in
+            bins without samples, and has the total counts of each bin.
 
         Returns
         -------
@@ -143,6 +275,34 @@ class Grad(Profile):
         # combine all xdata and all ydata
         x, grad, allfiles = Profile._decompose_list(list_grads)
 
+        widths = set(g.width for g in list_grads)
+        if weighted and (None in widths or any(g.counts is None for g in list_grads)):
+            raise ValueError("weighted join needs the grid width and counts of every window")
+        if None not in widths:
+            if len(widths) != 1:
+                raise ValueError("cannot join windows of different grid widths {}".format(widths))
+            width = widths.pop()
+            x_ref = list_grads[0].xdata[0]
+            index = _grid_index(x, x_ref, width)
+
+            if weighted:
+                # sum samples and sample-weighted gradients on the full grid
+                counts = np.concatenate([g.counts for g in list_grads])
+                lo = index.min()
+                n = np.bincount(index - lo, weights=counts)
+                grad_sum = np.bincount(index - lo, weights=counts*grad)
+                grad_mean = np.divide(grad_sum, n, out=np.zeros(len(n)), where=n > 0)
+                x_full = x_ref + (lo + np.arange(len(n)))*width
+                # keep x as written in the files where there is data
+                x_full[index - lo] = x
+                return Grad(allfiles, x_full, grad_mean, width=width, counts=n)
+
+            # average the values having same grid index, in ascending x,
+            # keeping x as written in the files
+            index, first, inverse = np.unique(index, return_index=True, return_inverse=True)
+            grad_mean = np.bincount(inverse, weights=grad) / np.bincount(inverse)
+            return Grad(allfiles, x[first], grad_mean, width=width)
+
         # average the values having same x gridpoint
         x_unique, grad_mean = npi.group_by(x).mean(grad)
 
@@ -323,16 +483,46 @@ class Pka(Profile):
         super().__init__(infile, xdata, ydata)
 
 
-def open_join_grads(list_files):
+def load_grads(list_files, nproc=1, counts=False):
+    """Read many colvars gradient files, optionally in parallel.
+
+    Parameters
+    ----------
+    list_files : list
+        list of strings of filenames of gradient files
+    nproc : int
+        number of processes to read files; None uses all cores
+    counts : bool
+        also read the count file of each gradient file (see find_count_file)
+
+    Returns
+    -------
+    list_grads : list
+        list of Grad objects, in the same order as list_files
+    """
+    if counts:
+        jobs = [(f, find_count_file(f)) for f in list_files]
+    else:
+        jobs = [(f, None) for f in list_files]
+    if nproc == 1:
+        return [Grad.from_grid_file(*job) for job in jobs]
+    with multiprocessing.Pool(nproc) as pool:
+        return pool.starmap(Grad.from_grid_file, jobs)
+
+
+def open_join_grads(list_files, nproc=1, weighted=False, merge_prefix=None):
     """Open a list of files with .grad data and join the windows.
     Should this be a static function? Maybe it doesn't make sense to call
     Grad.open_join_grads(...) so maybe better off as module-level function.
+
+    With weighted, windows are weighted by the samples in their count files,
+    and if merge_prefix is given, the joined gradient and counts are written
+    to merge_prefix.grad and merge_prefix.count.
     """
-    list_grads = []
-    for f in list_files:
-        g = Grad(f)
-        list_grads.append(g)
-    joined_grad = Grad.join_windows(list_grads)
+    list_grads = load_grads(list_files, nproc, counts=weighted)
+    joined_grad = Grad.join_windows(list_grads, weighted=weighted)
+    if weighted and merge_prefix is not None:
+        joined_grad.write_grid(merge_prefix)
     pmf = joined_grad.integrate()
 
     return pmf
@@ -342,7 +532,10 @@ def grads_to_pmf(
     side0_files, side1_files,
     bulk_range0, bulk_range1,
     T,
-    out_file='pmf.dat'):
+    out_file='pmf.dat',
+    nproc=1,
+    weighted=False,
+    out_dir='.'):
 
     """Main function to generate symmetrized PMF given input gradient files.
 
@@ -360,6 +553,15 @@ def grads_to_pmf(
         temperature of the system
     out_file : string
         filename of the output pmf data
+    nproc : int
+        number of processes to read gradient files
+    weighted : bool
+        weight windows by samples in their count files instead of a plain
+        average, and write merged gradients and counts of each leaflet to
+        merge0.grad, merge0.count, merge1.grad, and merge1.count
+    out_dir : string
+        directory to write pmf0.dat, pmf1.dat, pmf_unsym.dat, out_file, and
+        merged files, created if needed
 
     Returns
     -------
@@ -370,28 +572,30 @@ def grads_to_pmf(
     joined_pmf : Pmf
         new Pmf object with xdata and ydata of joined PMF
     """
+    os.makedirs(out_dir, exist_ok=True)
+
     # combine windows of each leaflet
-    pmf_0 = open_join_grads(side0_files)
-    pmf_1 = open_join_grads(side1_files)
+    pmf_0 = open_join_grads(side0_files, nproc, weighted, os.path.join(out_dir, 'merge0'))
+    pmf_1 = open_join_grads(side1_files, nproc, weighted, os.path.join(out_dir, 'merge1'))
 
     # shift bulk water region to have average pmf of zero
     pmf_0.shift_bulk_zero(*bulk_range0)
     pmf_1.shift_bulk_zero(*bulk_range1)
     print("Value of pre-shifted bulk water region may be an artifact of where "
           "(x-value) integration begins, where y-value is defined 0.\n")
-    pmf_0.write_data('pmf0.dat')
-    pmf_1.write_data('pmf1.dat')
+    pmf_0.write_data(os.path.join(out_dir, 'pmf0.dat'))
+    pmf_1.write_data(os.path.join(out_dir, 'pmf1.dat'))
 
     # combine upper and lower leaflets
     joined_pmf = Pmf.join_leaflets([pmf_0, pmf_1], T)
-    joined_pmf.write_data('pmf_unsym.dat')
+    joined_pmf.write_data(os.path.join(out_dir, 'pmf_unsym.dat'))
 
     # symmetrize pmf
     joined_pmf.symmetrize()
     #joined_pmf.errbar = np.zeros(len(joined_pmf.ydata))
 
     # write out pmf
-    joined_pmf.write_data('pmf.dat', errbar=True)
+    joined_pmf.write_data(os.path.join(out_dir, out_file), errbar=True)
 
     return pmf_0, pmf_1, joined_pmf
 
@@ -426,7 +630,11 @@ def pmfs_to_pka(pmf0_file, pmf1_file, T, out_file='pka_shift.dat'):
 if __name__ == "__main__":
 
     import argparse
-    import matplotlib.pyplot as plt
+    try:
+        import matplotlib.pyplot as plt
+    except ImportError:
+        # output files are still written; only the plots are skipped
+        plt = None
     parser = argparse.ArgumentParser()
 
     parser.add_argument("-0", "--side0", required=True, nargs='+',
@@ -439,11 +647,33 @@ if __name__ == "__main__":
                         help="Compute pKa shift profile from neutral PMF in -0"
                              " flag and charged PMF in -1 flag")
 
+    parser.add_argument("-n", "--nproc", type=int, default=1,
+                        help="Number of processes to read gradient files.")
+
+    parser.add_argument("-w", "--weighted", action="store_true", default=False,
+                        help="Weight windows by samples in the .count (or .zcount "
+                             "for .czar.grad) file next to each gradient file.")
+
+    parser.add_argument("-t", "--temp", type=float, default=295,
+                        help="Temperature of the system in Kelvin.")
+
+    parser.add_argument("--bulk0", type=float, nargs=2, default=[35, 39.9],
+                        help="Range of x values of the bulk region of the -0 PMF.")
+
+    parser.add_argument("--bulk1", type=float, nargs=2, default=[-35, -39.9],
+                        help="Range of x values of the bulk region of the -1 PMF.")
+
+    parser.add_argument("-o", "--outdir", default='.',
+                        help="Directory to write output PMF files.")
+
     args = parser.parse_args()
 
     # compute pka shift profile
     if args.pka and len(args.side0)==1 and len(args.side1)==1:
-        pka_shift = pmfs_to_pka(args.side0[0], args.side1[0], T = 295)
+        pka_shift = pmfs_to_pka(args.side0[0], args.side1[0], T = args.temp)
+        if plt is None:
+            print("matplotlib not found; skipping plot")
+            sys.exit()
 
         # plot final data
         plt.plot(pka_shift.xdata, pka_shift.ydata)
@@ -455,8 +685,12 @@ if __name__ == "__main__":
     else:
         pmf_0, pmf_1, joined_pmf = grads_to_pmf(
             args.side0, args.side1,
-            bulk_range0 = [35, 39.9], bulk_range1 = [-35, -39.9],
-            T = 295)
+            bulk_range0 = args.bulk0, bulk_range1 = args.bulk1,
+            T = args.temp, nproc = args.nproc, weighted = args.weighted,
+            out_dir = args.outdir)
+        if plt is None:
+            print("matplotlib not found; skipping plot")
+            sys.exit()
 
         # for plotting: only keep every Nth error bar else hard to interpret
         joined_pmf.subsample_errors(every_nth = 20)
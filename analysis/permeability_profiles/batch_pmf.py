@@ -0,0 +1,199 @@
+
+import os
+import json
+import contextlib
+import multiprocessing
+import numpy as np
+from abf_pmf_processor import grads_to_pmf
+
+# Generate PMFs of many systems (e.g., permeant tautomers) with grads_to_pmf,
+# one system per process, from a JSON manifest such as:
+#
+# {
+#     "defaults": {"T": 295, "bulk_range0": [35, 39.9], "bulk_range1": [-35, -39.9]},
+#     "systems": [
+#         {"name": "taut1", "side0": ["taut1/win01.grad", "taut1/win02.grad"],
+#                           "side1": ["taut1/win04.grad", "taut1/win05.grad"]},
+#         {"name": "taut2", "side0": ["taut2/win01.grad"], "side1": ["taut2/win04.grad"],
+#                           "T": 310, "weighted": true}
+#     ]
+# }
+#
+# Each system takes the defaults unless given its own value. Relative file
+# names are relative to the directory of the manifest. Output files of each
+# system are written to out_root/name/, with the printed output in log.txt.
+
+DEFAULTS = {
+    'T': 295,
+    'bulk_range0': [35, 39.9],
+    'bulk_range1': [-35, -39.9],
+    'weighted': False,
+    'out_file': 'pmf.dat',
+}
+
+SYSTEM_KEYS = {'name', 'side0', 'side1'}
+
+
+def load_manifest(infile):
+    """Read the systems of a JSON manifest.
+
+    Parameters
+    ----------
+    infile : string
+        filename of the JSON manifest
+
+    Returns
+    -------
+    systems : list
+        list of dicts of each system with all keys of DEFAULTS, and with
+        gradient filenames relative to the current directory
+    """
+    with open(infile) as f:
+        manifest = json.load(f)
+    base = os.path.dirname(infile)
+
+    defaults = dict(DEFAULTS)
+    defaults.update(manifest.get('defaults', {}))
+
+    systems = []
+    names = set()
+    for entry in manifest['systems']:
+        unknown = set(entry) - set(DEFAULTS) - SYSTEM_KEYS
+        if unknown:
+            raise ValueError("unknown keys for system {}: {}".format(
+                entry.get('name'), ", ".join(sorted(unknown))))
+        missing = SYSTEM_KEYS - set(entry)
+        if missing:
+            raise ValueError("missing keys for system {}: {}".format(
+                entry.get('name'), ", ".join(sorted(missing))))
+        if entry['name'] in names:
+            raise ValueError("system {} is listed more than once".format(entry['name']))
+        names.add(entry['name'])
+
+        system = dict(defaults)
+        system.update(entry)
+        for side in ['side0', 'side1']:
+            system[side] = [os.path.join(base, f) for f in system[side]]
+        systems.append(system)
+
+    return systems
+
+
+def run_system(system, out_root):
+    """Generate the PMF of one system and summarize it.
+
+    Parameters
+    ----------
+    system : dict
+        one system from load_manifest
+    out_root : string
+        directory in which to write the directory of the system
+
+    Returns
+    -------
+    summary : dict
+        name, status ('ok' or the error), and for successful systems, the
+        depth and location of the PMF minimum, the height and location of
+        the PMF maximum, and the largest symmetrization difference
+    """
+    out_dir = os.path.join(out_root, system['name'])
+    os.makedirs(out_dir, exist_ok=True)
+    summary = {'name': system['name'], 'out_dir': out_dir}
+
+    try:
+        with open(os.path.join(out_dir, 'log.txt'), 'w') as log, \
+                contextlib.redirect_stdout(log):
+            pmf_0, pmf_1, joined_pmf = grads_to_pmf(
+                system['side0'], system['side1'],
+                system['bulk_range0'], system['bulk_range1'],
+                system['T'], out_file=system['out_file'],
+                weighted=system['weighted'], out_dir=out_dir)
+    except Exception as e:
+        summary['status'] = "{}: {}".format(type(e).__name__, e)
+        return summary
+
+    imin = np.argmin(joined_pmf.ydata)
+    imax = np.argmax(joined_pmf.ydata)
+    summary.update({
+        'status': 'ok',
+        'x_min': joined_pmf.xdata[imin],
+        'pmf_min': joined_pmf.ydata[imin],
+        'x_max': joined_pmf.xdata[imax],
+        'pmf_max': joined_pmf.ydata[imax],
+        'sym_err': np.max(getattr(joined_pmf, 'errbar', np.nan)),
+    })
+    return summary
+
+
+def run_batch(systems, out_root='.', nproc=None):
+    """Generate the PMFs of many systems, one system per process.
+
+    Parameters
+    ----------
+    systems : list
+        list of dicts of systems from load_manifest
+    out_root : string
+        directory in which to write a directory for each system
+    nproc : int
+        number of processes; None uses all cores
+
+    Returns
+    -------
+    summaries : list
+        list of dicts from run_system, in the same order as systems
+    """
+    jobs = [(system, out_root) for system in systems]
+    if nproc == 1:
+        return [run_system(*job) for job in jobs]
+    with multiprocessing.Pool(nproc) as pool:
+        return pool.starmap(run_system, jobs, chunksize=1)
+
+
+def write_summary(summaries, outfile=None):
+    """Format the summaries of systems as a table, and write it to outfile
+    if given.
+
+    Returns
+    -------
+    table : string
+        table with one line per system
+    """
+    lines = ["{:<20s} {:>8s} {:>10s} {:>8s} {:>10s} {:>10s}  {}".format(
+        '# system', 'x_min', 'pmf_min', 'x_max', 'pmf_max', 'sym_err', 'status')]
+    for s in summaries:
+        if s['status'] == 'ok':
+            lines.append("{:<20s} {:8.2f} {:10.4f} {:8.2f} {:10.4f} {:10.4f}  {}".format(
+                s['name'], s['x_min'], s['pmf_min'], s['x_max'], s['pmf_max'],
+                s['sym_err'], s['status']))
+        else:
+            lines.append("{:<20s} {:>8s} {:>10s} {:>8s} {:>10s} {:>10s}  {}".format(
+                s['name'], *['nan']*5, s['status']))
+    table = "\n".join(lines) + "\n"
+
+    if outfile is not None:
+        with open(outfile, 'w') as f:
+            f.write(table)
+    return table
+
+
+if __name__ == "__main__":
+    import sys
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-m", "--manifest", required=True,
+                        help="JSON manifest of systems.")
+
+    parser.add_argument("-o", "--outdir", default='.',
+                        help="Directory in which to write a directory for each system.")
+
+    parser.add_argument("-n", "--nproc", type=int, default=None,
+                        help="Number of systems to process at once. Default is all cores.")
+
+    args = parser.parse_args()
+    systems = load_manifest(args.manifest)
+    summaries = run_batch(systems, args.outdir, args.nproc)
+    print(write_summary(summaries, os.path.join(args.outdir, 'summary.dat')), end='')
+
+    # exit with error if any system failed
+    sys.exit(0 if all(s['status'] == 'ok' for s in summaries) else 1)
@@ -19,45 +19,244 @@ By:         Victoria T. Lim
 Version:    Oct 02 2018
 Reference:  10.1021/ct400925s
 
-TODO:
-- be able to carry out error propagation
+Stacks of profiles (several files, or columns with --replicates) are all
+computed at once, for the mean and interval of the permeability. With
+--errors, error bars of the profiles are propagated linearly.
+
+Profiles on different colvar grids or in other units (e.g., nm and nm^2/ns)
+are converted and resampled onto one grid with resample.py.
 
 """
 
 import sys
 import numpy as np
+import resample
+from calc_pmf_partition import trapz_weights
 
-def main(**kwargs):
+def load_profile(infile):
+    """Load a profile of whitespace- or comma-separated columns.
 
-    ### Load data and check that they have the same colvar grid.
+    Returns
+    -------
+    x : numpy array
+        colvar values in the first column
+    columns : numpy array
+        array of shape (ncols-1, npoints) of the other columns
+    """
     try:
-        file_pmf  = np.loadtxt(args.pmf)
-        file_dif  = np.loadtxt(args.dif)
+        data = np.loadtxt(infile, ndmin=2)
     except ValueError: # for CSV files
-        file_pmf  = np.genfromtxt(args.pmf,delimiter=',')
-        file_dif  = np.genfromtxt(args.dif,delimiter=',')
+        data = np.genfromtxt(infile, delimiter=',')
+    return data[:,0], data[:,1:].T
+
+
+def load_stack(infiles, replicates=False, method='linear', xunits='A',
+               yunits='kcal/mol'):
+    """Load profiles of one or more files onto the colvar grid of the first.
+
+    Parameters
+    ----------
+    infiles : list
+        list of filenames
+    replicates : bool
+        if True, every column after the first of each file is one profile
+        (e.g., bootstrap replicates); else only the second column is a
+        profile, and the third column, if present, is its error bar
+    method : string
+        resampling method for files on a different grid than the first,
+        see resample.resample
+    xunits : string
+        units of the colvar values in the files, see resample.UNITS
+    yunits : string
+        units of the profiles in the files, see resample.UNITS
+
+    Returns
+    -------
+    x : numpy array
+        colvar values shared by all profiles, in Angstrom; the part of the
+        grid of the first file covered by all files
+    profiles : numpy array
+        array of shape (nprofiles, npoints)
+    errs : numpy array
+        array of shape (nprofiles, npoints) of error bars, or None if
+        replicates or if any file has no third column
+    """
+    kind = resample.unit_kind(yunits)
+    loaded = [(resample.convert(xf, xunits, 'length'), resample.convert(cols, yunits, kind))
+              for xf, cols in (load_profile(f) for f in infiles)]
+    x = loaded[0][0]
+    if any(not np.array_equal(x, xf) for xf, _ in loaded):
+        lo = max(xf.min() for xf, _ in loaded)
+        hi = min(xf.max() for xf, _ in loaded)
+        x = x[(x >= lo) & (x <= hi)]
+        loaded = [(x, cols if np.array_equal(x, xf) else resample.resample(xf, cols, x, method))
+                  for xf, cols in loaded]
+
+    if replicates:
+        return x, np.vstack([cols for _, cols in loaded]), None
+    profiles = np.array([cols[0] for _, cols in loaded])
+    errs = None
+    if all(len(cols) > 1 for _, cols in loaded):
+        errs = np.array([cols[1] for _, cols in loaded])
+    return x, profiles, errs
+
+
+def align(x, profiles, errs, target, method='linear'):
+    """Resample a stack of profiles and their error bars onto a target grid.
+    Error bars are resampled like the profiles, without reducing them for
+    averaging. See load_stack for the parameters."""
+    if np.array_equal(x, target):
+        return profiles, errs
+    profiles = resample.resample(x, profiles, target, method)
+    if errs is not None:
+        errs = resample.resample(x, errs, target, method)
+    return profiles, errs
+
+
+def permeability(x, pmf, dif, beta):
+    """Compute the resistivity and permeability of stacks of profiles.
+
+    Parameters
+    ----------
+    x : numpy array
+        colvar values
+    pmf : numpy array
+        PMFs in kcal/mol of shape (npoints,) or (nprofiles, npoints)
+    dif : numpy array
+        diffusivities in Angstrom^2/ns of shape (npoints,) or
+        (nprofiles, npoints); profiles of pmf and dif are paired, or one
+        profile is used with all profiles of the other
+    beta : float
+        thermodynamic beta in mol/kcal
+
+    Returns
+    -------
+    resist : numpy array
+        resistivity of each profile in ns/Angstrom
+    perme : numpy array
+        permeability of each profile in Angstrom/ns
+    contrib : numpy array
+        fraction of the resistivity of each profile from each point,
+        of shape (nprofiles, npoints), summing to one
+    """
+    pmf = np.atleast_2d(pmf)
+    dif = np.atleast_2d(dif)
+    if len(pmf) != len(dif) and 1 not in (len(pmf), len(dif)):
+        raise ValueError(f"cannot pair {len(pmf)} PMFs with {len(dif)} diffusivities")
+
+    quotient = np.exp(beta*pmf) / dif
+    terms = quotient * trapz_weights(x)
+    resist = terms.sum(axis=1)
+    return resist, 1./resist, terms / resist[:,np.newaxis]
+
+
+def propagate_errors(x, pmf, pmf_err, dif, dif_err, beta):
+    """Propagate independent errors of the PMF and diffusivity at each
+    point to the permeability by first-order (linear) propagation.
+
+    With q_i = exp[beta w_i] / D_i and trapezoid weights c_i, the
+    resistivity is R = sum_i c_i q_i, so
+        dR/dw_i = beta c_i q_i     and     dR/dD_i = -c_i q_i / D_i
+    and sigma_P = sigma_R / R^2.
+
+    Parameters
+    ----------
+    x, pmf, dif, beta : see permeability
+    pmf_err : numpy array
+        error bars of the PMFs, same shape as pmf, or None for no error
+    dif_err : numpy array
+        error bars of the diffusivities, same shape as dif, or None
+
+    Returns
+    -------
+    perme : numpy array
+        permeability of each profile in Angstrom/ns
+    perme_err : numpy array
+        propagated error of each permeability
+    """
+    resist, perme, contrib = permeability(x, pmf, dif, beta)
+    terms = contrib * resist[:,np.newaxis]
+
+    rel_var = 0.
+    if pmf_err is not None:
+        rel_var = rel_var + (beta*np.atleast_2d(pmf_err))**2
+    if dif_err is not None:
+        rel_var = rel_var + (np.atleast_2d(dif_err)/np.atleast_2d(dif))**2
+    resist_err = np.sqrt(np.sum(terms**2 * rel_var, axis=1))
+    return perme, resist_err / resist**2
+
+
+def summarize(perme, level=0.95):
+    """Get the mean, standard deviation, and percentile confidence interval
+    of permeabilities of many profiles (e.g., bootstrap replicates)."""
+    alpha = 100*(1-level)/2
+    lower, upper = np.percentile(perme, [alpha, 100-alpha])
+    return np.mean(perme), np.std(perme, ddof=1), lower, upper
 
-    pmf =  file_pmf[:,1]
-    dif =  file_dif[:,1]
-    colvar_values =  file_pmf[:,0]
-    colvar_values1 = file_dif[:,0]
-    if not np.array_equal(colvar_values,colvar_values1):
-        sys.exit("ERROR: collective variable grid of PMF and diffusivity files do not match")
+
+def load_aligned(args):
+    """Load the PMF and diffusivity files of the command line arguments and
+    resample them onto the same colvar grid. Returns the colvar values and
+    the PMFs, PMF errors, diffusivities, and diffusivity errors."""
+    pmf_x, pmf, pmf_err = load_stack(args.pmf, args.replicates in ['pmf', 'both'],
+                                     args.method, args.pmf_xunits, args.pmf_units)
+    dif_x, dif, dif_err = load_stack(args.dif, args.replicates in ['dif', 'both'],
+                                     args.method, args.dif_xunits, args.dif_units)
+    if np.array_equal(pmf_x, dif_x):
+        colvar_values = pmf_x
+    else:
+        if args.grid == 'common':
+            colvar_values = resample.common_grid([pmf_x, dif_x], args.spacing)
+        else:
+            colvar_values = pmf_x if args.grid == 'pmf' else dif_x
+            other = dif_x if args.grid == 'pmf' else pmf_x
+            colvar_values = colvar_values[(colvar_values >= other.min()) & (colvar_values <= other.max())]
+        pmf, pmf_err = align(pmf_x, pmf, pmf_err, colvar_values, args.method)
+        dif, dif_err = align(dif_x, dif, dif_err, colvar_values, args.method)
+        print("\n\tResampled PMF ({} points) and diffusivity ({} points) by {} "
+              "onto {} points from {:.3f} to {:.3f} Angstrom".format(len(pmf_x),
+              len(dif_x),args.method,len(colvar_values),colvar_values[0],colvar_values[-1]))
+    return colvar_values, pmf, pmf_err, dif, dif_err
+
+
+def main(**kwargs):
+
+    ### Load data and resample them onto the same colvar grid.
+    try:
+        colvar_values, pmf, pmf_err, dif, dif_err = load_aligned(args)
+    except ValueError as e:
+        sys.exit(f"ERROR: {e}")
 
     ### Calculate thermodynamic beta.
     kb = 0.0019872041     # units of kcal/(mol.K), https://tinyurl.com/y8f7sse7
     beta = 1./(kb*args.temp)
 
     ### Compute the permeability.
-    beta_pmf = beta*pmf
-    exp_pmf = np.exp(beta_pmf)
-    quotient = exp_pmf / dif
-    #resist = np.sum(quotient)
-    resist = np.trapz(quotient, colvar_values)
-    perme = 1./resist
-    print("\n\tPermeability = {:.3E} Angstrom/ns = {:.3E} cm/s".format(perme,perme*10))
+    try:
+        resist, perme, contrib = permeability(colvar_values, pmf, dif, beta)
+    except ValueError as e:
+        sys.exit(f"ERROR: {e}")
+    if len(perme) == 1:
+        print("\n\tPermeability = {:.3E} Angstrom/ns = {:.3E} cm/s".format(perme[0],perme[0]*10))
+    else:
+        mean, std, lower, upper = summarize(perme, args.level)
+        print("\n\tPermeability of {} profiles = {:.3E} +/- {:.3E} Angstrom/ns".format(len(perme),mean,std))
+        print("\t{:g}% interval = [{:.3E}, {:.3E}] Angstrom/ns = [{:.3E}, {:.3E}] cm/s".format(
+              100*args.level,lower,upper,lower*10,upper*10))
+
+    ### Propagate error bars of the profiles.
+    if args.errors and (pmf_err is not None or dif_err is not None):
+        perme, perme_err = propagate_errors(colvar_values, pmf, pmf_err, dif, dif_err, beta)
+        for p, e in zip(perme, perme_err):
+            print("\tPropagated error = {:.3E} +/- {:.3E} Angstrom/ns".format(p,e))
     print("\n\tFor ref, water is = 1.36E-3 Angstrom/ns = 136E-4 cm/s\n")
 
+    ### Write the resistance contribution of each point.
+    if args.contrib is not None:
+        np.savetxt(args.contrib, np.c_[colvar_values, contrib.mean(axis=0), contrib.std(axis=0)],
+                   header="colvar  fraction_of_resistivity  std_over_profiles",
+                   fmt=['%.4f','%.6E','%.6E'])
+
 
 
 if __name__ == "__main__":
@@ -65,19 +264,61 @@ if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
 
-    parser.add_argument("-p", "--pmf",
+    parser.add_argument("-p", "--pmf", nargs='+',
                         help="Filename of potential of mean force across full "
-                             "membrane. Units should be in kcal/mol.")
+                             "membrane. Units should be in kcal/mol. Give "
+                             "several files for a stack of profiles.")
 
-    parser.add_argument("-d", "--dif",
+    parser.add_argument("-d", "--dif", nargs='+',
                         help="Filename of diffusivity across full membrane. "
-                             "Units should be in Angstrom^2/ns.")
+                             "Units should be in Angstrom^2/ns. Give several "
+                             "files for a stack of profiles.")
 
     parser.add_argument("-t", "--temp", type=float,
                         help="Temperature in Kelvin")
 
+    parser.add_argument("-r", "--replicates", choices=['pmf', 'dif', 'both'], default=None,
+                        help="Every column after the first of each PMF file, "
+                             "diffusivity file, or both is one profile, e.g., "
+                             "bootstrap replicates.")
+
+    parser.add_argument("-e", "--errors", action="store_true", default=False,
+                        help="Propagate error bars in the third column of the "
+                             "PMF and/or diffusivity files to the permeability.")
+
+    parser.add_argument("-l", "--level", type=float, default=0.95,
+                        help="Confidence level of the interval over profiles.")
+
+    parser.add_argument("-c", "--contrib", default=None,
+                        help="Write the fraction of the resistivity from each "
+                             "colvar value to this file.")
+
+    parser.add_argument("-m", "--method", choices=['linear', 'cubic', 'bin'], default='linear',
+                        help="Resampling method for profiles on different "
+                             "colvar grids. See resample.py.")
+
+    parser.add_argument("-g", "--grid", choices=['pmf', 'dif', 'common'], default='pmf',
+                        help="Resample onto the colvar grid of the PMF, of the "
+                             "diffusivity, or an even grid over both, within "
+                             "the range covered by both.")
+
+    parser.add_argument("-s", "--spacing", type=float, default=None,
+                        help="Spacing of the common grid in Angstrom. Default "
+                             "is the finer spacing of the PMF and diffusivity.")
+
+    parser.add_argument("--pmf-units", default='kcal/mol', choices=list(resample.UNITS['energy']),
+                        help="Units of the PMF files.")
+
+    parser.add_argument("--dif-units", default='A2/ns', choices=list(resample.UNITS['diffusivity']),
+                        help="Units of the diffusivity files.")
+
+    parser.add_argument("--pmf-xunits", default='A', choices=list(resample.UNITS['length']),
+                        help="Units of the colvar values of the PMF files.")
+
+    parser.add_argument("--dif-xunits", default='A', choices=list(resample.UNITS['length']),
+                        help="Units of the colvar values of the diffusivity files.")
+
 
     args = parser.parse_args()
     opt = vars(args)
     main(**opt)
-
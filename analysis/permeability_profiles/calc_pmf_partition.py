@@ -5,6 +5,7 @@ import numpy as np
 
 """
 Usage:   python calc_pmf_partition.py -i pmf.dat --z1 '35' --z2 '-35' -t 295
+         python calc_pmf_partition.py -i pmf1.dat pmf2.dat --z1 ' -35' ' -30' --z2 30 35 -o scan.csv
 
 Purpose: Obtain partition coefficients and partition free energies from
          an input potential of mean force for membrane permeation.
@@ -34,7 +35,8 @@ References:
    - https://github.com/vtlim/permeability/blob/master/analysis/permeability_profiles/calc_perme.py
 4. Useful error propagation guide:
    - https://terpconnect.umd.edu/~toh/models/ErrorPropagation.pdf
-5. Python package for uncertainty propagation
+5. Python package for uncertainty propagation, which gives the same results
+   as the linear propagation here (which no longer uses it)
    - https://pythonhosted.org/uncertainties/
    - https://kitchingroup.cheme.cmu.edu/pycse/pycse.html
 
@@ -47,7 +49,132 @@ Notes:
 
 """
 
-def calc_pmf_partition(infile, z1, z2, temperature):
+def trapz_weights(z):
+    """Get the weight of each point in a trapezoid integral over z."""
+    dz = np.diff(z)
+    weights = np.zeros(len(z))
+    weights[:-1] += dz/2
+    weights[1:] += dz/2
+    return weights
+
+
+def partition(z, pmf, beta):
+    """
+    Compute the partition coefficient and free energy of one or more PMFs
+    on the same z grid, from the first to the last point of z.
+
+    Parameters
+    ----------
+    z : numpy array
+        z-coordinates from z1 to z2
+    pmf : numpy array
+        potential of mean force at z, of shape (npoints,) or a stack of
+        shape (nsamples, npoints)
+    beta : float
+        thermodynamic beta, 1/kT
+
+    Returns
+    -------
+    partcoeff : float or numpy array
+        partition coefficient K(wat --> mem) of each PMF
+    dg : float or numpy array
+        partition free energy dG(wat --> mem) of each PMF
+
+    """
+    # take relative pmf to the z1 value, W(z) - W(z1)
+    rel_pmf = pmf - pmf[..., :1]
+
+    # scale by -1/kT, take exponent, and integrate
+    integrated = np.exp(-1 * rel_pmf * beta) @ trapz_weights(z)
+
+    # scale by difference of z2 - z1, then take free energy
+    partcoeff = integrated / (z[-1] - z[0])
+    dg = (-1/beta) * np.log(partcoeff)
+
+    return partcoeff, dg
+
+
+def propagate_linear(z, pmf, err, beta):
+    """
+    Propagate independent errors of the PMF at each z to the partition
+    coefficient and free energy by first-order (linear) propagation, as
+    done by the uncertainties package, with array math.
+
+    With trapezoid weights w_i and e_i = exp[-beta*(W_i - W_1)],
+    K = sum_i w_i e_i / (z2 - z1), so
+        dK/dW_i = -beta w_i e_i / (z2 - z1)             for i > 1
+        dK/dW_1 = beta (sum_j w_j e_j - w_1) / (z2 - z1)
+    and sigma_dG = kT sigma_K / K.
+
+    Parameters
+    ----------
+    z : numpy array
+        z-coordinates from z1 to z2
+    pmf : numpy array
+        potential of mean force at z
+    err : numpy array
+        error bars of the pmf at z
+    beta : float
+        thermodynamic beta, 1/kT
+
+    Returns
+    -------
+    partcoeff, dg : float
+        see partition
+    partcoeff_err, dg_err : float
+        propagated errors of partcoeff and dg
+
+    """
+    partcoeff, dg = partition(z, pmf, beta)
+
+    # trapezoid weights of each point
+    weights = trapz_weights(z)
+
+    # derivatives of the integral with respect to each pmf value
+    exp_pmf = np.exp(-1 * (pmf - pmf[0]) * beta)
+    deriv = -beta * weights * exp_pmf
+    deriv[0] += beta * np.sum(weights * exp_pmf)
+    deriv /= (z[-1] - z[0])
+
+    partcoeff_err = np.sqrt(np.sum((deriv * err)**2))
+    dg_err = (1/beta) * partcoeff_err / partcoeff
+    return partcoeff, dg, partcoeff_err, dg_err
+
+
+def propagate_mc(z, pmf, err, beta, nsamples=10000, seed=None):
+    """
+    Propagate independent Gaussian errors of the PMF at each z to the
+    partition coefficient and free energy by Monte Carlo sampling of PMFs,
+    all samples at once. Unlike linear propagation, this accounts for the
+    nonlinearity of exp and log.
+
+    Parameters
+    ----------
+    z, pmf, err, beta : see propagate_linear
+    nsamples : int
+        number of sampled PMFs
+    seed : int
+        seed of the random number generator
+
+    Returns
+    -------
+    partcoeff, dg : float
+        see partition, of the input PMF
+    partcoeff_err, dg_err : float
+        standard deviations of partcoeff and dg over sampled PMFs
+
+    """
+    partcoeff, dg = partition(z, pmf, beta)
+
+    rng = np.random.default_rng(seed)
+    samples = pmf + err * rng.standard_normal((nsamples, len(pmf)))
+    partcoeff_mc, dg_mc = partition(z, samples, beta)
+
+    return partcoeff, dg, np.std(partcoeff_mc, ddof=1), np.std(dg_mc, ddof=1)
+
+
+def calc_pmf_partition(infile, z1, z2, temperature, method='linear',
+                       nsamples=10000, seed=None):
     """
     Parameters
     ----------
@@ -62,6 +189,23 @@ def calc_pmf_partition(infile, z1, z2, temperature):
         z2 should be greater than z1
     temperature : float
         used to calculate k_B * T
+    method : string
+        'linear' or 'mc' propagation of error bars, if present in infile
+    nsamples : int
+        number of sampled PMFs for 'mc'
+    seed : int
+        seed of the random number generator for 'mc'
+
+    Returns
+    -------
+    partcoeff : float
+        partition coefficient K(wat --> mem)
+    dg : float
+        partition free energy dG(wat --> mem)
+    partcoeff_err : float
+        error of partcoeff, or None without error bars
+    dg_err : float
+        error of dg, or None without error bars
 
     """
 
@@ -75,12 +219,6 @@ def calc_pmf_partition(infile, z1, z2, temperature):
     pmf = data[1]
     num_cols = data.shape[0]
 
-    # column with error bars is present (otherwise 2 columns)
-    calc_uncert = False
-    if num_cols == 3:
-        err_bars = data[2]
-        calc_uncert = True
-
     # get the index of the z1 and z2 values
     # result looks like: (array([49]),)
     z1_idx = np.where(np.isclose(z_crd, z1))[0][0]
@@ -94,97 +232,181 @@ def calc_pmf_partition(infile, z1, z2, temperature):
     trunc_pmf = pmf[z1_idx : (z2_idx+1)]
     trunc_z = z_crd[z1_idx : (z2_idx+1)]
 
-    # take relative pmf to the z1 value, W(z) - W(z1)
-    rel_pmf = trunc_pmf - trunc_pmf[0]
+    # column with error bars is present (otherwise 2 columns)
+    if num_cols < 3:
+        partcoeff, dg = partition(trunc_z, trunc_pmf, beta)
+        print(f"partition coefficient  K(wat --> mem) = {partcoeff:.3E}")
+        print(f"partition free energy dG(wat --> mem) = {dg:.3E}")
+        return partcoeff, dg, None, None
+
+    # truncate error bars in same way pmf was truncated
+    trunc_err = data[2][z1_idx : (z2_idx+1)]
+    if method == 'linear':
+        results = propagate_linear(trunc_z, trunc_pmf, trunc_err, beta)
+    elif method == 'mc':
+        results = propagate_mc(trunc_z, trunc_pmf, trunc_err, beta, nsamples, seed)
+    else:
+        raise ValueError(f"unknown error propagation method {method}")
+    partcoeff, dg, partcoeff_err, dg_err = results
+
+    print(f"partition coefficient  K(wat --> mem) = {partcoeff:.3E} +/- {partcoeff_err:.3E}")
+    print(f"partition free energy dG(wat --> mem) = {dg:.3E} +/- {dg_err:.3E}\n\n")
+    return results
+
+
+def find_index(z, values):
+    """Get the index in z of each value, raising an error if not found."""
+    match = np.isclose(z[np.newaxis, :], np.atleast_1d(values)[:, np.newaxis])
+    if not np.all(match.any(axis=1)):
+        missing = np.atleast_1d(values)[~match.any(axis=1)]
+        raise ValueError(f"z values not found in PMF grid: {missing}")
+    return match.argmax(axis=1)
+
+
+def partition_batch(z, pmfs, pairs, beta, errs=None):
+    """
+    Compute partition coefficients and free energies of a stack of PMFs on
+    a shared z grid for many (z1, z2) pairs at once. Each integral is a
+    row of trapezoid weights that is zero outside of [z1, z2], so all PMFs
+    and pairs are integrated by one matrix product.
 
-    # scale the relative pmf by -1/kT = -1*beta
-    scale_pmf = -1 * rel_pmf * beta
+    Parameters
+    ----------
+    z : numpy array
+        z-coordinates of the PMFs, from low to high z
+    pmfs : numpy array
+        array of shape (nprofiles, npoints) of PMFs
+    pairs : list
+        list of (z1, z2) tuples with z1 < z2
+    beta : float
+        thermodynamic beta, 1/kT
+    errs : numpy array
+        optional array of shape (nprofiles, npoints) of error bars of the
+        PMFs, propagated linearly as in propagate_linear
+
+    Returns
+    -------
+    results : dict
+        'partcoeff' and 'dg', and with errs 'partcoeff_err' and 'dg_err',
+        each of shape (nprofiles, npairs)
+
+    """
+    pmfs = np.atleast_2d(pmfs)
+    pairs = np.asarray(pairs, dtype=np.float64).reshape(-1, 2)
+    if np.any(pairs[:, 0] >= pairs[:, 1]):
+        raise ValueError("z1 should be less than z2 for every pair")
+    i1 = find_index(z, pairs[:, 0])
+    i2 = find_index(z, pairs[:, 1])
+    length = z[i2] - z[i1]
+
+    # trapezoid weights of each pair, of shape (npairs, npoints)
+    dz = np.diff(z)
+    inside = (np.arange(len(dz))[np.newaxis, :] >= i1[:, np.newaxis]) & \
+             (np.arange(len(dz))[np.newaxis, :] < i2[:, np.newaxis])
+    weights = np.zeros((len(pairs), len(z)))
+    weights[:, :-1] += inside * dz/2
+    weights[:, 1:] += inside * dz/2
+
+    # exp[-beta*(W - W(z1))] = ref * exp[-beta*(W - W_min)], kept in range
+    pmf_min = pmfs.min(axis=1, keepdims=True)
+    exp_pmf = np.exp(-1 * (pmfs - pmf_min) * beta)
+    ref = np.exp((pmfs[:, i1] - pmf_min) * beta)
+
+    partcoeff = ref * (exp_pmf @ weights.T) / length
+    results = {'partcoeff': partcoeff, 'dg': (-1/beta) * np.log(partcoeff)}
+    if errs is None:
+        return results
+
+    # dK/dW_i = -beta w_i e_i / L, except at z1: beta K - beta w_1 / L
+    errs = np.atleast_2d(errs)
+    w1 = weights[np.arange(len(pairs)), i1]
+    err1 = errs[:, i1]
+    var = (beta * ref / length)**2 * ((exp_pmf * errs)**2 @ (weights**2).T)
+    var -= (beta * w1 * err1 / length)**2
+    var += (beta * partcoeff - beta * w1 / length)**2 * err1**2
+    results['partcoeff_err'] = np.sqrt(np.maximum(var, 0))
+    results['dg_err'] = (1/beta) * results['partcoeff_err'] / partcoeff
+    return results
+
+
+def load_pmfs(infiles):
+    """
+    Read PMFs on a shared z grid from files as for calc_pmf_partition.
+
+    Returns
+    -------
+    z : numpy array
+        z-coordinates shared by all files
+    pmfs : numpy array
+        array of shape (nfiles, npoints) of PMFs
+    errs : numpy array
+        array of shape (nfiles, npoints) of error bars, or None if any file
+        has no third column
 
-    # take exponent of each value
-    exp_pmf = np.exp(scale_pmf)
+    """
+    data = [np.loadtxt(f).T for f in infiles]
+    z = data[0][0]
+    for f, d in zip(infiles, data):
+        if d.shape[1] != len(z) or not np.allclose(d[0], z):
+            raise ValueError(f"z grid of {f} differs from that of {infiles[0]}")
+    pmfs = np.array([d[1] for d in data])
+    errs = None
+    if all(d.shape[0] >= 3 for d in data):
+        errs = np.array([d[2] for d in data])
+    return z, pmfs, errs
+
+
+def scan_partition(infiles, pairs, temperature, outfile=None):
+    """
+    Compute partition coefficients and free energies for every PMF file and
+    every (z1, z2) pair, and write them as a CSV table.
 
-    # integrate
-    integrated = np.trapz(exp_pmf, trunc_z)
+    Parameters
+    ----------
+    infiles : list
+        list of names of PMF files on a shared z grid
+    pairs : list
+        list of (z1, z2) tuples with z1 < z2
+    temperature : float
+        used to calculate k_B * T
+    outfile : string
+        name of the CSV file to write; default is to print the table
 
-    # calculate partition coefficient by scaling by difference of z2 - z1
-    denom = (z2 - z1)
-    partcoeff = integrated / denom
+    Returns
+    -------
+    table : numpy structured array
+        one row for each file and pair, with fields infile, z1, z2,
+        partcoeff, partcoeff_err, dg, dg_err (errors are nan without
+        error bars)
 
-    # calculate partition free energy from partition coefficient
-    # np.log is ln, np.log10 is base 10 log
-    dg = (-1/beta) * np.log(partcoeff)
+    """
+    kb = 0.0019872041     # units of kcal/(mol.K), https://tinyurl.com/y8f7sse7
+    beta = 1./(kb*temperature)
 
-    print(f"partition coefficient  K(wat --> mem) = {partcoeff:.3E}")
-    print(f"partition free energy dG(wat --> mem) = {dg:.3E}")
-
-    # NOTE/TODO: this section repeats above section if uncerts are present
-    # can add control statements to do one or other only
-
-    if calc_uncert == True:
-        import uncertainties as u
-        from uncertainties import unumpy
-
-#        # initial attempt at error propagation; was stuck at integral
-#
-#        def root_sum_sq(err1, err2):
-#            # https://stackoverflow.com/a/51077781/8397754
-#            return (err1*err1 + err2*err2) ** 0.5
-#
-#        # (1) calculate root sum square from taking pmf relative to z1
-#        first_err = trunc_err[0]
-#        rel_pmf_err = np.apply_along_axis(root_sum_sq, 0, trunc_err, first_err)
-#
-#        # (2) multiplicative constant: ERR_PROP = abs(constant) * err_orig
-#        scale_pmf_err = rel_pmf_err * abs(beta)
-#
-#        # (3) exponential: ERR_PROP = exp(ydata) * err_orig
-#        exp_pmf_err = exp_pmf * scale_pmf_err
-#
-#        # (4) integration: let's have that handled by uncertainties package
-#        # example: https://kitchingroup.cheme.cmu.edu/pycse/pycse.html
-#        templist = []
-#        for v, w in zip(exp_pmf, exp_pmf_err):
-#            templist.append( u.ufloat((v, w)) )
-#        exp_pmf_with_err = np.array(templist)
-#        integrated_u = np.trapz(exp_pmf_with_err, trunc_z)
-#
-#        # (5) multiplicative constant, scale by denominator
-#        partcoeff_u = integrated_u / denom
-#
-#        # (6) natural log: ERR_PROP = err_orig / ydata
-#        dg_u = (-1/beta) * unumpy.log(partcoeff_u)
-
-
-
-        # truncate error bars in same way pmf was truncated
-        trunc_err = err_bars[z1_idx : (z2_idx+1)]
-        templist = []
-
-        # combine data with its uncertainties
-        for v, w in zip(trunc_pmf, trunc_err):
-            templist.append( u.ufloat((v, w)) )
-        trunc_pmf_with_err = np.array(templist)
-
-        # take relative pmf to the z1 value, W(z) - W(z1)
-        rel_pmf_with_err = trunc_pmf_with_err - trunc_pmf_with_err[0]
-
-        # scale the relative pmf by -1/kT = -1*beta
-        scale_pmf_with_err = -1 * rel_pmf_with_err * beta
-
-        # take exponent of each value
-        exp_pmf_with_err = unumpy.exp(scale_pmf_with_err)
-
-        # integrate
-        integrated_u = np.trapz(exp_pmf_with_err, trunc_z)
-
-        # calculate partition coefficient by scaling by difference of z2 - z1
-        partcoeff_u = integrated_u / denom
-
-        # calculate partition free energy from partition coefficient
-        dg_u = (-1/beta) * unumpy.log(partcoeff_u)
-
-        print(f"partition coefficient  K(wat --> mem) = {partcoeff_u}")
-        print(f"partition free energy dG(wat --> mem) = {dg_u}\n\n")
+    z, pmfs, errs = load_pmfs(infiles)
+    results = partition_batch(z, pmfs, pairs, beta, errs)
+    nan = np.full(results['partcoeff'].shape, np.nan)
+
+    pairs = np.asarray(pairs, dtype=np.float64).reshape(-1, 2)
+    nfiles, npairs = len(infiles), len(pairs)
+    names = ['infile', 'z1', 'z2', 'partcoeff', 'partcoeff_err', 'dg', 'dg_err']
+    table = np.zeros(nfiles*npairs, dtype=[('infile', 'U256')] +
+                     [(n, 'f8') for n in names[1:]])
+    table['infile'] = np.repeat(infiles, npairs)
+    table['z1'] = np.tile(pairs[:, 0], nfiles)
+    table['z2'] = np.tile(pairs[:, 1], nfiles)
+    for n in names[3:]:
+        table[n] = results.get(n, nan).ravel()
+
+    lines = [",".join(names)]
+    for row in table:
+        lines.append(",".join([row['infile']] + [f"{row[n]:.6E}" for n in names[1:]]))
+    if outfile is None:
+        print("\n".join(lines))
+    else:
+        with open(outfile, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+    return table
 
 
 if __name__ == "__main__":
@@ -192,27 +414,50 @@ if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
 
-    parser.add_argument("-i", "--infile", required=True,
+    parser.add_argument("-i", "--infile", required=True, nargs='+',
                         help="Name of input file with data in columns. First "
                               "column should be z coordinates in order from "
                               "low to high values, second column "
                               "should have pmf values (kcal/mol), and third "
-                              "column (optionaly) should have error bars.")
+                              "column (optionaly) should have error bars. "
+                              "Several files on the same z grid are computed "
+                              "together into a CSV table.")
 
-    parser.add_argument("-1", "--z1", type=float,
+    parser.add_argument("-1", "--z1", type=float, nargs='+',
                         help="Z-coordinate of reference point in aqueous "
-                             "solution. PMF is taken relative to this point.")
+                             "solution. PMF is taken relative to this point. "
+                             "With several values, every (z1, z2) pair is "
+                             "computed into a CSV table.")
 
-    parser.add_argument("-2", "--z2", type=float,
+    parser.add_argument("-2", "--z2", type=float, nargs='+',
                         help="Z-coordinate of reference point in aqueous "
                              "solution on opposite side of membrane from z1. "
                              "Assign z2 such that z1 < z2.")
 
+    parser.add_argument("-o", "--outfile", default=None,
+                        help="Name of CSV file to write the table of several "
+                             "files or pairs. Default is to print it.")
+
     parser.add_argument("-t", "--temperature", type=float, default=295.0,
                         help="Temperature (K) to calculate thermodynamic beta."
                              " Default is 295 K.")
 
+    parser.add_argument("-m", "--method", choices=['linear', 'mc'], default='linear',
+                        help="Propagate error bars by first-order (linear) "
+                             "propagation or by Monte Carlo sampling of PMFs.")
+
+    parser.add_argument("-n", "--nsamples", type=int, default=10000,
+                        help="Number of sampled PMFs for Monte Carlo propagation.")
+
+    parser.add_argument("-s", "--seed", type=int, default=None,
+                        help="Seed for Monte Carlo propagation.")
+
     args = parser.parse_args()
 
-    calc_pmf_partition(args.infile, args.z1, args.z2, args.temperature)
+    if len(args.infile) == 1 and len(args.z1) == 1 and len(args.z2) == 1:
+        calc_pmf_partition(args.infile[0], args.z1[0], args.z2[0], args.temperature,
+                           args.method, args.nsamples, args.seed)
+    else:
+        pairs = [(z1, z2) for z1 in args.z1 for z2 in args.z2]
+        scan_partition(args.infile, pairs, args.temperature, args.outfile)
 
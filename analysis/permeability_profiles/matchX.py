@@ -10,9 +10,11 @@ Purpose: Match two sets of XY data based on most similar X-values.
          This can be used for when data comes from different sources,
          but there needs to be a 1:1 correspondence for further calculations.
 
+         Matching uses binary search on the sorted x-values, so grids
+         of 10^5-10^6 points are matched in a fraction of a second.
+
 Assumes:
 - No repeated x in either dataset.
-- Data sets are sorted by x-value.
 - The first x-value should be INSIDE the range of file2 x-values.
 
 TODO:
@@ -26,51 +28,85 @@ import os
 import sys
 
 
-def find_nearest(array, value):
+def find_nearest(array, values):
     """
-    Returns the index of "array" whose data best matches "value".
-    https://tinyurl.com/yc7twjx8
+    Returns the index of "array" whose data best matches each of "values",
+    by binary search in sorted order.
+
+    Ties are broken deterministically: a value exactly halfway between two
+    points of array matches the one with the smaller x (the first of equal
+    x in array order). This can differ from versions before binary search,
+    which picked among tied points arbitrarily.
+
+    Parameters
+    ----------
+    array : array-like
+        Data to search, not necessarily sorted
+    values : float or array-like
+        Values to match
+
+    Returns
+    -------
+    idxs : int or numpy array of ints
+        Indices into array, same shape as values
+
     """
     array = np.asarray(array)
-    idxs = np.argsort(np.abs(array - value))[0]
-    return idxs
+    order = np.argsort(array, kind='stable')
+    sarr = array[order]
 
+    # right neighbor in sorted array, then step left if that is closer
+    right = np.clip(np.searchsorted(sarr, values), 1, len(sarr)-1)
+    left = right - 1
+    closer_left = np.abs(values - sarr[left]) <= np.abs(sarr[right] - values)
+    pos = np.where(closer_left, left, right)
+    if len(sarr) == 1:
+        pos = np.zeros_like(pos)
 
-def list_duplicates(seq):
-    """
-    https://tinyurl.com/y8vb2bzq
-    """
-    seen = set()
-    seen_add = seen.add
-    # adds all elements it doesn't know yet to seen and all other to seen_twice
-    seen_twice = set( x for x in seq if x in seen or seen_add(x) )
-    # turn the set into a list (as requested)
-    return list( seen_twice )
+    return order[pos]
 
 
 def find_matches(refx, otrx, verbose=False):
+    """
+    Match each x of the reference data to the nearest x of the other data,
+    such that each x of the other data is used at most once. Where several
+    reference x share a nearest x, only the closest keeps the match.
+
+    Parameters
+    ----------
+    refx : array-like
+        X values of the reference data
+    otrx : array-like
+        X values of the other data
+    verbose : bool
+        Print each shared match and the reference x competing for it
+
+    Returns
+    -------
+    otr_inds_to_keep : numpy array of ints
+        Matching index of otrx for each refx, or -1 if unmatched
 
-    otr_inds_to_keep = [] # matching file2 index for each file1 x-value
+    """
+    refx = np.asarray(refx)
+    otrx = np.asarray(otrx)
 
     # get the closest element in file2 that matches file1
-    for i, a in enumerate(refx):
-        otr_inds_to_keep.append(find_nearest(otrx, a))
-
-    # get the indices that were reported more than once
-    dups = list_duplicates(otr_inds_to_keep)
-
-    # for each of the duplicates, find which entry to keep and which to discard
-    for d in dups:
-        locs = list(i for i,value in enumerate(otr_inds_to_keep) if value == d)
-        vals = [refx[i] for i in locs]
-        refotr = otrx[d]
-        if verbose: print(d, refotr, vals)
-        vals = np.abs(np.array(vals)-refotr)
-        best_dup = locs[np.argmin(vals)]
-        for l in locs:
-            if l != best_dup:
-                otr_inds_to_keep[l] = None
-
+    otr_inds_to_keep = find_nearest(otrx, refx)
+    dist = np.abs(refx - otrx[otr_inds_to_keep])
+
+    # sort by matched index, then distance; the first of each index is kept
+    order = np.lexsort((dist, otr_inds_to_keep))
+    sorted_inds = otr_inds_to_keep[order]
+    best = np.ones(len(order), dtype=bool)
+    best[1:] = sorted_inds[1:] != sorted_inds[:-1]
+
+    if verbose:
+        shared = np.unique(sorted_inds[~best])
+        for d in shared:
+            print(d, otrx[d], refx[otr_inds_to_keep == d])
+
+    otr_inds_to_keep = otr_inds_to_keep.copy()
+    otr_inds_to_keep[order[~best]] = -1
     return otr_inds_to_keep
 
 
@@ -102,18 +138,18 @@ def main(**kwargs):
 
     # find the best matches between the two files
     otr_inds_to_keep = find_matches(refx,otrx)
-    leftover = otr_inds_to_keep.count(None)
+    matched = otr_inds_to_keep >= 0
+    leftover = np.count_nonzero(~matched)
 
-    # get indices of none, and remove from original refx
-    nones = list(i for i,value in enumerate(otr_inds_to_keep) if value is None)
-    newrefx = [i for j,i in enumerate(refx) if j not in nones]
-    newrefy = [i for j,i in enumerate(refy) if j not in nones]
-    otr_inds_to_keep = [i for j,i in enumerate(otr_inds_to_keep) if j not in nones]
+    # remove unmatched x-values from original refx
+    newrefx = refx[matched]
+    newrefy = refy[matched]
+    otr_inds_to_keep = otr_inds_to_keep[matched]
     print("Found {} matches. {} x-values from reference file unmatched.".format(len(otr_inds_to_keep),leftover))
 
     # get the values of the matching otrx
-    newotrx = [otrx[i] for i in otr_inds_to_keep]
-    newotry = [otry[i] for i in otr_inds_to_keep]
+    newotrx = otrx[otr_inds_to_keep]
+    newotry = otry[otr_inds_to_keep]
 
     # quick assessment of the final matched values
     diffx = np.array(newrefx)-np.array(newotrx)
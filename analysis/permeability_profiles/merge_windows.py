@@ -0,0 +1,247 @@
+
+import os
+import multiprocessing
+import numpy as np
+from abf_pmf_processor import Profile, Grad, Pmf, write_colvars_grid
+
+# Merge stratified ABF windows into one set of colvars grid files, as done by
+# a NAMD `run 0` with `inputPrefix` in ABF/winmerge, without NAMD.
+# Like NAMD, the inputs of each window are read from prefix.grad and
+# prefix.count and, for eABF with CZAR, prefix.zgrad and prefix.zcount.
+
+
+def read_window(prefix):
+    """Read the gradients and counts of one ABF window.
+
+    Parameters
+    ----------
+    prefix : string
+        input prefix of the window, as for inputPrefix in NAMD, such that
+        files prefix.grad and prefix.count exist
+
+    Returns
+    -------
+    grad : Grad
+        gradients of the window with its counts
+    zgrad : Grad
+        CZAR z-averaged gradients of the window with its z-counts, or None
+        if prefix.zgrad and prefix.zcount are not found
+    """
+    grad = Grad.from_grid_file(prefix+'.grad', prefix+'.count')
+    zfiles = [prefix+'.zgrad', prefix+'.zcount']
+    found = [os.path.exists(f) for f in zfiles]
+    if not any(found):
+        return grad, None
+    if not all(found):
+        raise FileNotFoundError("need both {} and {}".format(*zfiles))
+    return grad, Grad.from_grid_file(*zfiles)
+
+
+def pad_grid(grad, lower, upper):
+    """Extend a Grad with counts to the full grid of bins from lower to upper,
+    with zero gradient and zero counts in the new bins.
+
+    Parameters
+    ----------
+    grad : Grad
+        gradients with grid width and counts, e.g., from Grad.join_windows
+    lower : float
+        lower boundary of the full grid
+    upper : float
+        upper boundary of the full grid
+
+    Returns
+    -------
+    new_grad : Grad
+        new Grad object on the full grid
+    """
+    width = grad.width
+    x_full = np.arange(lower + width/2, upper, width)
+    index = np.rint((grad.xdata - x_full[0])/width).astype(int)
+    if index.min() < 0 or index.max() >= len(x_full):
+        raise ValueError("grid of {} is not within [{}, {}]".format(
+            grad.infile, lower, upper))
+
+    y_full = np.zeros(len(x_full))
+    n_full = np.zeros(len(x_full))
+    y_full[index] = grad.ydata
+    n_full[index] = grad.counts
+    return Grad(grad.infile, x_full, y_full, width=width, counts=n_full)
+
+
+def log_gradient(counts, width):
+    """Compute d ln(counts)/dz by finite differences, as colvars does for
+    the CZAR estimator: centered differences inside the grid, second-order
+    one-sided differences at its boundaries, and zero wherever a bin used
+    has no samples.
+
+    Parameters
+    ----------
+    counts : numpy array
+        samples in each bin of a non-periodic grid
+    width : float
+        bin width of the grid
+
+    Returns
+    -------
+    dlog : numpy array
+        derivative of the log of counts in each bin
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    dlog = np.zeros(len(counts))
+    if len(counts) < 3:
+        return dlog
+
+    # empty bins are not used, so avoid log(0)
+    logn = np.log(np.maximum(counts, 1))
+
+    # inside, use neighbors i-1 and i+1
+    ok = (counts[:-2] > 0) & (counts[2:] > 0)
+    dlog[1:-1] = np.where(ok, (logn[2:] - logn[:-2]) / (2*width), 0)
+
+    # at the boundaries, use the bin and its two inner neighbors
+    if np.all(counts[:3] > 0):
+        dlog[0] = (-3*logn[0] + 4*logn[1] - logn[2]) / (2*width)
+    if np.all(counts[-3:] > 0):
+        dlog[-1] = (3*logn[-1] - 4*logn[-2] + logn[-3]) / (2*width)
+    return dlog
+
+
+def czar_gradient(zgrad, T):
+    """Compute the CZAR free energy gradient from merged z-averaged gradients
+    and z-counts: zgrad - kT d ln(zcount)/dz.
+
+    Parameters
+    ----------
+    zgrad : Grad
+        merged z-averaged gradients with grid width and z-counts
+    T : float
+        temperature of the simulations in Kelvin
+
+    Returns
+    -------
+    czar : Grad
+        new Grad object of CZAR gradients, with the z-counts
+    """
+    kt = Profile._get_kt(T)
+    y_czar = zgrad.ydata - kt*log_gradient(zgrad.counts, zgrad.width)
+    return Grad(zgrad.infile, zgrad.xdata, y_czar, width=zgrad.width,
+                counts=zgrad.counts)
+
+
+def integrate_grid(grad):
+    """Integrate gradients of a grid to the free energy at its bin edges,
+    as in the .pmf file of NAMD, with its minimum set to zero.
+
+    Parameters
+    ----------
+    grad : Grad
+        gradients with grid width
+
+    Returns
+    -------
+    pmf : Pmf
+        new Pmf object with one more point than the gradients
+    """
+    x_pmf = np.append(grad.xdata - grad.width/2, grad.xdata[-1] + grad.width/2)
+    y_pmf = np.append(0, np.cumsum(grad.ydata*grad.width))
+    return Pmf(grad.infile, x_pmf, y_pmf - y_pmf.min())
+
+
+def merge_windows(prefixes, T, grid_range=None, nproc=1):
+    """Merge ABF windows with the count weighting of NAMD and CZAR.
+
+    Parameters
+    ----------
+    prefixes : list
+        list of strings of input prefixes of the windows, see read_window
+    T : float
+        temperature of the simulations in Kelvin, for the CZAR estimator
+    grid_range : list
+        lower and upper boundary of the merged grid; default is the union of
+        the grids of the windows
+    nproc : int
+        number of processes to read windows
+
+    Returns
+    -------
+    merged : dict
+        'grad' for merged gradients; if all windows have CZAR files, also
+        'zgrad' for merged z-averaged gradients and 'czar' for CZAR
+        gradients. All are Grad objects with counts.
+    """
+    if nproc == 1:
+        windows = [read_window(p) for p in prefixes]
+    else:
+        with multiprocessing.Pool(nproc) as pool:
+            windows = pool.map(read_window, prefixes)
+
+    grads, zgrads = zip(*windows)
+    merged = {'grad': Grad.join_windows(grads, weighted=True)}
+    if all(z is not None for z in zgrads):
+        merged['zgrad'] = Grad.join_windows(zgrads, weighted=True)
+    elif any(z is not None for z in zgrads):
+        raise ValueError("only some windows have .zgrad and .zcount files")
+
+    if grid_range is not None:
+        for key in merged:
+            merged[key] = pad_grid(merged[key], *grid_range)
+    if 'zgrad' in merged:
+        merged['czar'] = czar_gradient(merged['zgrad'], T)
+
+    return merged
+
+
+def write_merged(merged, out_prefix):
+    """Write merged windows to colvars grid files named as by NAMD:
+    out_prefix.grad, .count, and .pmf and, for CZAR, out_prefix.zgrad,
+    .zcount, .czar.grad, and .czar.pmf.
+
+    Parameters
+    ----------
+    merged : dict
+        merged Grad objects from merge_windows
+    out_prefix : string
+        output prefix, as for outputName in NAMD
+    """
+    grad = merged['grad']
+    grad.write_grid(out_prefix)
+    pmf = integrate_grid(grad)
+    write_colvars_grid(out_prefix+'.pmf', pmf.xdata, pmf.ydata, grad.width)
+
+    if 'czar' in merged:
+        zgrad = merged['zgrad']
+        write_colvars_grid(out_prefix+'.zgrad', zgrad.xdata, zgrad.ydata, zgrad.width)
+        write_colvars_grid(out_prefix+'.zcount', zgrad.xdata, zgrad.counts,
+                           zgrad.width, fmt='%d')
+        czar = merged['czar']
+        write_colvars_grid(out_prefix+'.czar.grad', czar.xdata, czar.ydata, czar.width)
+        pmf = integrate_grid(czar)
+        write_colvars_grid(out_prefix+'.czar.pmf', pmf.xdata, pmf.ydata, czar.width)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-i", "--inputs", required=True, nargs='+',
+                        help="Input prefixes of the windows, e.g., win01.02.czar, "
+                             "as for inputPrefix in NAMD.")
+
+    parser.add_argument("-o", "--output", default='merge',
+                        help="Output prefix of merged files.")
+
+    parser.add_argument("-t", "--temp", type=float, default=295,
+                        help="Temperature in Kelvin for the CZAR estimator.")
+
+    parser.add_argument("-r", "--range", type=float, nargs=2, default=None,
+                        help="Lower and upper boundary of the merged grid, as "
+                             "lowerBoundary and upperBoundary of the colvar. "
+                             "Default is the union of the windows' grids.")
+
+    parser.add_argument("-n", "--nproc", type=int, default=1,
+                        help="Number of processes to read windows.")
+
+    args = parser.parse_args()
+    merged = merge_windows(args.inputs, args.temp, args.range, args.nproc)
+    write_merged(merged, args.output)
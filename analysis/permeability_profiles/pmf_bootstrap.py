@@ -0,0 +1,418 @@
+
+import multiprocessing
+import numpy as np
+from scipy import integrate, stats
+from abf_pmf_processor import Profile, find_count_file, _grid_index
+
+# Estimate the uncertainty of a PMF from stratified ABF simulations by
+# splitting the gradient history of each window into blocks in time.
+# The history files (e.g., win01.hist.grad and win01.hist.count, written by
+# NAMD with historyFreq) hold the running average gradient and the running
+# counts at each history step, so the samples and summed gradients of each
+# block follow from the differences of consecutive snapshots.
+#
+# Each replicate PMF is built the same way as in grads_to_pmf: join windows,
+# integrate, shift bulk to zero, join leaflets, and symmetrize, but for all
+# replicates at once as arrays of shape (nreplicates, npoints). The
+# unweighted join averages each bin over the windows that sample it in the
+# replicate, whereas Grad.join_windows also averages in the zero gradient a
+# .grad file lists for an unsampled bin.
+#  * bootstrap: each replicate resamples the blocks of each window with
+#    replacement; errors are the std of replicates and percentile bands.
+#  * block: replicate b uses only block b of every window; errors are the
+#    std of the blocks over sqrt(nblocks) and t-distribution bands.
+
+
+def read_grid_history(infile):
+    """Read a colvars grid history file of a one-dimensional colvar, which
+    is a series of grids (e.g., .hist.grad, .hist.count) each with a header.
+
+    Parameters
+    ----------
+    infile : string
+        name of the grid history file
+
+    Returns
+    -------
+    x : numpy array
+        bin centers of the grid
+    width : float
+        bin width of the grid
+    values : numpy array
+        array of shape (nsnapshots, nbins) of the grid at each snapshot
+    """
+    with open(infile, 'r') as f:
+        f.readline()
+        fields = f.readline().split()
+    width, nbins = float(fields[2]), int(fields[3])
+
+    data = np.loadtxt(infile, comments='#', ndmin=2)
+    if len(data) % nbins != 0:
+        raise ValueError(f"{infile} does not hold whole grids of {nbins} bins")
+    data = data.reshape(-1, nbins, data.shape[1])
+    return data[0, :, 0], width, data[:, :, 1]
+
+
+def window_blocks(grad_file, nblocks, count_file=None):
+    """Split the gradient history of one window into blocks in time.
+
+    Parameters
+    ----------
+    grad_file : string
+        name of the gradient history file
+    nblocks : int
+        number of blocks, at most the number of snapshots
+    count_file : string
+        name of the count history file; default is found by find_count_file
+
+    Returns
+    -------
+    x : numpy array
+        bin centers of the grid of the window
+    width : float
+        bin width of the grid
+    grad_sums : numpy array
+        array of shape (nblocks, nbins) of summed gradients of each block
+    counts : numpy array
+        array of shape (nblocks, nbins) of samples of each block
+    """
+    if count_file is None:
+        count_file = find_count_file(grad_file)
+    x, width, grads = read_grid_history(grad_file)
+    x_count, _, counts = read_grid_history(count_file)
+    if grads.shape != counts.shape or not np.allclose(x, x_count):
+        raise ValueError(f"grids of {grad_file} and {count_file} differ")
+    nsnap = len(grads)
+    if nblocks > nsnap:
+        raise ValueError(f"cannot split {nsnap} snapshots of {grad_file} into {nblocks} blocks")
+
+    # running sums at the end of each block, starting from zero
+    ends = np.rint(np.linspace(0, nsnap, nblocks+1)[1:]).astype(int) - 1
+    cum_counts = np.vstack([np.zeros(len(x)), counts[ends]])
+    cum_sums = np.vstack([np.zeros(len(x)), counts[ends]*grads[ends]])
+    return x, width, np.diff(cum_sums, axis=0), np.diff(cum_counts, axis=0)
+
+
+def stack_leaflet(list_blocks):
+    """Put the blocks of all windows of one leaflet on the leaflet's grid.
+
+    Parameters
+    ----------
+    list_blocks : list
+        list of tuples from window_blocks, with the same number of blocks
+
+    Returns
+    -------
+    leaflet : dict
+        'x' of the grid points with data, as written in the files; 'sums'
+        and 'counts' of shape (nwindows, nblocks, npoints); and 'cover' of
+        shape (nwindows, npoints), whether each window has each point
+    """
+    width = list_blocks[0][1]
+    x_ref = list_blocks[0][0][0]
+    indices = [_grid_index(b[0], x_ref, width) for b in list_blocks]
+    all_index = np.unique(np.concatenate(indices))
+
+    nwin, nblocks, npts = len(list_blocks), len(list_blocks[0][2]), len(all_index)
+    x = np.zeros(npts)
+    sums = np.zeros((nwin, nblocks, npts))
+    counts = np.zeros((nwin, nblocks, npts))
+    cover = np.zeros((nwin, npts), dtype=bool)
+    for w, ((xw, _, s, n), index) in enumerate(zip(list_blocks, indices)):
+        if len(s) != nblocks:
+            raise ValueError("all windows need the same number of blocks")
+        pos = np.searchsorted(all_index, index)
+        x[pos] = xw
+        sums[w][:, pos] = s
+        counts[w][:, pos] = n
+        cover[w, pos] = True
+    return {'x': x, 'sums': sums, 'counts': counts, 'cover': cover}
+
+
+def _group_sum(y, groups):
+    """Sum columns of y (nrep, n) that belong to the same group."""
+    onehot = np.zeros((len(groups), groups.max()+1))
+    onehot[np.arange(len(groups)), groups] = 1
+    return y @ onehot
+
+
+def join_windows_batch(leaflet, weights, weighted=False):
+    """Join the windows of a leaflet for each replicate, as in
+    Grad.join_windows, but averaging each bin only over the windows with
+    samples of it in the replicate.
+
+    Parameters
+    ----------
+    leaflet : dict
+        blocks of one leaflet from stack_leaflet
+    weights : numpy array
+        array of shape (nrep, nwindows, nblocks) of how many times each
+        block of each window is used in each replicate
+    weighted : bool
+        weight windows by their samples instead of a plain average
+
+    Returns
+    -------
+    grad : numpy array
+        array of shape (nrep, npoints) of joined gradients
+    """
+    sums = np.einsum('rwb,wbg->rwg', weights, leaflet['sums'])
+    counts = np.einsum('rwb,wbg->rwg', weights, leaflet['counts'])
+    if weighted:
+        total = counts.sum(axis=1)
+        return np.divide(sums.sum(axis=1), total, out=np.zeros_like(total), where=total > 0)
+
+    # average over the windows that sample each bin in this replicate, so
+    # bins missed by the resampled blocks do not pull the mean toward zero
+    grads = np.divide(sums, counts, out=np.zeros_like(sums), where=counts > 0)
+    cover = (counts > 0).sum(axis=1)
+    return np.divide(grads.sum(axis=1), cover, out=np.zeros(cover.shape), where=cover > 0)
+
+
+def integrate_batch(x, grad, bulk_range):
+    """Integrate gradients and shift the bulk region to zero for each
+    replicate, as in Grad.integrate and Pmf.shift_bulk_zero.
+
+    Returns
+    -------
+    x_pmf : numpy array
+        midpoints of x
+    pmf : numpy array
+        array of shape (nrep, npoints-1) of PMFs
+    """
+    pmf = integrate.cumulative_trapezoid(grad, x, axis=1)
+    x_pmf = (x[1:] + x[:-1]) / 2
+    try:
+        i0, i1 = [np.where(np.isclose(x_pmf, x0))[0][0] for x0 in bulk_range]
+    except IndexError as e:
+        raise Exception("ERROR: at least one x-value of bulk range not found") from e
+    lo, hi = min(i0, i1), max(i0, i1)
+    pmf -= pmf[:, lo:hi+1].mean(axis=1, keepdims=True)
+    return x_pmf, pmf
+
+
+def join_leaflets_batch(x0, pmf0, x1, pmf1, T):
+    """Join the PMFs of two leaflets for each replicate, as in
+    Pmf.join_leaflets. Returns sorted x and PMFs."""
+    kt = Profile._get_kt(T)
+    x_unique, groups = np.unique(np.concatenate([x0, x1]), return_inverse=True)
+    boltz_sum = _group_sum(np.exp(-np.hstack([pmf0, pmf1])/kt), groups)
+    return x_unique, -kt*np.log(boltz_sum)
+
+
+def symmetrize_batch(x, pmf):
+    """Symmetrize PMFs for each replicate, as in Pmf.symmetrize."""
+    rhs_x, groups = np.unique(np.abs(x), return_inverse=True)
+    rhs_y = _group_sum(pmf, groups) / np.bincount(groups)
+    full_x = np.concatenate((np.flip(-rhs_x), rhs_x))
+    full_y = np.hstack((np.flip(rhs_y, axis=1), rhs_y))
+
+    # remove the -0.0 entry if it exists
+    if rhs_x[0] == 0.0:
+        full_x = np.delete(full_x, len(rhs_x)-1)
+        full_y = np.delete(full_y, len(rhs_x)-1, axis=1)
+    return full_x, full_y
+
+
+def pmf_batch(leaflets, weights, bulk_ranges, T, weighted=False):
+    """Compute the joined, symmetrized PMF for each replicate.
+
+    Parameters
+    ----------
+    leaflets : list
+        the two leaflets from stack_leaflet
+    weights : list
+        the two arrays of block weights of the leaflets, see join_windows_batch
+    bulk_ranges : list
+        the two bulk ranges of the leaflets, see grads_to_pmf
+    T : float
+        temperature of the system
+    weighted : bool
+        weight windows by their samples
+
+    Returns
+    -------
+    x : numpy array
+        x of the symmetrized PMFs
+    pmfs : numpy array
+        array of shape (nrep, npoints) of symmetrized PMFs
+    """
+    parts = []
+    for leaflet, w, bulk in zip(leaflets, weights, bulk_ranges):
+        grad = join_windows_batch(leaflet, w, weighted)
+        parts.extend(integrate_batch(leaflet['x'], grad, bulk))
+    x, pmf = join_leaflets_batch(*parts, T)
+    return symmetrize_batch(x, pmf)
+
+
+def _pmf_job(job):
+    return pmf_batch(*job)[1]
+
+
+def resample_weights(nwindows, nblocks, nreps, mode, rng):
+    """Get the block weights of each replicate of one leaflet.
+
+    Returns
+    -------
+    weights : numpy array
+        array of shape (nreps, nwindows, nblocks); for block mode, nreps is
+        nblocks and replicate b uses only block b
+    """
+    if mode == 'block':
+        return np.broadcast_to(np.eye(nblocks)[:, np.newaxis, :],
+                               (nblocks, nwindows, nblocks)).astype(float)
+    return rng.multinomial(nblocks, np.full(nblocks, 1/nblocks),
+                           size=(nreps, nwindows)).astype(float)
+
+
+def pmf_uncertainty(
+    side0_files, side1_files,
+    bulk_range0, bulk_range1,
+    T,
+    nblocks=10,
+    nreps=1000,
+    mode='bootstrap',
+    level=0.95,
+    weighted=False,
+    nproc=1,
+    seed=None):
+    """Main function to estimate per-bin errors of the symmetrized PMF from
+    gradient history files of each window.
+
+    Parameters
+    ----------
+    side0_files : list
+        list of strings of filenames of gradient history files of one leaflet
+    side1_files : list
+        list of strings of filenames of gradient history files of other leaflet
+    bulk_range0 : list
+        list of floats for x values that define bulk region for side0 PMF
+    bulk_range1 : list
+        list of floats for x values that define bulk region for side1 PMF
+    T : float
+        temperature of the system
+    nblocks : int
+        number of blocks in time of each window
+    nreps : int
+        number of bootstrap replicates; unused for block mode
+    mode : string
+        'bootstrap' or 'block'
+    level : float
+        confidence level of the bands
+    weighted : bool
+        weight windows by their samples, as with grads_to_pmf
+    nproc : int
+        number of processes over replicates
+    seed : int
+        seed of the bootstrap resampling
+
+    Returns
+    -------
+    result : dict
+        'x', 'pmf' of all data, 'stderr', 'lower' and 'upper' of the
+        confidence band, and 'replicates' of shape (nreps, npoints)
+    """
+    if mode not in ('bootstrap', 'block'):
+        raise ValueError(f"unknown mode {mode}")
+    leaflets = [stack_leaflet([window_blocks(f, nblocks) for f in files])
+                for files in [side0_files, side1_files]]
+    bulk_ranges = [bulk_range0, bulk_range1]
+
+    # all blocks once gives the PMF of all data
+    full = [np.ones((1,) + lf['cover'].shape[:1] + (nblocks,)) for lf in leaflets]
+    x, pmf_full = pmf_batch(leaflets, full, bulk_ranges, T, weighted)
+
+    rng = np.random.default_rng(seed)
+    weights = [resample_weights(len(lf['cover']), nblocks, nreps, mode, rng)
+               for lf in leaflets]
+
+    # split replicates into chunks, one or more per process
+    nrep = len(weights[0])
+    nchunks = 1 if nproc == 1 else min(nrep, 4*(nproc or multiprocessing.cpu_count()))
+    chunks = np.array_split(np.arange(nrep), nchunks)
+    jobs = [(leaflets, [w[c] for w in weights], bulk_ranges, T, weighted) for c in chunks]
+    if nproc == 1:
+        pmfs = [_pmf_job(job) for job in jobs]
+    else:
+        with multiprocessing.Pool(nproc) as pool:
+            pmfs = pool.map(_pmf_job, jobs)
+    pmfs = np.vstack(pmfs)
+
+    alpha = (1 - level) / 2
+    if mode == 'bootstrap':
+        stderr = pmfs.std(axis=0, ddof=1)
+        lower, upper = np.percentile(pmfs, [100*alpha, 100*(1-alpha)], axis=0)
+    else:
+        stderr = pmfs.std(axis=0, ddof=1) / np.sqrt(nblocks)
+        half = stats.t.ppf(1-alpha, nblocks-1) * stderr
+        lower, upper = pmf_full[0] - half, pmf_full[0] + half
+
+    return {'x': x, 'pmf': pmf_full[0], 'stderr': stderr,
+            'lower': lower, 'upper': upper, 'replicates': pmfs}
+
+
+def write_uncertainty(result, outfile, level=0.95):
+    """Write x, PMF, standard error, and confidence band columns."""
+    header = ("x  pmf  stderr  lower  upper  ({:g}% band of {:d} replicates)".format(
+              100*level, len(result['replicates'])))
+    np.savetxt(outfile, np.c_[result['x'], result['pmf'], result['stderr'],
+               result['lower'], result['upper']],
+               header=header, fmt=['%.2f', '%.6f', '%.6f', '%.6f', '%.6f'])
+
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-0", "--side0", required=True, nargs='+',
+                        help="Gradient history files (e.g., .hist.grad) of one leaflet.")
+
+    parser.add_argument("-1", "--side1", required=True, nargs='+',
+                        help="Gradient history files (e.g., .hist.grad) of other leaflet.")
+
+    parser.add_argument("-b", "--nblocks", type=int, default=10,
+                        help="Number of blocks in time of each window.")
+
+    parser.add_argument("-r", "--nreps", type=int, default=1000,
+                        help="Number of bootstrap replicates.")
+
+    parser.add_argument("-m", "--mode", choices=['bootstrap', 'block'], default='bootstrap',
+                        help="Resample blocks with replacement, or use each block once.")
+
+    parser.add_argument("-l", "--level", type=float, default=0.95,
+                        help="Confidence level of the bands.")
+
+    parser.add_argument("-t", "--temp", type=float, default=295,
+                        help="Temperature of the system in Kelvin.")
+
+    parser.add_argument("--bulk0", type=float, nargs=2, default=[35, 39.9],
+                        help="Range of x values of the bulk region of the -0 PMF.")
+
+    parser.add_argument("--bulk1", type=float, nargs=2, default=[-35, -39.9],
+                        help="Range of x values of the bulk region of the -1 PMF.")
+
+    parser.add_argument("-w", "--weighted", action="store_true", default=False,
+                        help="Weight windows by their samples.")
+
+    parser.add_argument("-n", "--nproc", type=int, default=1,
+                        help="Number of processes over replicates.")
+
+    parser.add_argument("-s", "--seed", type=int, default=None,
+                        help="Seed of the bootstrap resampling.")
+
+    parser.add_argument("-o", "--outfile", default='pmf_bootstrap.dat',
+                        help="Name of the output file.")
+
+    parser.add_argument("--replicates", default=None,
+                        help="Also write x and one column per replicate PMF to "
+                             "this file, e.g., for calc_perme.py -r pmf.")
+
+    args = parser.parse_args()
+    result = pmf_uncertainty(
+        args.side0, args.side1, args.bulk0, args.bulk1, args.temp,
+        nblocks=args.nblocks, nreps=args.nreps, mode=args.mode, level=args.level,
+        weighted=args.weighted, nproc=args.nproc, seed=args.seed)
+    write_uncertainty(result, args.outfile, args.level)
+    if args.replicates is not None:
+        np.savetxt(args.replicates, np.c_[result['x'], result['replicates'].T], fmt='%.6f')
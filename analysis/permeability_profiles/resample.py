@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+
+"""
+Usage:   python resample.py -i water_2.csv -o water_2_angstrom.dat -x nm -y nm2/ns -g water_1.csv -m cubic
+
+Purpose: Resample profiles (e.g., PMF or diffusivity) from different sources
+         (ABF, US, MBAR, digitized plots) onto a common colvar grid, and
+         convert them to the units used by these scripts: Angstrom for the
+         colvar, kcal/mol for energies, and Angstrom^2/ns for diffusivities.
+
+         Methods:
+          * linear: linear interpolation between neighboring points
+          * cubic: cubic spline interpolation, needs scipy
+          * bin: average of the points in the bin around each grid point,
+            for a target grid coarser than the data. Empty bins are filled
+            by linear interpolation.
+
+         Profiles are never extrapolated; the target grid must lie within
+         the range of the data, see common_grid.
+
+"""
+
+import numpy as np
+
+
+# factor to multiply values in each unit by to get the units of these scripts
+UNITS = {
+    'length': {'A': 1., 'angstrom': 1., 'nm': 10.},
+    'energy': {'kcal/mol': 1., 'kJ/mol': 1./4.184},
+    'diffusivity': {'A2/ns': 1., 'nm2/ns': 100., 'cm2/s': 1.e7},
+}
+
+
+def convert(values, unit, kind):
+    """
+    Convert values to the units of these scripts.
+
+    Parameters
+    ----------
+    values : array-like
+        values in the given unit
+    unit : string
+        unit of the values, a key of UNITS[kind]
+    kind : string
+        'length', 'energy', or 'diffusivity'
+
+    Returns
+    -------
+    values : numpy array
+        values in Angstrom, kcal/mol, or Angstrom^2/ns
+
+    """
+    try:
+        factor = UNITS[kind][unit]
+    except KeyError:
+        raise ValueError("unknown {} unit '{}'; choose from {}".format(
+                         kind, unit, ', '.join(UNITS.get(kind, {}))))
+    return np.asarray(values, dtype=np.float64) * factor
+
+
+def unit_kind(unit):
+    """Get the kind of quantity ('length', 'energy', 'diffusivity') of a unit."""
+    for kind, units in UNITS.items():
+        if unit in units:
+            return kind
+    raise ValueError("unknown unit '{}'".format(unit))
+
+
+def common_grid(xs, spacing=None):
+    """
+    Generate an evenly spaced grid over the overlap of several grids.
+
+    Parameters
+    ----------
+    xs : list of array-likes
+        colvar grids of each profile
+    spacing : float
+        spacing of the new grid; default is the finest median spacing
+        of the input grids
+
+    Returns
+    -------
+    grid : numpy array
+        evenly spaced colvar values from the largest minimum to the
+        smallest maximum of the grids
+
+    """
+    lo = max(np.min(x) for x in xs)
+    hi = min(np.max(x) for x in xs)
+    if lo >= hi:
+        raise ValueError("the colvar grids do not overlap")
+    if spacing is None:
+        spacing = min(np.median(np.diff(np.sort(x))) for x in xs)
+    npoints = int(np.floor((hi - lo)/spacing + 1e-6)) + 1
+    return lo + spacing*np.arange(npoints)
+
+
+def _sorted(x, y):
+    """Sort x in increasing order, with y of shape (..., npoints) to match."""
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    order = np.argsort(x, kind='stable')
+    return x[order], y[..., order]
+
+
+def linear(x, y, target):
+    """Interpolate profiles y of shape (..., npoints) linearly onto target."""
+    x, y = _sorted(x, y)
+    right = np.clip(np.searchsorted(x, target), 1, len(x)-1)
+    left = right - 1
+    frac = (target - x[left]) / (x[right] - x[left])
+    return y[..., left]*(1-frac) + y[..., right]*frac
+
+
+def cubic(x, y, target):
+    """Interpolate profiles y of shape (..., npoints) onto target with a
+    not-a-knot cubic spline."""
+    try:
+        from scipy.interpolate import CubicSpline
+    except ImportError:
+        raise ImportError("cubic resampling needs scipy")
+    x, y = _sorted(x, y)
+    return CubicSpline(x, y, axis=-1)(target)
+
+
+def bin_average(x, y, target):
+    """
+    Average profiles over bins around the target grid points. Bin edges are
+    halfway between grid points, and the outer bins are as wide on the
+    outside as on the inside.
+
+    Parameters
+    ----------
+    x : array-like
+        colvar values of the data
+    y : array-like
+        profiles of shape (..., npoints)
+    target : array-like
+        increasing colvar values of the grid
+
+    Returns
+    -------
+    avg : numpy array
+        average of each bin, of shape (..., ntarget); nan for empty bins
+    counts : numpy array
+        number of data points in each bin
+
+    """
+    x, y = _sorted(x, y)
+    target = np.asarray(target, dtype=np.float64)
+    mids = (target[1:] + target[:-1])/2
+    if len(target) > 1:
+        edges = np.concatenate(([2*target[0] - mids[0]], mids, [2*target[-1] - mids[-1]]))
+    else:
+        edges = np.array([-np.inf, np.inf])
+
+    # points outside the outer edges are not in any bin
+    which = np.searchsorted(edges, x, side='right') - 1
+    inside = (which >= 0) & (which < len(target))
+    which = which[inside]
+
+    counts = np.bincount(which, minlength=len(target))
+    sums = np.zeros((len(target),) + y.shape[:-1])
+    np.add.at(sums, which, np.moveaxis(y[..., inside], -1, 0))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        avg = np.moveaxis(sums, 0, -1) / counts
+    return avg, counts
+
+
+def resample(x, y, target, method='linear'):
+    """
+    Resample profiles onto a target grid.
+
+    Parameters
+    ----------
+    x : array-like
+        colvar values of the data
+    y : array-like
+        profiles of shape (npoints,) or (nprofiles, npoints)
+    target : array-like
+        increasing colvar values to resample onto, within the range of x
+    method : string
+        'linear', 'cubic', or 'bin'
+
+    Returns
+    -------
+    yt : numpy array
+        profiles on the target grid, of shape (..., ntarget)
+
+    """
+    x = np.asarray(x, dtype=np.float64)
+    target = np.asarray(target, dtype=np.float64)
+    tol = 1e-6*max(np.ptp(x), 1.)
+    if target.min() < x.min() - tol or target.max() > x.max() + tol:
+        raise ValueError("target grid [{:g}, {:g}] is outside the range of "
+                         "the data [{:g}, {:g}]".format(target.min(), target.max(),
+                                                        x.min(), x.max()))
+    target = np.clip(target, x.min(), x.max())
+
+    if method == 'linear':
+        return linear(x, y, target)
+    elif method == 'cubic':
+        return cubic(x, y, target)
+    elif method == 'bin':
+        avg, counts = bin_average(x, y, target)
+        if np.any(counts == 0):
+            avg[..., counts == 0] = linear(x, y, target[counts == 0])
+        return avg
+    raise ValueError("unknown resampling method '{}'".format(method))
+
+
+def main(**kwargs):
+
+    data = np.genfromtxt(args.infile, delimiter=',' if args.infile.endswith('.csv') else None)
+    x = convert(data[:,0], args.xunits, 'length')
+    y = convert(data[:,1:].T, args.yunits, unit_kind(args.yunits))
+
+    if args.grid is not None:
+        ref = np.genfromtxt(args.grid, delimiter=',' if args.grid.endswith('.csv') else None)
+        target = convert(ref[:,0], args.grid_xunits, 'length')
+        target = target[(target >= x.min()) & (target <= x.max())]
+    else:
+        target = common_grid([x], args.spacing)
+
+    yt = resample(x, y, target, args.method)
+    np.savetxt(args.outfile, np.column_stack([target, yt.T]), fmt='%.6f')
+
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-i", "--infile", required=True,
+                        help="Profile with colvar values in the first column "
+                             "and one or more profiles in the other columns.")
+    parser.add_argument("-o", "--outfile", required=True,
+                        help="Name of the output file.")
+    parser.add_argument("-m", "--method", choices=['linear', 'cubic', 'bin'],
+                        default='linear', help="Resampling method.")
+    parser.add_argument("-g", "--grid", default=None,
+                        help="Resample onto the colvar values in the first "
+                             "column of this file, within the range of the data.")
+    parser.add_argument("--grid-xunits", default='A', choices=list(UNITS['length']),
+                        help="Units of the colvar values of the grid file.")
+    parser.add_argument("-s", "--spacing", type=float, default=None,
+                        help="Without --grid, resample onto an even grid with "
+                             "this spacing (Angstrom). Default is the median "
+                             "spacing of the data.")
+    parser.add_argument("-x", "--xunits", default='A', choices=list(UNITS['length']),
+                        help="Units of the colvar values of the input file.")
+    parser.add_argument("-y", "--yunits", default='kcal/mol',
+                        choices=list(UNITS['energy']) + list(UNITS['diffusivity']),
+                        help="Units of the profiles of the input file.")
+
+    args = parser.parse_args()
+    opt = vars(args)
+    main(**opt)